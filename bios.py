@@ -0,0 +1,347 @@
+import math
+from helper import *
+
+BIOS_IF = 0x03007ff8  # interrupt handlers OR the flags they served in here for IntrWait
+IME = 0x04000208
+HALTCNT = 0x04000301
+
+# the BIOS IRQ vector: saves the scratch registers, calls the handler whose
+# address the game stored at 0x03007ffc and returns from the exception
+IRQ_HANDLER = (
+    0xe92d500f,  # stmfd sp!, {r0-r3, r12, lr}
+    0xe3a00301,  # mov r0, #0x04000000
+    0xe28fe000,  # add lr, pc, #0
+    0xe510f004,  # ldr pc, [r0, #-4]
+    0xe8bd500f,  # ldmfd sp!, {r0-r3, r12, lr}
+    0xe25ef004,  # subs pc, lr, #4
+)
+
+# stack pointers and mode the BIOS leaves behind before jumping to the cartridge
+BOOT_STACKS = ((0b10011, 0x03007fe0), (0b10010, 0x03007fa0), (0b11111, 0x03007f00))
+
+# the BIOS sine table, a full turn in 256 steps, Q14 rounded towards zero
+SINE_TABLE = tuple(int(math.sin(math.pi * i / 128) * 0x4000) for i in range(256))
+
+
+def trunc_div(a, b):
+    # C division, rounding towards zero
+    q = abs(a) // abs(b)
+    return q if (a < 0) == (b < 0) else -q
+
+
+def arctan(x):
+    # the BIOS polynomial, bit exact for 1.14 fixed point input
+    a = -((x * x) >> 14)
+    b = ((0xa9 * a) >> 14) + 0x390
+    b = ((b * a) >> 14) + 0x91c
+    b = ((b * a) >> 14) + 0xfb6
+    b = ((b * a) >> 14) + 0x16aa
+    b = ((b * a) >> 14) + 0x2081
+    b = ((b * a) >> 14) + 0x3651
+    b = ((b * a) >> 14) + 0xa2f9
+    return (x * b) >> 16
+
+
+def arctan2(x, y):
+    if y == 0:
+        return 0x8000 if x < 0 else 0
+    if x == 0:
+        return 0xc000 if y < 0 else 0x4000
+    if y >= 0:
+        if x >= 0:
+            if x >= y:
+                return arctan(trunc_div(y << 14, x))
+        elif -x >= y:
+            return arctan(trunc_div(y << 14, x)) + 0x8000
+        return 0x4000 - arctan(trunc_div(x << 14, y))
+    if x <= 0:
+        if -x > -y:
+            return arctan(trunc_div(y << 14, x)) + 0x8000
+    elif x >= -y:
+        return (arctan(trunc_div(y << 14, x)) + 0x10000) & 0xffff
+    return 0xc000 - arctan(trunc_div(x << 14, y))
+
+
+def rotation(sx, sy, angle):
+    # PA, PB, PC and PD for 8.8 scale factors and the top byte of angle, shifted like the BIOS
+    sin = SINE_TABLE[angle >> 8 & 0xff]
+    cos = SINE_TABLE[(angle >> 8) + 64 & 0xff]
+    return sx * cos >> 14, -sx * sin >> 14, sy * sin >> 14, sy * cos >> 14
+
+
+def signed(value, bits):
+    if value & 1 << bits - 1:
+        return value - (1 << bits)
+    return value
+
+
+# The decoders return the decompressed bytes and the offset after the
+# compressed data. A stream running past the end of data stops where it is
+# cut off, so a bad pointer from the game only gives a short result.
+
+def lz77(data, offset):
+    size = get_bytes(data, offset, 4) >> 8
+    out = bytearray()
+    i = offset + 4
+    end = len(data)
+    while len(out) < size and i < end:
+        flags = data[i]
+        i += 1
+        for bit in range(7, -1, -1):
+            if len(out) >= size:
+                break
+            if flags >> bit & 1:
+                if i + 1 >= end:
+                    return bytes(out), end
+                length = (data[i] >> 4) + 3
+                start = len(out) - ((data[i] & 15) << 8 | data[i + 1]) - 1
+                if start < 0:  # refers to before the start of the output
+                    return bytes(out), i
+                i += 2
+                for j in range(start, start + length):  # overlapping copies repeat the pattern
+                    out.append(out[j])
+            else:
+                if i >= end:
+                    return bytes(out), end
+                out.append(data[i])
+                i += 1
+    return bytes(out[:size]), min(i, end)
+
+
+def run_length(data, offset):
+    size = get_bytes(data, offset, 4) >> 8
+    out = bytearray()
+    i = offset + 4
+    end = len(data)
+    while len(out) < size and i < end:
+        flag = data[i]
+        if flag & 0x80:
+            if i + 1 >= end:
+                return bytes(out), end
+            out += bytes((data[i + 1],)) * ((flag & 0x7f) + 3)
+            i += 2
+        else:
+            length = (flag & 0x7f) + 1
+            out += data[i + 1:i + 1 + length]  # a slice past the end is just short
+            i += 1 + length
+    return bytes(out[:size]), min(i, end)
+
+
+def huffman(data, offset):
+    header = get_bytes(data, offset, 4)
+    bits = header & 15
+    size = header >> 8
+    root = offset + 5
+    end = len(data)
+    if root >= end:
+        return b"", end
+    stream = offset + 4 + (data[offset + 4] + 1) * 2
+    out = bytearray()
+    word = 0  # output symbols are packed into words from the low bits up
+    filled = 0
+    node = root
+    while len(out) < size and stream + 4 <= end:
+        code = get_bytes(data, stream, 4)
+        stream += 4
+        for bit in range(31, -1, -1):
+            b = code >> bit & 1
+            child = (node & ~1) + (data[node] & 0x3f) * 2 + 2 + b
+            if child >= end:
+                return bytes(out), end
+            if data[node] & 0x80 >> b:  # bit 7 marks node 0 as data, bit 6 node 1
+                word |= (data[child] & (1 << bits) - 1) << filled
+                filled += bits
+                if filled == 32:
+                    out += word.to_bytes(4, "little")
+                    word = filled = 0
+                    if len(out) >= size:
+                        break
+                node = root
+            else:
+                node = child
+    return bytes(out[:size]), stream
+
+
+class HleBios:
+    # Runs the common BIOS calls natively instead of through the BIOS image,
+    # so games boot without one. Waiting calls halt through HALTCNT like the
+    # real BIOS, and unknown calls are skipped and remembered in unsupported.
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.memory = cpu.memory
+        self.calls = {
+            0x02: self.halt,
+            0x03: self.halt,  # Stop, treated as halt
+            0x04: self.intr_wait,
+            0x05: self.vblank_intr_wait,
+            0x06: self.div,
+            0x07: self.div_arm,
+            0x08: self.sqrt,
+            0x09: self.arctan,
+            0x0a: self.arctan2,
+            0x0b: self.cpu_set,
+            0x0c: self.cpu_fast_set,
+            0x0e: self.bg_affine_set,
+            0x0f: self.obj_affine_set,
+            0x11: self.lz77,
+            0x12: self.lz77,
+            0x13: self.huffman,
+            0x14: self.run_length,
+            0x15: self.run_length,
+        }
+        self.count = 0
+        self.unsupported = set()
+        self.waiting = None  # flags an IntrWait that runs again after each interrupt is waiting for
+        cpu.bios = self
+
+    def call(self, number):
+        self.count += 1
+        handler = self.calls.get(number)
+        if handler is None:
+            self.unsupported.add(number)
+        else:
+            handler()
+
+    def install(self):
+        # an empty BIOS area with just the IRQ vector, for running without an image
+        data = bytearray(self.memory.SYS_ROM.end - self.memory.SYS_ROM.start + 1)
+        for i, cmd in enumerate(IRQ_HANDLER):
+            set_bytes(data, 0x18 + 4 * i, 4, cmd)
+        self.memory.SYS_ROM.initialize(data)
+
+    def boot(self):
+        # the state the BIOS hands over to the cartridge
+        cpu = self.cpu
+        for mode, sp in BOOT_STACKS:
+            cpu.status = mode
+            cpu.SP = sp
+        cpu.flush_pipeline()
+        cpu.PC = 0x08000000
+
+    def halt(self):
+        self.memory.write8(HALTCNT, 0)
+
+    def intr_wait(self):
+        # Sleeps until a handler has set one of the r1 flags in BIOS_IF, then
+        # clears them. The SWI is executed again after every interrupt until
+        # the flags show up, which is when the real BIOS loop would return.
+        reg = self.cpu.reg
+        flags = self.memory.read16(BIOS_IF)
+        if self.waiting is None and reg[0]:
+            self.memory.write16(BIOS_IF, flags & Not32(reg[1]))
+        elif flags & reg[1]:
+            self.memory.write16(BIOS_IF, flags & Not32(reg[1]))
+            self.waiting = None
+            return
+        self.waiting = reg[1]
+        self.memory.write16(IME, 1)
+        self.cpu.PC -= 2 * self.cpu.word_size
+        self.cpu.branched = True
+        self.halt()
+
+    def vblank_intr_wait(self):
+        if self.waiting is None:
+            self.cpu.reg[0] = 1
+            self.cpu.reg[1] = 1
+        self.intr_wait()
+
+    def div(self):
+        reg = self.cpu.reg
+        num = SInt32(reg[0])
+        den = SInt32(reg[1])
+        if den == 0:  # the BIOS never returns
+            return
+        q = trunc_div(num, den)
+        reg[0] = UInt32(q) & 0xffffffff
+        reg[1] = UInt32(num - q * den)
+        reg[3] = abs(q) & 0xffffffff
+
+    def div_arm(self):
+        reg = self.cpu.reg
+        reg[0], reg[1] = reg[1], reg[0]
+        self.div()
+
+    def sqrt(self):
+        self.cpu.reg[0] = math.isqrt(self.cpu.reg[0])
+
+    def arctan(self):
+        self.cpu.reg[0] = arctan(signed(self.cpu.reg[0] & 0xffff, 16)) & 0xffffffff
+
+    def arctan2(self):
+        reg = self.cpu.reg
+        reg[0] = arctan2(signed(reg[0] & 0xffff, 16), signed(reg[1] & 0xffff, 16)) & 0xffff
+
+    def cpu_set(self):
+        reg = self.cpu.reg
+        unit = 4 if reg[2] & 1 << 26 else 2
+        self.transfer(reg[0], reg[1], reg[2] & 0x1fffff, unit, reg[2] & 1 << 24)
+
+    def cpu_fast_set(self):
+        reg = self.cpu.reg
+        count = (reg[2] & 0x1fffff) + 7 & ~7  # whole blocks of eight words
+        self.transfer(reg[0], reg[1], count, 4, reg[2] & 1 << 24)
+
+    def transfer(self, src, dst, count, unit, fill):
+        src &= Not32(unit - 1)
+        dst &= Not32(unit - 1)
+        if not count:
+            return
+        if fill:
+            value = self.memory.read16(src) if unit == 2 else self.memory.read32(src)
+            self.memory.fill(dst, value, count, unit)
+        else:
+            self.memory.copy(dst, src, count, unit)
+
+    def bg_affine_set(self):
+        reg = self.cpu.reg
+        read16 = self.memory.read16
+        read32 = self.memory.read32
+        write16 = self.memory.write16
+        write32 = self.memory.write32
+        src, dst = reg[0], reg[1]
+        for i in range(reg[2]):
+            ox = signed(read32(src), 32)
+            oy = signed(read32(src + 4), 32)
+            cx = signed(read16(src + 8), 16)
+            cy = signed(read16(src + 10), 16)
+            pa, pb, pc, pd = rotation(signed(read16(src + 12), 16), signed(read16(src + 14), 16), read16(src + 16))
+            write16(dst, pa)
+            write16(dst + 2, pb)
+            write16(dst + 4, pc)
+            write16(dst + 6, pd)
+            write32(dst + 8, ox - (pa * cx + pb * cy))  # 8.8 times whole pixels gives the 24.8 of BG2X
+            write32(dst + 12, oy - (pc * cx + pd * cy))
+            src += 20
+            dst += 16
+
+    def obj_affine_set(self):
+        reg = self.cpu.reg
+        read16 = self.memory.read16
+        write16 = self.memory.write16
+        src, dst, stride = reg[0], reg[1], reg[3]
+        for i in range(reg[2]):
+            params = rotation(signed(read16(src), 16), signed(read16(src + 2), 16), read16(src + 4))
+            for j in range(4):
+                write16(dst + j * stride, params[j])
+            src += 8
+            dst += 4 * stride
+
+    def decompress(self, decoder):
+        # decodes straight from the source buffer and stores the result in one block
+        memory = self.memory
+        reg = self.cpu.reg
+        bank, offset = memory.resolve(memory.regions, reg[0], 4)
+        if bank is None:
+            return
+        out, end = decoder(bank.data, offset)
+        bank.mark_touched(offset, end - offset)
+        memory.write_block(reg[1], out)
+
+    def lz77(self):
+        self.decompress(lz77)
+
+    def run_length(self):
+        self.decompress(run_length)
+
+    def huffman(self):
+        self.decompress(huffman)
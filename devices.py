@@ -0,0 +1,324 @@
+from functools import partial
+from helper import *
+
+# IO register offsets
+DISPSTAT = 0x004
+VCOUNT = 0x006
+DMA0SAD = 0x0b0
+TM0CNT = 0x100
+IE = 0x200
+IF = 0x202
+IME = 0x208
+POSTFLG = 0x300
+HALTCNT = 0x301
+
+IRQ_VBLANK = 1 << 0
+IRQ_HBLANK = 1 << 1
+IRQ_VCOUNT = 1 << 2
+IRQ_TIMER0 = 1 << 3  # timer n is IRQ_TIMER0 << n
+IRQ_DMA0 = 1 << 8  # dma n is IRQ_DMA0 << n
+
+HDRAW_CYCLES = 960
+LINE_CYCLES = 1232
+VISIBLE_LINES = 160
+TOTAL_LINES = 228
+
+TIMER_SHIFTS = (0, 6, 8, 10)  # prescalers 1, 64, 256 and 1024
+
+DMA_IMMEDIATE = 0
+DMA_VBLANK = 1
+DMA_HBLANK = 2
+DMA_SPECIAL = 3
+DMA_COUNT_MASKS = (0x3fff, 0x3fff, 0x3fff, 0xffff)
+DMA_SOURCE_MASKS = (0x07ffffff, 0x0fffffff, 0x0fffffff, 0x0fffffff)
+DMA_DEST_MASKS = (0x07ffffff, 0x07ffffff, 0x07ffffff, 0x0fffffff)
+DMA_STEPS = (1, -1, 0, 1)  # address control: increment, decrement, fixed, increment and reload
+CAPTURE_FIRST_LINE = 2  # lines whose HBlank starts a channel 3 video capture transfer
+CAPTURE_LAST_LINE = 161
+FIFO_A = 0x040000a0
+FIFO_B = 0x040000a4
+
+
+def read_io16(io, offset):
+    return get_bytes(io.data, offset, 2)
+
+
+def write_io16(io, offset, value):
+    set_bytes(io.data, offset, 2, value)
+
+
+class Interrupts:
+    # IE, IF and IME, and HALTCNT which waits for them. Keeps cpu.irq_pending
+    # and cpu.halted up to date so the run loop only has to look at attributes.
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.io = cpu.memory.IO_RAM
+        self.io.write_handlers[IE] = self.write_enable
+        self.io.write_handlers[IF] = self.write_request
+        self.io.write_handlers[IME] = self.write_enable
+        self.io.write_handlers[POSTFLG] = self.write_haltcnt
+        self.io.data[HALTCNT] = 0xff  # write only, 0xff marks the last write as handled
+        self.halts = 0
+
+    def halt(self):
+        # sleeps until an enabled interrupt is requested, whether or not IME is set
+        io = self.io
+        self.halts += 1
+        self.cpu.halted = not read_io16(io, IE) & read_io16(io, IF) & 0x3fff
+
+    def write_haltcnt(self, offset, old):
+        # shares a halfword with POSTFLG, which must not halt again
+        if self.io.data[HALTCNT] != 0xff:
+            self.io.data[HALTCNT] = 0xff
+            self.halt()  # stop mode is treated as halt
+
+    def request(self, mask):
+        write_io16(self.io, IF, read_io16(self.io, IF) | mask)
+        self.update()
+
+    def write_enable(self, offset, old):
+        self.update()
+
+    def write_request(self, offset, old):
+        # writing a 1 acknowledges that interrupt
+        write_io16(self.io, IF, old & Not32(read_io16(self.io, IF)))
+        self.update()
+
+    def update(self):
+        io = self.io
+        requested = read_io16(io, IE) & read_io16(io, IF) & 0x3fff
+        if requested:
+            self.cpu.halted = False
+        self.cpu.irq_pending = bool(read_io16(io, IME) & 1 and requested)
+
+
+class Video:
+    # Scanline timing: HBlank starts 960 cycles into each of the 228 lines of
+    # 1232 cycles and VBlank covers lines 160 to 227. Keeps DISPSTAT and VCOUNT
+    # current, raises their interrupts and tells the listeners about each blank.
+    def __init__(self, cpu, interrupts):
+        self.cpu = cpu
+        self.io = cpu.memory.IO_RAM
+        self.interrupts = interrupts
+        self.scheduler = cpu.scheduler
+        self.vcount = 0
+        self.frames = 0
+        self.hblank_listeners = []  # called with the line that just finished drawing
+        self.vblank_listeners = []  # called without arguments when line 160 starts
+        self.io.write_handlers[DISPSTAT] = self.write_dispstat
+        self.io.write_handlers[VCOUNT] = self.write_vcount
+        self.scheduler.schedule(cpu.cycles + HDRAW_CYCLES, self.hblank)
+        self.scheduler.schedule(cpu.cycles + LINE_CYCLES, self.next_line)
+
+    def write_dispstat(self, offset, old):
+        # the blank and match flags are read only
+        write_io16(self.io, DISPSTAT, read_io16(self.io, DISPSTAT) & 0xff38 | old & 7)
+
+    def write_vcount(self, offset, old):
+        write_io16(self.io, VCOUNT, old)
+
+    def hblank(self, time):
+        stat = read_io16(self.io, DISPSTAT) | 2
+        write_io16(self.io, DISPSTAT, stat)
+        if stat & 0x10:
+            self.interrupts.request(IRQ_HBLANK)
+        for listener in self.hblank_listeners:
+            listener(self.vcount)
+        self.scheduler.schedule(time + LINE_CYCLES, self.hblank)
+
+    def next_line(self, time):
+        vcount = self.vcount = (self.vcount + 1) % TOTAL_LINES
+        write_io16(self.io, VCOUNT, vcount)
+        stat = read_io16(self.io, DISPSTAT) & 0xfff8
+        if VISIBLE_LINES <= vcount < TOTAL_LINES - 1:
+            stat |= 1
+        match = vcount == stat >> 8
+        if match:
+            stat |= 4
+        write_io16(self.io, DISPSTAT, stat)
+        if vcount == VISIBLE_LINES:
+            self.frames += 1
+            if stat & 8:
+                self.interrupts.request(IRQ_VBLANK)
+            for listener in self.vblank_listeners:
+                listener()
+        if match and stat & 0x20:
+            self.interrupts.request(IRQ_VCOUNT)
+        self.scheduler.schedule(time + LINE_CYCLES, self.next_line)
+
+
+class Timers:
+    # Counters are never ticked. A running timer remembers the cycle it last
+    # held a known value, reads work the count out from the cycle counter and
+    # the overflow is a scheduled event. Cascaded timers count the overflows
+    # of the timer below them instead.
+    def __init__(self, cpu, interrupts):
+        self.cpu = cpu
+        self.io = cpu.memory.IO_RAM
+        self.interrupts = interrupts
+        self.scheduler = cpu.scheduler
+        self.reload = [0, 0, 0, 0]
+        self.counter = [0, 0, 0, 0]  # value at start
+        self.start = [0, 0, 0, 0]
+        self.control = [0, 0, 0, 0]
+        self.events = [None, None, None, None]
+        self.overflows = 0
+        for n in range(4):
+            self.io.write_handlers[TM0CNT + 4 * n] = self.write_reload
+            self.io.write_handlers[TM0CNT + 4 * n + 2] = self.write_control
+            self.io.read_handlers[TM0CNT + 4 * n] = self.read_counter
+
+    def running(self, n):
+        # enabled and counting cycles rather than overflows
+        return self.control[n] & 0x80 and not (n and self.control[n] & 4)
+
+    def count(self, n, now):
+        if not self.running(n):
+            return self.counter[n]
+        value = self.counter[n] + (now - self.start[n] >> TIMER_SHIFTS[self.control[n] & 3])
+        if value > 0xffff:  # overflowed, the event just has not fired yet
+            value = self.reload[n] + (value - 0x10000) % (0x10000 - self.reload[n])
+        return value
+
+    def read_counter(self, offset):
+        write_io16(self.io, offset, self.count((offset - TM0CNT) >> 2, self.cpu.cycles))
+
+    def write_reload(self, offset, old):
+        self.reload[(offset - TM0CNT) >> 2] = read_io16(self.io, offset)
+
+    def write_control(self, offset, old):
+        n = (offset - TM0CNT) >> 2
+        now = self.cpu.cycles
+        value = read_io16(self.io, offset)
+        self.counter[n] = self.count(n, now)
+        self.start[n] = now
+        if value & 0x80 and not old & 0x80:
+            self.counter[n] = self.reload[n]
+        self.control[n] = value
+        self.schedule_overflow(n)
+
+    def schedule_overflow(self, n):
+        self.scheduler.cancel(self.events[n])
+        self.events[n] = None
+        if self.running(n):
+            ticks = 0x10000 - self.counter[n]
+            time = self.start[n] + (ticks << TIMER_SHIFTS[self.control[n] & 3])
+            self.events[n] = self.scheduler.schedule(time, partial(self.overflow, n))
+
+    def overflow(self, n, time):
+        self.overflows += 1
+        self.counter[n] = self.reload[n]
+        self.start[n] = time
+        if self.control[n] & 0x40:
+            self.interrupts.request(IRQ_TIMER0 << n)
+        self.schedule_overflow(n)
+        if n < 3 and self.control[n + 1] & 0x84 == 0x84:
+            self.counter[n + 1] += 1
+            if self.counter[n + 1] > 0xffff:
+                self.overflow(n + 1, time)
+
+
+class Dma:
+    # Four channels. Immediate transfers start two cycles after being enabled,
+    # HBlank and VBlank transfers when the video timing reports the blank.
+    # The CPU is stalled for the duration by adding the cycles to its counter.
+    # Special timing is video capture on channel 3, started by the HBlanks of
+    # lines 2 to 161 and stopped after them. On channels 1 and 2 it feeds the
+    # sound FIFOs; sound is not emulated, so those only run through
+    # fifo_request and otherwise stay enabled without transferring.
+    def __init__(self, cpu, interrupts, video):
+        self.cpu = cpu
+        self.io = cpu.memory.IO_RAM
+        self.interrupts = interrupts
+        self.scheduler = cpu.scheduler
+        self.source = [0, 0, 0, 0]
+        self.dest = [0, 0, 0, 0]
+        self.count = [0, 0, 0, 0]
+        self.control = [0, 0, 0, 0]
+        self.transfers = 0
+        for n in range(4):
+            self.io.write_handlers[DMA0SAD + 12 * n + 10] = self.write_control
+        video.hblank_listeners.append(self.hblank)
+        video.vblank_listeners.append(self.vblank)
+
+    def write_control(self, offset, old):
+        n = (offset - DMA0SAD) // 12
+        base = DMA0SAD + 12 * n
+        value = read_io16(self.io, offset)
+        self.control[n] = value
+        if value & 0x8000 and not old & 0x8000:
+            self.source[n] = get_bytes(self.io.data, base, 4) & DMA_SOURCE_MASKS[n]
+            self.dest[n] = get_bytes(self.io.data, base + 4, 4) & DMA_DEST_MASKS[n]
+            self.count[n] = self.word_count(n)
+            if value >> 12 & 3 == DMA_IMMEDIATE:
+                self.scheduler.schedule(self.cpu.cycles + 2, partial(self.transfer, n))
+
+    def word_count(self, n):
+        return read_io16(self.io, DMA0SAD + 12 * n + 8) & DMA_COUNT_MASKS[n] or DMA_COUNT_MASKS[n] + 1
+
+    def hblank(self, vcount):
+        if vcount < VISIBLE_LINES:
+            self.trigger(DMA_HBLANK)
+        if self.control[3] & 0x8000 and self.control[3] >> 12 & 3 == DMA_SPECIAL:
+            if CAPTURE_FIRST_LINE <= vcount <= CAPTURE_LAST_LINE:
+                self.transfer(3)
+            elif vcount == CAPTURE_LAST_LINE + 1:
+                self.stop(3)
+
+    def fifo_request(self, address):
+        # for a sound FIFO running low: refills it with four words from the channel pointed at it
+        for n in (1, 2):
+            control = self.control[n]
+            if control & 0x8000 and control >> 12 & 3 == DMA_SPECIAL and self.dest[n] == address:
+                self.count[n] = 4
+                self.transfer(n, control=control & ~0x60 | 0x440)  # 32 bit, fixed destination
+
+    def vblank(self):
+        self.trigger(DMA_VBLANK)
+
+    def trigger(self, timing):
+        for n in range(4):
+            if self.control[n] & 0x8000 and self.control[n] >> 12 & 3 == timing:
+                self.transfer(n)
+
+    def transfer(self, n, time=None, control=None):
+        if control is None:
+            control = self.control[n]
+        if not control & 0x8000:  # disabled before it started
+            return
+        memory = self.cpu.memory
+        unit = 4 if control & 0x400 else 2
+        count = self.count[n]
+        src = self.source[n] & Not32(unit - 1)
+        dst = self.dest[n] & Not32(unit - 1)
+        src_step = DMA_STEPS[control >> 7 & 3] * unit
+        dst_step = DMA_STEPS[control >> 5 & 3] * unit
+        if src_step == unit and dst_step == unit:
+            memory.copy(dst, src, count, unit)
+        else:
+            read, write = (memory.read16, memory.write16) if unit == 2 else (memory.read32, memory.write32)
+            for i in range(count):
+                write(dst + i * dst_step, read(src + i * src_step))
+        self.source[n] = src + count * src_step
+        self.dest[n] = dst + count * dst_step
+        if unit == 2:
+            cycles_n, cycles_s = memory.cycles_n16, memory.cycles_s16
+        else:
+            cycles_n, cycles_s = memory.cycles_n32, memory.cycles_s32
+        src_region = src >> 24 & 0xff
+        dst_region = dst >> 24 & 0xff
+        self.cpu.cycles += 2 + cycles_n[src_region] + cycles_n[dst_region] + \
+            (count - 1) * (cycles_s[src_region] + cycles_s[dst_region])
+        self.transfers += 1
+        if control & 0x4000:
+            self.interrupts.request(IRQ_DMA0 << n)
+        if control & 0x200 and control >> 12 & 3 != DMA_IMMEDIATE:
+            self.count[n] = self.word_count(n)
+            if control >> 5 & 3 == 3:
+                self.dest[n] = get_bytes(self.io.data, DMA0SAD + 12 * n + 4, 4) & DMA_DEST_MASKS[n]
+        else:
+            self.stop(n)
+
+    def stop(self, n):
+        self.control[n] &= 0x7fff
+        write_io16(self.io, DMA0SAD + 12 * n + 10, self.control[n])
@@ -2,15 +2,26 @@ import sys
 import getopt
 from os import environ
 from processor import Processor
+from memory import Memory, load_bios, load_rom
+from devices import Interrupts, Video, Timers, Dma
+from bios import HleBios
+from renderer import Renderer, np, SCALERS, available_scalers, scale2x_passes, repeat_scale
 from helper import *
 
 environ["PYGAME_HIDE_SUPPORT_PROMPT"] = 'TRUE'
 import pygame
 from pygame.locals import *
 
+CYCLES_PER_FRAME = 280896  # 228 lines of 1232 cycles
+TRACE_SIZE = 1 << 20
+TRACE_FILE = "trace.bin"  # render with: python tracer.py trace.bin
+USAGE = "gba.py [-b <bios>] [-H] [-s <scale>] [-f nearest|repeat|scale2x] -r <rom>"
+
 # Graphics
 class Graphics:
-    def __init__(self, w, h, vram, sx, sy):
+    # Frames are drawn at the native resolution into screen and scaled onto
+    # the window once, so drawing costs the same at every scale factor.
+    def __init__(self, w, h, vram, sx, sy, memory=None, scaler="nearest"):
         self.width = w
         self.height = h
         self.vram = vram
@@ -18,6 +29,44 @@ class Graphics:
         self.display = pygame.display.set_mode((self.width * sx, self.height * sy))
         self.color_map = [i * 255 // 31 for i in range(32)]
         self.word_size = self.vram.word_size
+        # whole frames go through NumPy when it is installed
+        self.renderer = Renderer(memory) if np is not None and memory is not None else None
+        self.screen = pygame.Surface((w, h), 0, self.display)
+        assert scaler in available_scalers()
+        self.scaler = scaler
+
+    def attach(self, video):
+        # per scanline registers for HBlank effects
+        if self.renderer is not None:
+            self.renderer.attach(video)
+
+    def render(self):
+        if self.renderer is None:
+            if not self.mode3_render():
+                return False
+            rgb = None
+        else:
+            frames = self.renderer.frames
+            rgb = self.renderer.rgb()
+            if self.renderer.frames == frames:
+                return False
+            pygame.surfarray.blit_array(self.screen, rgb.swapaxes(0, 1))
+        self.present(rgb)
+        return True
+
+    def present(self, rgb=None):
+        sx, sy = self.scale
+        size = self.display.get_size()
+        if self.scaler == "repeat" and rgb is not None:
+            pygame.surfarray.blit_array(self.display, repeat_scale(rgb, sx, sy).swapaxes(0, 1))
+        elif self.scaler == "scale2x":
+            # doubles while it fits, the rest of the way is nearest neighbour
+            surface = self.screen
+            for i in range(scale2x_passes(self.width, self.height, size[0], size[1])):
+                surface = pygame.transform.scale2x(surface)
+            pygame.transform.scale(surface, size, self.display)
+        else:  # also repeat without a renderer, the mode 3 fallback has no frame array
+            pygame.transform.scale(self.screen, size, self.display)
 
     def rgb15(self, r, g, b):
         return r | (g << 5) | (b << 10)
@@ -26,13 +75,23 @@ class Graphics:
         return self.color_map[v & 31], self.color_map[(v >> 5) & 31], self.color_map[(v >> 10) & 31]
 
     def mode3_render(self):
-        for i in range(self.width):
-            for j in range(self.height):
+        # only scanlines with writes since the last frame are redrawn
+        if not self.vram.is_dirty():
+            return False
+        line = self.width * self.word_size
+        for j in range(self.height):
+            if not self.vram.is_dirty(j * line, (j + 1) * line):
+                continue
+            for i in range(self.width):
                 color = self.get_rgb15(get_bytes(self.vram.data, (i + j * self.width) * self.word_size, 2))
-                pygame.draw.rect(self.display, color, (i * self.scale[0], j * self.scale[1], self.scale[0], self.scale[1]))
+                self.screen.set_at((i, j), color)
+        self.vram.clean()
+        return True
 
     def mode3_write(self, x, y, v):
-        set_bytes(self.vram.data, (x + y * self.width) * self.word_size, 2, v)
+        offset = (x + y * self.width) * self.word_size
+        set_bytes(self.vram.data, offset, 2, v)
+        self.vram.mark_dirty(offset, 2)
 
 
 # IO
@@ -75,122 +134,86 @@ class InputOutput:
         return self.io_ram.data[1] & (0b111 << 5)
 
 
-# Memory
-class MemoryBank:
-    def __init__(self, start, end, port_size, zero=False):
-        self.start = start
-        self.end = end
-        self.port_size = port_size
-        self.word_size = port_size // 8
-        self.data = []
-        if(zero):
-            for i in range(start, end):
-                self.data.append(0)
-
-    def initialize(self, data):
-        self.data = data
-
-    def inside(self, x):
-        return x <= self.end and x >= self.start
-
-    def get(self, x):
-        if(self.inside(x)):
-            return self.data[x]
-        else:
-            raise Exception("Memory out of bounds: %s" % x)
-
-    def set(self, x, v):
-        if(self.inside(x)):
-            self.data[x] = v
-        else:
-            raise Exception("Memory out of bounds: %s" % x)
-
-
-class Memory:
-    def __init__(self):
-        self.SYS_ROM = MemoryBank(0x00000000, 0x00003fff, 32)
-        self.EWRAM = MemoryBank(0x02000000, 0x0203ffff, 16, zero=True)
-        self.IWRAM = MemoryBank(0x03000000, 0x03007fff, 32, zero=True)
-        self.IO_RAM = MemoryBank(0x04000000, 0x040003ff, 16, zero=True)
-        self.PAL_RAM = MemoryBank(0x05000000, 0x050003ff, 16, zero=True)
-        self.VRAM = MemoryBank(0x06000000, 0x06017fff, 16, zero=True)
-        self.OAM = MemoryBank(0x07000000, 0x070003ff, 32)
-        self.PAK_ROM = MemoryBank(0x08000000, 0x09ffffff, 16)
-        self.CART_RAM = MemoryBank(0x0e000000, 0x0e00ffff, 8)  # 64kb
-        self.total = [self.SYS_ROM, self.EWRAM, self.IWRAM, self.IO_RAM, self.PAL_RAM, self.VRAM, self.OAM, self.PAK_ROM, self.CART_RAM]
-
-    def lookup(self, addr, length):
-        for i in self.total:
-            if i.inside(addr):
-                return get_bytes(i.data, addr - i.start, length)
-        raise Exception("Memory out of bounds: %s" % addr)
-
-    def write_word(self, addr, value):
-        return self.write_bytes(addr, value, 4)
-
-    def write_byte(self, addr, value):
-        return self.write_bytes(addr, value, 1)
-
-    def write_bytes(self, addr, value, count):
-        for i in self.total:
-            if i.inside(addr):
-                return set_bytes(i.data, addr - i.start, count, value)
-        raise Exception("Memory out of bounds: %s" % addr)
-
-def load_bios(mem, name):
-    file = open(name, "rb")
-    data = file.read()
-    mem.SYS_ROM.initialize(data)
-
-
-def load_rom(mem, name):
-    file = open(name, "rb")
-    data = file.read()
-    mem.PAK_ROM.initialize(data)
-
-
 def main(argv):
     bios = ""
     rom = ""
     debug = False
+    hle = False
+    scale = 5
+    scaler = "nearest"
     try:
-        opts, args = getopt.getopt(argv, "hvb:r:", ["bios=", "rom="])
+        opts, args = getopt.getopt(argv, "hvHb:r:s:f:", ["bios=", "rom=", "hle", "scale=", "filter="])
     except getopt.GetoptError:
-        print("gba.py -b <bios> -r <rom>")
+        print(USAGE)
         sys.exit()
     for opt, arg in opts:
         if opt == "-h":
-            print("gba.py -b <bios> -r <rom>")
+            print(USAGE)
             sys.exit()
+        elif opt in ("-s", "--scale"):
+            scale = int(arg) if arg.isdigit() else 0
+            if scale < 1:
+                print(USAGE)
+                sys.exit()
+        elif opt in ("-f", "--filter"):
+            if arg not in SCALERS:
+                print(USAGE)
+                sys.exit()
+            if arg not in available_scalers():
+                print("The %s filter needs NumPy" % arg)
+                sys.exit()
+            scaler = arg
+        elif opt in ("-H", "--hle"):
+            hle = True
         elif opt in ("-b", "--bios"):
             bios = arg
         elif opt in ("-r", "--rom"):
             rom = arg
         elif opt == "-v":
             debug = True
-    if bios == "":
-        print("No bios provided")
+    if bios == "" and rom == "":
+        print("No bios or rom provided")
         sys.exit()
+    hle = hle or bios == ""  # without an image the BIOS calls run natively
 
     pygame.init()
     mem = Memory()
-    gpu = Graphics(240, 160, mem.VRAM, 5, 5)
+    gpu = Graphics(240, 160, mem.VRAM, scale, scale, mem, scaler)
     fps = pygame.time.Clock()
     pygame.display.set_caption(rom or bios)
-    cpu = Processor(mem, console_debug=debug)
-    load_bios(mem, bios)
+    cpu = Processor(mem, trace_size=TRACE_SIZE if debug else 0)
+    interrupts = Interrupts(cpu)
+    video = Video(cpu, interrupts)
+    Timers(cpu, interrupts)
+    Dma(cpu, interrupts, video)
+    gpu.attach(video)
     if rom:
         load_rom(mem, rom)
+    if hle:
+        bios_calls = HleBios(cpu)
+        if bios:
+            load_bios(mem, bios)
+        else:
+            bios_calls.install()
+            bios_calls.boot()
+    else:
+        load_bios(mem, bios)
 
-    while True:
-        # for event in pygame.event.get():
-        #     if event.type == QUIT:
-        #         pygame.quit()
-        #         sys.exit()
-        # gpu.mode3_render()
-        # pygame.display.update()
-        # fps.tick(60)
-        cpu.step()
+    frame_end = 0
+    try:
+        while True:
+            for event in pygame.event.get():
+                if event.type == QUIT:
+                    pygame.quit()
+                    sys.exit()
+            if gpu.render():
+                pygame.display.update()
+            # fps.tick(60)
+            frame_end += CYCLES_PER_FRAME
+            cpu.run(cycles=frame_end - cpu.cycles)
+    finally:
+        if cpu.tracer is not None:
+            print("Wrote %d trace records to %s" % (cpu.tracer.dump(TRACE_FILE), TRACE_FILE))
 
 if __name__ == "__main__":
     main(sys.argv[1:])
\ No newline at end of file
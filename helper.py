@@ -14,17 +14,11 @@
 
 # Little Endian
 def get_bytes(ram, start, length):
-    value = 0
-    for i in range(length):
-        value <<= 8
-        value += ram[start + length - 1 - i]
-    return value
+    return int.from_bytes(ram[start:start + length], "little")
 
 
 def set_bytes(ram, start, length, value):
-    for i in range(length):
-        ram[start + i] = value & 255
-        value >>= 8
+    ram[start:start + length] = (value & ((1 << 8 * length) - 1)).to_bytes(length, "little")
 
 
 def UInt32(s):
@@ -0,0 +1,437 @@
+import os
+import sys
+import mmap
+import struct
+from helper import *
+
+# typed views use host byte order, which only matches the GBA on little endian hosts
+NATIVE_VIEWS = sys.byteorder == "little"
+TOUCH_PAGE_SHIFT = 12
+DIRTY_PAGE_SHIFT = 8
+CODE_PAGE_SHIFT = 8
+WAITCNT = 0x204
+
+# cycles for a non-sequential and a sequential access to each region, 16 bit
+# then 32 bit; the cartridge rows are filled in from WAITCNT
+BASE_CYCLES = {
+    0x00: (1, 1, 1, 1),
+    0x02: (3, 3, 6, 6),
+    0x03: (1, 1, 1, 1),
+    0x04: (1, 1, 1, 1),
+    0x05: (1, 1, 2, 2),
+    0x06: (1, 1, 2, 2),
+    0x07: (1, 1, 1, 1)
+}
+ROM_N_WAITS = (4, 3, 2, 8)
+ROM_S_WAITS = ((2, 1), (4, 1), (8, 1))  # wait state 0, 1 and 2
+waitstate_cache = {}
+WORD_STRUCTS = [struct.Struct("<%dI" % n) for n in range(17)]  # LDM/STM move up to 16 words
+
+
+class MemoryBank:
+    def __init__(self, start, end, port_size, zero=False, mirror=None):
+        self.start = start
+        self.end = end
+        self.port_size = port_size
+        self.word_size = port_size // 8
+        # addresses inside the 16MB region are masked with mirror before indexing
+        self.mirror = mirror if mirror is not None else end - start
+        self.fold = 0
+        self.touched = None  # page bitmap of reads, only kept for the cartridge
+        self.dirty = None  # page bitmap of writes, only kept for video memory
+        self.code_cache = {}  # page -> decoded instructions, dropped when the page is written
+        self.write_handlers = None  # offset -> callback(offset, old value), only kept for IO
+        self.read_handlers = None  # offset -> callback(offset) refreshing the stored value, only kept for IO
+        if(zero):
+            self.initialize(bytearray(end - start + 1))
+        else:
+            self.initialize(b"")
+
+    def initialize(self, data):
+        # data is wrapped, not copied, so ROM images stay shared with the loader
+        self.data = data
+        self.size = len(data)
+        self.halfwords = None
+        self.words = None
+        if NATIVE_VIEWS and self.size % 4 == 0:
+            view = memoryview(data)
+            self.halfwords = view.cast("H")
+            self.words = view.cast("I")
+
+    def track_touched(self):
+        self.touched = bytearray((self.size >> TOUCH_PAGE_SHIFT) + 1)
+
+    def mark_touched(self, offset, length=1):
+        if self.touched is not None:
+            for i in range(offset >> TOUCH_PAGE_SHIFT, ((offset + length - 1) >> TOUCH_PAGE_SHIFT) + 1):
+                self.touched[i] = 1
+
+    def touched_bytes(self):
+        if self.touched is None:
+            return 0
+        return min(self.touched.count(1) << TOUCH_PAGE_SHIFT, self.size)
+
+    def track_dirty(self):
+        self.dirty = bytearray(((self.size - 1) >> DIRTY_PAGE_SHIFT) + 1)
+
+    def mark_dirty(self, offset, length=1):
+        if self.dirty is not None:
+            for i in range(offset >> DIRTY_PAGE_SHIFT, ((offset + length - 1) >> DIRTY_PAGE_SHIFT) + 1):
+                self.dirty[i] = 1
+
+    def is_dirty(self, start=0, end=None):
+        if self.dirty is None:
+            return True
+        if end is None:
+            return 1 in self.dirty
+        return 1 in self.dirty[start >> DIRTY_PAGE_SHIFT:((end - 1) >> DIRTY_PAGE_SHIFT) + 1]
+
+    def clean(self):
+        if self.dirty is not None:
+            self.dirty[:] = bytes(len(self.dirty))
+
+    def invalidate_code(self, offset, length=1):
+        for i in range(offset >> CODE_PAGE_SHIFT, ((offset + length - 1) >> CODE_PAGE_SHIFT) + 1):
+            self.code_cache.pop(i, None)
+
+    def inside(self, x):
+        return x <= self.end and x >= self.start
+
+    def get(self, x):
+        if(self.inside(x)):
+            return self.data[x]
+        else:
+            raise Exception("Memory out of bounds: %s" % x)
+
+    def set(self, x, v):
+        if(self.inside(x)):
+            self.data[x] = v
+        else:
+            raise Exception("Memory out of bounds: %s" % x)
+
+
+class Memory:
+    def __init__(self):
+        self.SYS_ROM = MemoryBank(0x00000000, 0x00003fff, 32, mirror=0x00ffffff)
+        self.EWRAM = MemoryBank(0x02000000, 0x0203ffff, 16, zero=True)
+        self.IWRAM = MemoryBank(0x03000000, 0x03007fff, 32, zero=True)
+        self.IO_RAM = MemoryBank(0x04000000, 0x040003ff, 16, zero=True, mirror=0x00ffffff)
+        self.PAL_RAM = MemoryBank(0x05000000, 0x050003ff, 16, zero=True)
+        self.VRAM = MemoryBank(0x06000000, 0x06017fff, 16, zero=True, mirror=0x0001ffff)
+        self.VRAM.fold = 0x8000  # upper 32kb of each 128kb mirror repeats the OBJ tiles
+        self.OAM = MemoryBank(0x07000000, 0x070003ff, 32, zero=True)
+        self.PAK_ROM = MemoryBank(0x08000000, 0x09ffffff, 16)
+        self.CART_RAM = MemoryBank(0x0e000000, 0x0e00ffff, 8)  # 64kb
+        self.PAL_RAM.track_dirty()
+        self.VRAM.track_dirty()
+        self.OAM.track_dirty()
+        self.IO_RAM.write_handlers = {WAITCNT: self.write_waitcnt}
+        self.IO_RAM.read_handlers = {}
+        self.total = [self.SYS_ROM, self.EWRAM, self.IWRAM, self.IO_RAM, self.PAL_RAM, self.VRAM, self.OAM, self.PAK_ROM, self.CART_RAM]
+        self.open_bus = 0  # last value seen on the bus, returned for unmapped reads
+        # one entry per 16MB region (addr >> 24), None where nothing is mapped
+        self.regions = [None] * 256
+        self.regions[0x00] = self.SYS_ROM
+        self.regions[0x02] = self.EWRAM
+        self.regions[0x03] = self.IWRAM
+        self.regions[0x04] = self.IO_RAM
+        self.regions[0x05] = self.PAL_RAM
+        self.regions[0x06] = self.VRAM
+        self.regions[0x07] = self.OAM
+        for i in range(0x08, 0x0e):  # wait state 0, 1 and 2 mirrors
+            self.regions[i] = self.PAK_ROM
+        self.regions[0x0e] = self.CART_RAM
+        self.regions[0x0f] = self.CART_RAM
+        # ROM regions cannot be written, so they are left out of the write table
+        self.write_regions = list(self.regions)
+        for i in range(0x08, 0x0e):
+            self.write_regions[i] = None
+        self.write_regions[0x00] = None
+        # access cycles by region, updated in place so holders of a table see WAITCNT changes
+        self.cycles_n16 = [1] * 256
+        self.cycles_s16 = [1] * 256
+        self.cycles_n32 = [1] * 256
+        self.cycles_s32 = [1] * 256
+        for region in BASE_CYCLES:
+            self.set_region_cycles(region, BASE_CYCLES[region])
+        self.update_waitstates()
+
+    def set_region_cycles(self, region, cycles):
+        self.cycles_n16[region], self.cycles_s16[region], self.cycles_n32[region], self.cycles_s32[region] = cycles
+
+    def update_waitstates(self):
+        value = self.IO_RAM.data[WAITCNT] | self.IO_RAM.data[WAITCNT + 1] << 8
+        rows = waitstate_cache.get(value)
+        if rows is None:
+            sram = 1 + ROM_N_WAITS[value & 3]
+            rows = {0x0e: (sram, sram, sram, sram), 0x0f: (sram, sram, sram, sram)}
+            for ws in range(3):
+                n = 1 + ROM_N_WAITS[value >> 2 + 3 * ws & 3]
+                s = 1 + ROM_S_WAITS[ws][value >> 4 + 3 * ws & 1]
+                rows[0x08 + 2 * ws] = rows[0x09 + 2 * ws] = (n, s, n + s, 2 * s)  # 32 bit is two accesses
+            waitstate_cache[value] = rows
+        for region in rows:
+            self.set_region_cycles(region, rows[region])
+
+    def write_waitcnt(self, offset, old):
+        self.update_waitstates()
+
+    def write_io(self, bank, offset, value, count):
+        # stores the value and calls the handler of every halfword it touched
+        handlers = bank.write_handlers
+        old = {}
+        for i in range(offset & 0xfffffffe, offset + count, 2):
+            if i in handlers:
+                old[i] = bank.data[i] | bank.data[i + 1] << 8
+        set_bytes(bank.data, offset, count, value)
+        for i in old:
+            handlers[i](i, old[i])
+
+    def read_io(self, bank, offset, count):
+        # lets registers that change on their own, like timer counters, update before a read
+        handlers = bank.read_handlers
+        for i in range(offset & 0xfffffffe, offset + count, 2):
+            if i in handlers:
+                handlers[i](i)
+
+    # bulk transfers slice between the buffers when no handler has to see the
+    # access, and fall back to the width specific accessors otherwise
+    def copy(self, dst, src, count, unit):
+        # copies count units upwards
+        self.write_block(dst, self.read_block(src, count * unit, unit), unit)
+
+    def fill(self, dst, value, count, unit):
+        self.write_block(dst, (value & (1 << 8 * unit) - 1).to_bytes(unit, "little") * count, unit)
+
+    def read_block(self, addr, length, unit=1):
+        bank, offset = self.resolve(self.regions, addr, length)
+        if bank is not None and bank.read_handlers is None and not addr & unit - 1:
+            bank.mark_touched(offset, length)
+            return bytes(bank.data[offset:offset + length])
+        read = (None, self.read8, self.read16, None, self.read32)[unit]
+        return b"".join(read(addr + i).to_bytes(unit, "little") for i in range(0, length, unit))
+
+    def write_block(self, addr, data, unit=1):
+        length = len(data)
+        bank, offset = self.resolve(self.write_regions, addr, length)
+        if bank is not None and bank.write_handlers is None and not addr & unit - 1:
+            bank.mark_dirty(offset, length)
+            if bank.code_cache:
+                bank.invalidate_code(offset, length)
+            bank.data[offset:offset + length] = data
+            return
+        write = (None, self.write8, self.write16, None, self.write32)[unit]
+        for i in range(0, length, unit):
+            write(addr + i, get_bytes(data, i, unit))
+
+    def read_words(self, addr, count):
+        # the words a block load reads from a word aligned address
+        bank, offset = self.resolve(self.regions, addr, 4 * count)
+        if bank is not None and bank.read_handlers is None:
+            if bank.touched is not None:
+                bank.mark_touched(offset, 4 * count)
+            return WORD_STRUCTS[count].unpack_from(bank.data, offset)
+        return [self.read32(addr + 4 * i) for i in range(count)]
+
+    def write_words(self, addr, values):
+        count = len(values)
+        bank, offset = self.resolve(self.write_regions, addr, 4 * count)
+        if bank is not None and bank.write_handlers is None:
+            if bank.dirty is not None:
+                bank.mark_dirty(offset, 4 * count)
+            if bank.code_cache:
+                bank.invalidate_code(offset, 4 * count)
+            WORD_STRUCTS[count].pack_into(bank.data, offset, *values)
+            return
+        for i in range(count):
+            self.write32(addr + 4 * i, values[i])
+
+    def resolve(self, table, addr, length):
+        bank = table[addr >> 24 & 0xff]
+        if bank is None:
+            return None, 0
+        offset = addr & bank.mirror
+        if offset >= bank.size:
+            offset -= bank.fold
+        if offset + length > bank.size:
+            return None, 0
+        return bank, offset
+
+    def lookup(self, addr, length):
+        bank, offset = self.resolve(self.regions, addr, length)
+        if bank is None:
+            return self.open_bus & ((1 << 8 * length) - 1)
+        if bank.touched is not None:
+            bank.touched[offset >> TOUCH_PAGE_SHIFT] = 1
+        if bank.read_handlers is not None:
+            self.read_io(bank, offset, length)
+        if length == 4:
+            if not offset & 3 and bank.words is not None:
+                return bank.words[offset >> 2]
+        elif length == 2:
+            if not offset & 1 and bank.halfwords is not None:
+                return bank.halfwords[offset >> 1]
+        elif length == 1:
+            return bank.data[offset]
+        return get_bytes(bank.data, offset, length)
+
+    def write_word(self, addr, value):
+        return self.write_bytes(addr, value, 4)
+
+    def write_byte(self, addr, value):
+        return self.write_bytes(addr, value, 1)
+
+    def write_bytes(self, addr, value, count):
+        bank, offset = self.resolve(self.write_regions, addr, count)
+        if bank is None:
+            return
+        if bank.write_handlers is not None:
+            return self.write_io(bank, offset, value, count)
+        if bank.dirty is not None:
+            bank.mark_dirty(offset, count)
+        if bank.code_cache:
+            bank.invalidate_code(offset, count)
+        if count == 4:
+            if not offset & 3 and bank.words is not None:
+                bank.words[offset >> 2] = value & 0xffffffff
+                return
+        elif count == 2:
+            if not offset & 1 and bank.halfwords is not None:
+                bank.halfwords[offset >> 1] = value & 0xffff
+                return
+        elif count == 1:
+            bank.data[offset] = value & 0xff
+            return
+        set_bytes(bank.data, offset, count, value)
+
+    # width specific accessors used by the processor, misaligned loads rotate
+    # the aligned value like the ARM7TDMI and stores drop the low address bits
+    def read8(self, addr):
+        bank = self.regions[addr >> 24 & 0xff]
+        if bank is not None:
+            offset = addr & bank.mirror
+            if offset >= bank.size:
+                offset -= bank.fold
+            if offset < bank.size:
+                if bank.touched is not None:
+                    bank.touched[offset >> TOUCH_PAGE_SHIFT] = 1
+                if bank.read_handlers is not None:
+                    self.read_io(bank, offset, 1)
+                return bank.data[offset]
+        return self.open_bus & 0xff
+
+    def read16(self, addr):
+        bank = self.regions[addr >> 24 & 0xff]
+        if bank is not None:
+            offset = addr & bank.mirror & 0xfffffffe
+            if offset >= bank.size:
+                offset -= bank.fold
+            if offset + 2 <= bank.size:
+                if bank.touched is not None:
+                    bank.touched[offset >> TOUCH_PAGE_SHIFT] = 1
+                if bank.read_handlers is not None:
+                    self.read_io(bank, offset, 2)
+                if bank.halfwords is not None:
+                    value = bank.halfwords[offset >> 1]
+                else:
+                    value = get_bytes(bank.data, offset, 2)
+                if addr & 1:
+                    return value >> 8 | (value & 0xff) << 24
+                return value
+        return self.open_bus & 0xffff
+
+    def read32(self, addr):
+        bank = self.regions[addr >> 24 & 0xff]
+        if bank is not None:
+            offset = addr & bank.mirror & 0xfffffffc
+            if offset >= bank.size:
+                offset -= bank.fold
+            if offset + 4 <= bank.size:
+                if bank.touched is not None:
+                    bank.touched[offset >> TOUCH_PAGE_SHIFT] = 1
+                if bank.read_handlers is not None:
+                    self.read_io(bank, offset, 4)
+                if bank.words is not None:
+                    value = bank.words[offset >> 2]
+                else:
+                    value = get_bytes(bank.data, offset, 4)
+                rotate = (addr & 3) << 3
+                if rotate:
+                    return (value >> rotate | value << 32 - rotate) & 0xffffffff
+                return value
+        return self.open_bus
+
+    def write8(self, addr, value):
+        bank = self.write_regions[addr >> 24 & 0xff]
+        if bank is not None:
+            offset = addr & bank.mirror
+            if offset >= bank.size:
+                offset -= bank.fold
+            if offset < bank.size:
+                if bank.write_handlers is not None:
+                    return self.write_io(bank, offset, value, 1)
+                if bank.dirty is not None:
+                    bank.dirty[offset >> DIRTY_PAGE_SHIFT] = 1
+                if bank.code_cache and offset >> CODE_PAGE_SHIFT in bank.code_cache:
+                    del bank.code_cache[offset >> CODE_PAGE_SHIFT]
+                bank.data[offset] = value & 0xff
+
+    def write16(self, addr, value):
+        bank = self.write_regions[addr >> 24 & 0xff]
+        if bank is not None:
+            offset = addr & bank.mirror & 0xfffffffe
+            if offset >= bank.size:
+                offset -= bank.fold
+            if offset + 2 <= bank.size:
+                if bank.write_handlers is not None:
+                    return self.write_io(bank, offset, value, 2)
+                if bank.dirty is not None:
+                    bank.dirty[offset >> DIRTY_PAGE_SHIFT] = 1
+                if bank.code_cache and offset >> CODE_PAGE_SHIFT in bank.code_cache:
+                    del bank.code_cache[offset >> CODE_PAGE_SHIFT]
+                if bank.halfwords is not None:
+                    bank.halfwords[offset >> 1] = value & 0xffff
+                else:
+                    set_bytes(bank.data, offset, 2, value)
+
+    def write32(self, addr, value):
+        bank = self.write_regions[addr >> 24 & 0xff]
+        if bank is not None:
+            offset = addr & bank.mirror & 0xfffffffc
+            if offset >= bank.size:
+                offset -= bank.fold
+            if offset + 4 <= bank.size:
+                if bank.write_handlers is not None:
+                    return self.write_io(bank, offset, value, 4)
+                if bank.dirty is not None:
+                    bank.dirty[offset >> DIRTY_PAGE_SHIFT] = 1
+                if bank.code_cache and offset >> CODE_PAGE_SHIFT in bank.code_cache:
+                    del bank.code_cache[offset >> CODE_PAGE_SHIFT]
+                if bank.words is not None:
+                    bank.words[offset >> 2] = value & 0xffffffff
+                else:
+                    set_bytes(bank.data, offset, 4, value)
+
+
+def map_file(name, limit):
+    # read-only mapping: pages are faulted in on first access and shared
+    # between every process that maps the same image
+    with open(name, "rb") as file:
+        size = min(os.fstat(file.fileno()).st_size, limit)
+        if size == 0:
+            return b""
+        data = mmap.mmap(file.fileno(), size, access=mmap.ACCESS_READ)
+    if hasattr(data, "madvise") and hasattr(mmap, "MADV_RANDOM"):
+        data.madvise(mmap.MADV_RANDOM)  # no read-ahead of untouched pages
+    return data
+
+
+def load_bios(mem, name):
+    bank = mem.SYS_ROM
+    bank.initialize(map_file(name, bank.end - bank.start + 1))
+
+
+def load_rom(mem, name):
+    bank = mem.PAK_ROM
+    bank.initialize(map_file(name, bank.end - bank.start + 1))
+    bank.track_touched()
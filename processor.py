@@ -1,122 +1,72 @@
+from types import MethodType
 from helper import *
+from memory import CODE_PAGE_SHIFT
+from translator import BlockTranslator
+from tracer import Tracer
+from scheduler import Scheduler, NEVER
 
-class RegisterBank:
-    def __init__(self, processor):
-        self.processor = processor
-        self.MODE_usr = 0b10000
-        self.MODE_fiq = 0b10001
-        self.MODE_irq = 0b10010
-        self.MODE_svc = 0b10011
-        self.MODE_mon = 0b10110
-        self.MODE_abt = 0b10111
-        self.MODE_hyp = 0b11010
-        self.MODE_und = 0b11011
-        self.MODE_sys = 0b11111
-        self.reg = [
-            0, 0, 0, 0, 0, 0, 0, 0,
-            0, 0, 0, 0, 0, 0, 0, 0
-        ]
-        self.SPs = {
-            0b10001: 0,
-            0b10010: 0,
-            0b10011: 0,
-            0b10110: 0,
-            0b10111: 0,
-            0b11010: 0,
-            0b11011: 0
-        }
-        self.LRs = {  # no hyp LR
-            0b10001: 0,
-            0b10010: 0,
-            0b10011: 0,
-            0b10110: 0,
-            0b10111: 0,
-            0b11011: 0
-        }
-        self.ELR_hyp = 0
-        self.reg_FIQ = {
-            8: 0, 9: 0, 10: 0, 11: 0, 12: 0
-        }
-        self.PC = 0
-        self.LR = 0
-        self.SP = 0
+def condition_passed(cond, nzcv):
+    n = nzcv & 8 != 0
+    z = nzcv & 4 != 0
+    c = nzcv & 2 != 0
+    v = nzcv & 1 != 0
+    return [
+        z, not z, c, not c, n, not n, v, not v,
+        c and not z, not c or z, n == v, n != v,
+        not z and n == v, z or n != v, True, False
+    ][cond]
 
-    def __getitem__(self, key):
-        return self.read_register_with_mode(self.processor.get_current_mode(), key)
 
-    def __setitem__(self, key, val):
-        self.write_register_with_mode(self.processor.get_current_mode(), key, val)
+# indexed by condition code then the NZCV nibble
+COND_TABLE = tuple(tuple(condition_passed(cond, nzcv) for nzcv in range(16)) for cond in range(16))
 
-    def write_register_with_mode(self, mode, r, val):
-        if r == 15:
-            self.PC = val
-        elif r >= 0 and r < 8:
-            self.reg[r] = val
-        elif r >= 8 and r < 13:
-            if mode == self.MODE_fiq:
-                self.reg_FIQ[r] = val
-            else:
-                self.reg[r] = val
-        elif r == 13:
-            if mode == self.MODE_sys or mode == self.MODE_usr or mode == 0:
-                self.SP = val
-            else:
-                self.SPs[mode] = val
-        elif r == 14:
-            if mode == self.MODE_sys or mode == self.MODE_usr or mode == self.MODE_hyp or mode == 0:
-                self.LR = val
-            else:
-                self.LRs[mode] = val
-
-    def read_register_with_mode(self, mode, r):
-        if r == 15:
-            return self.PC
-        elif r >= 0 and r < 8:
-            return self.reg[r]
-        elif r >= 8 and r < 13:
-            if mode == self.MODE_fiq:
-                return self.reg_FIQ[r]
-            else:
-                return self.reg[r]
-        elif r == 13:
-            if mode == self.MODE_sys or mode == self.MODE_usr or mode == 0:
-                return self.SP
-            else:
-                return self.SPs[mode]
-        elif r == 14:
-            if mode == self.MODE_sys or mode == self.MODE_usr or mode == self.MODE_hyp or mode == 0:
-                return self.LR
-            else:
-                return self.LRs[mode]
 
-    @property
-    def PC(self):
-        return self.reg[15]
+def rotate_immediate(rest):
+    # operand2 immediate: the low byte rotated right by twice the top nibble,
+    # with the shifter carry out, None when the rotation leaves C alone
+    value = rest & 255
+    rotate = rest >> 8 << 1
+    if rotate == 0:
+        return value, None
+    value = (value >> rotate | value << 32 - rotate) & 0xffffffff
+    return value, value >> 31
 
-    @PC.setter
-    def PC(self, v):
-        self.reg[15] = UInt32(v) & (0xfffffffc if not self.processor.T else 0xfffffffe)
 
-    @property
-    def LR(self):
-        return self.reg[14]
+ROTATED_IMMEDIATES = tuple(rotate_immediate(rest) for rest in range(4096))
 
-    @LR.setter
-    def LR(self, v):
-        self.reg[14] = v
+FLAGS_CLEAN = 0  # NZCV live in status
+FLAGS_LOGIC = 1  # N and Z pending from flag_result
+FLAGS_ADD = 2  # NZCV pending from flag_x + flag_y + flag_carry = flag_result
 
-    @property
-    def SP(self):
-        return self.reg[13]
+class Instruction:
+    # one decoded instruction, fields not used by its handler are left at 0
+    __slots__ = ("cmd", "bin", "cond", "rd", "rn", "rm", "rest", "im", "s", "priv", "U", "I", "W", "R",
+                 "reg_list", "link", "addr", "field_mask", "immediate", "always",
+                 "operand", "rs", "amount", "carry", "registers")
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, 0)
+        for name in fields:
+            setattr(self, name, fields[name])
+
+def register_list(reg_list):
+    # indices of the registers a block transfer moves, lowest first
+    return tuple(i for i in range(16) if reg_list >> i & 1)
 
-    @SP.setter
-    def SP(self, v):
-        self.reg[13] = v
 
 class Processor:
-    def __init__(self, mem, console_debug=False):
-        if not console_debug:
-            self.print = lambda *args, **kwargs: None
+    def __init__(self, mem, trace_size=0):
+        self.tracer = None
+        self.cycles = 0  # total cycles executed
+        self.irq_pending = False  # set by the interrupt controller, run() enters IRQ mode when CPSR allows
+        self.scheduler = Scheduler()
+        self.bios = None  # HleBios running SWIs natively, None to enter the BIOS image
+        self.branched = False  # set by every handler that writes PC, taken branches refill the pipeline
+        self.halted = False  # set by HALTCNT until IE & IF, run() skips straight to the next event
+        self.halt_skipped = 0  # cycles fast-forwarded while halted
+        self.idle_skipped = 0  # cycles fast-forwarded out of idle loops
+        self.breakpoints = set()
         self.fetch = 0
         self.decode = 0
         self.state = "ARM"  # or THUMB
@@ -124,80 +74,12 @@ class Processor:
         self.word_size = 4
         self.write_flags = False
         self.memory = mem
+        self.decode_hits = 0
+        self.decode_misses = 0
+        self.translator = BlockTranslator(self)
+        self.use_blocks = True  # False runs step_block through the interpreter
         self.ops = [
 
-        ]
-        self.cond = [
-            lambda: self.Z,
-            lambda: not self.Z,
-            lambda: self.C,
-            lambda: not self.C,
-            lambda: self.N,
-            lambda: not self.N,
-            lambda: self.V,
-            lambda: not self.V,
-            lambda: self.C and not self.Z,
-            lambda: not self.C and self.Z,
-            lambda: self.N == self.V,
-            lambda: self.N != self.V,
-            lambda: not self.Z and self.N == self.V,
-            lambda: self.Z and self.N != self.V,
-            lambda: True,
-            lambda: False
-        ]
-        self.ops0s = [
-            self.AND,
-            self.EOR,
-            self.SUB,
-            self.RSB,
-            self.ADD,
-            self.ADC,
-            self.SBC,
-            self.RSC,
-            self.TST,
-            self.TEQ,
-            self.CMP,
-            self.CMN,
-            self.ORR,
-            self.MOV,
-            self.BIC,
-            self.MVN
-        ]
-        self.ops0 = [
-            self.AND,
-            self.EOR,
-            self.SUB,
-            self.RSB,
-            self.ADD,
-            self.ADC,
-            self.SBC,
-            self.RSC,
-            self.MRS,
-            self.MSR,
-            self.MRS,
-            self.MSR,
-            self.ORR,
-            self.MOV,
-            self.BIC,
-            self.MVN
-        ]
-        self.t_ops = [
-            self.AND,
-            self.EOR,
-            self.T_LSL,
-            self.T_LSR,
-            self.T_ASR,
-            self.ADC,
-            self.SBC,
-            self.ROR,
-            self.TST,
-            self.T_NEG,
-            self.CMP,
-            self.CMN,
-            self.ORR,
-            self.T_MUL,
-            self.BIC,
-            self.MVN
         ]
         self.shift_codes = [
             self.LSL,
@@ -214,6 +96,39 @@ class Processor:
         self.MODE_hyp = 0b11010
         self.MODE_und = 0b11011
         self.MODE_sys = 0b11111
+        # reg always holds the registers of the current mode, banked copies are
+        # swapped in and out when the mode bits of the status register change
+        self.reg = [
+            0, 0, 0, 0, 0, 0, 0, 0,
+            0, 0, 0, 0, 0, 0, 0, 0
+        ]
+        self.SPs = {
+            0b10000: 0,  # shared by usr, sys and the reset mode 0
+            0b10001: 0,
+            0b10010: 0,
+            0b10011: 0,
+            0b10110: 0,
+            0b10111: 0,
+            0b11010: 0,
+            0b11011: 0
+        }
+        self.LRs = {  # no hyp LR
+            0b10000: 0,
+            0b10001: 0,
+            0b10010: 0,
+            0b10011: 0,
+            0b10110: 0,
+            0b10111: 0,
+            0b11011: 0
+        }
+        self.reg_FIQ = [0, 0, 0, 0, 0]  # r8-r12 of fiq mode while another mode runs
+        self.reg_usr = [0, 0, 0, 0, 0]  # r8-r12 of the other modes while fiq runs
+        self._status = 0
+        self.flag_op = FLAGS_CLEAN
+        self.flag_result = 0
+        self.flag_x = 0
+        self.flag_y = 0
+        self.flag_carry = 0
         self.status = 0  # self.MODE_usr
         self.saved_status = {
             0b10001: 0,
@@ -224,7 +139,6 @@ class Processor:
             0b11010: 0,
             0b11011: 0
         }
-        self.reg = RegisterBank(self)
         self.ITSTATE = 0b00000000
         self.SCTLR = Labeled32(
             [("TE", 30, 1), ("AFE", 29, 0), ("TRE", 28, 0), ("NMFI", 27, 1), ("EE", 25, 1), ("VE", 24, 0),
@@ -233,9 +147,8 @@ class Processor:
              ("C", 2, 0), ("A", 1, 0), ("M", 0, 0)]
         )
         self.SCTLR.set_bits([23, 18, 16, 6, 4, 3])
-
-    def print(self, *args, **kwargs):
-        print(*args, **kwargs)
+        if trace_size:
+            self.enable_trace(trace_size)
 
     @property
     def PC(self):
@@ -261,9 +174,95 @@ class Processor:
     def SP(self, v):
         self.reg[13] = v
 
+    # NZCV are evaluated lazily: flag setting ops only record what produced
+    # them and the bits are computed when something reads them
+    @property
+    def status(self):
+        if self.flag_op:
+            self.materialize_flags()
+        return self._status
+
+    @status.setter
+    def status(self, v):
+        if (v ^ self._status) & 0x1f:
+            self.switch_registers(self._status & 0x1f, v & 0x1f)
+        if (v ^ self._status) & 0x20:  # returns from exceptions can switch instruction set
+            self.state = "THUMB" if v & 0x20 else "ARM"
+            self.word_size = 2 if v & 0x20 else 4
+        self.flag_op = FLAGS_CLEAN
+        self._status = v
+
+    def switch_registers(self, old, new):
+        reg = self.reg
+        old_sp = old if old in self.SPs else self.MODE_usr
+        new_sp = new if new in self.SPs else self.MODE_usr
+        if old_sp != new_sp:
+            self.SPs[old_sp] = reg[13]
+            reg[13] = self.SPs[new_sp]
+        old_lr = old if old in self.LRs else self.MODE_usr
+        new_lr = new if new in self.LRs else self.MODE_usr
+        if old_lr != new_lr:
+            self.LRs[old_lr] = reg[14]
+            reg[14] = self.LRs[new_lr]
+        if old == self.MODE_fiq and new != self.MODE_fiq:
+            self.reg_FIQ = reg[8:13]
+            reg[8:13] = self.reg_usr
+        elif new == self.MODE_fiq and old != self.MODE_fiq:
+            self.reg_usr = reg[8:13]
+            reg[8:13] = self.reg_FIQ
+
+    def read_user_register(self, r):
+        # user mode view of a register, for LDM/STM with the S bit set
+        mode = self._status & 0x1f
+        if r == 13 and mode in self.SPs and mode != self.MODE_usr:
+            return self.SPs[self.MODE_usr]
+        if r == 14 and mode in self.LRs and mode != self.MODE_usr:
+            return self.LRs[self.MODE_usr]
+        if 8 <= r < 13 and mode == self.MODE_fiq:
+            return self.reg_usr[r - 8]
+        return self.reg[r]
+
+    def write_user_register(self, r, val):
+        mode = self._status & 0x1f
+        if r == 13 and mode in self.SPs and mode != self.MODE_usr:
+            self.SPs[self.MODE_usr] = val
+        elif r == 14 and mode in self.LRs and mode != self.MODE_usr:
+            self.LRs[self.MODE_usr] = val
+        elif 8 <= r < 13 and mode == self.MODE_fiq:
+            self.reg_usr[r - 8] = val
+        elif r == 15:
+            self.PC = val
+        else:
+            self.reg[r] = val
+
+    def materialize_flags(self):
+        r = self.flag_result
+        if self.flag_op == FLAGS_LOGIC:
+            self._status = (self._status & 0x3fffffff) | (r & 1 << 31) | (r == 0) << 30
+        else:
+            x = self.flag_x
+            y = self.flag_y
+            carry = x + y + self.flag_carry > 0xffffffff
+            overflow = ((x ^ r) & (y ^ r)) >> 31
+            self._status = (self._status & 0x0fffffff) | (r & 1 << 31) | (r == 0) << 30 | carry << 29 | overflow << 28
+        self.flag_op = FLAGS_CLEAN
+
+    def nzcv(self):
+        if self.flag_op:
+            self.materialize_flags()
+        return self._status >> 28
+
+    def set_nz(self, value):
+        if self.flag_op == FLAGS_ADD:  # keep the C and V it produced
+            self.materialize_flags()
+        self.flag_op = FLAGS_LOGIC
+        self.flag_result = value & 0xffffffff
+
     @property
     def N(self):
-        return (self.status & (1 << 31)) != 0
+        if self.flag_op:
+            return (self.flag_result & (1 << 31)) != 0
+        return (self._status & (1 << 31)) != 0
 
     @N.setter
     def N(self, v):
@@ -274,7 +273,9 @@ class Processor:
 
     @property
     def Z(self):
-        return (self.status & (1 << 30)) != 0
+        if self.flag_op:
+            return self.flag_result == 0
+        return (self._status & (1 << 30)) != 0
 
     @Z.setter
     def Z(self, v):
@@ -285,7 +286,9 @@ class Processor:
 
     @property
     def C(self):
-        return (self.status & (1 << 29)) != 0
+        if self.flag_op == FLAGS_ADD:
+            return self.flag_x + self.flag_y + self.flag_carry > 0xffffffff
+        return (self._status & (1 << 29)) != 0
 
     @C.setter
     def C(self, v):
@@ -296,7 +299,10 @@ class Processor:
 
     @property
     def V(self):
-        return (self.status & (1 << 28)) != 0
+        if self.flag_op == FLAGS_ADD:
+            r = self.flag_result
+            return ((self.flag_x ^ r) & (self.flag_y ^ r) & (1 << 31)) != 0
+        return (self._status & (1 << 28)) != 0
 
     @V.setter
     def V(self, v):
@@ -318,7 +324,7 @@ class Processor:
 
     @property
     def T(self):
-        return (self.status & (1 << 5)) != 0
+        return (self._status & (1 << 5)) != 0
 
     @T.setter
     def T(self, v):
@@ -332,7 +338,7 @@ class Processor:
             self.word_size = 4
 
     def get_current_mode(self):
-        return self.get_mode(self.status)
+        return self.get_mode(self._status)
 
     def get_mode(self, s):
         return s & 0b11111
@@ -381,184 +387,424 @@ class Processor:
         self.saved_status[mode] = (self.saved_status[mode] & Not32(copy)) | (value & copy)
 
     def step(self):
+        # returns the cycles of the instruction that reached the execute stage,
+        # or 0 while the pipeline refills
+        executed = 0
         self.write_flags = False
-        if self.decode != 0:
-            if self.cond[self.decode["cond"]]():
-                pc = self.PC
-                self.decode["cmd"](self.decode)
-                if self.PC != pc:
+        decode = self.decode
+        if decode != 0:
+            start = self.cycles
+            pc = self.PC
+            if self.word_size == 4:
+                self.cycles += self.memory.cycles_s32[pc >> 24 & 0xff]
+            else:
+                self.cycles += self.memory.cycles_s16[pc >> 24 & 0xff]
+            if decode.always or COND_TABLE[decode.cond][self.nzcv()]:
+                self.branched = False
+                decode.cmd(decode)
+                if self.branched:
                     self.fetch = 0
-            self.print(self.decode["cmd"].__name__, self.cond[self.decode["cond"]]())
-            self.print(format_hex(self.PC, self.word_size), format_bin(self.decode["bin"], self.word_size))
-            self.print(self.reg.reg)
-            self.print("NZCV Q" + " " * 24 + "IFT4 3210")
-            self.print(format_bin(self.status, 4))
-            self.print()
+                    self.cycles += self.refill_cycles(self.PC)
             self.decode = 0
+            executed = self.cycles - start
         if self.fetch != 0:
-            self.decode = self.decoder(self.fetch)
+            self.decode = self.fetch
             self.fetch = 0
-        self.fetch = self.memory.lookup(self.PC, self.word_size)
+        self.fetch = self.decode_at(self.PC)
+        self.memory.open_bus = self.fetch.bin
         self.PC += self.word_size
+        return executed
+
+    def traced_step(self):
+        # replaces step while tracing, so the untraced path has no checks
+        decode = self.decode
+        addr = self.PC - 2 * self.word_size
+        executed = Processor.step(self)
+        if executed:
+            self.tracer.record(addr, decode.bin, self.reg, self.status)
+        return executed
+
+    def enable_trace(self, capacity=65536):
+        self.tracer = Tracer(capacity)
+        self.step = self.traced_step
+
+    def disable_trace(self):
+        self.tracer = None
+        self.__dict__.pop("step", None)
+
+    def refill_cycles(self, addr):
+        # a taken branch costs a non-sequential and a sequential fetch at the target
+        if self.word_size == 4:
+            return self.memory.cycles_n32[addr >> 24 & 0xff] + self.memory.cycles_s32[addr >> 24 & 0xff]
+        return self.memory.cycles_n16[addr >> 24 & 0xff] + self.memory.cycles_s16[addr >> 24 & 0xff]
+
+    def run(self, budget=None, cycles=None):
+        # Executes at least budget instructions or cycles, whichever runs out
+        # first (blocks may overrun either), and returns how many instructions
+        # ran; self.cycles tells how long they took. Execution only leaves the
+        # hot loop when the next scheduled event is due or an interrupt can be
+        # taken. Stops early when the next instruction is a breakpoint.
+        executed = 0
+        if budget is None:
+            budget = NEVER
+        end = self.cycles + cycles if cycles is not None else NEVER
+        scheduler = self.scheduler
+        while executed < budget and self.cycles < end:
+            if scheduler.next_time <= self.cycles:
+                scheduler.run_due(self.cycles)
+            if self.irq_pending and not self._status & 0x80:
+                self.interrupt()
+            stop = min(end, scheduler.next_time)
+            if self.halted:
+                if stop > self.cycles:
+                    self.halt_skipped += stop - self.cycles
+                    self.cycles = stop
+                continue
+            ran = self.execute(budget - executed, stop)
+            executed += ran
+            if ran and self.breakpoints and self.next_address() in self.breakpoints:
+                break
+        return executed
+
+    def execute(self, budget, stop):
+        # the hot loop of run(), breakpoints and tracing force the interpreter
+        executed = 0
+        if self.use_blocks and not self.breakpoints and self.tracer is None:
+            lookup = self.translator.lookup
+            pc = self.flush_pipeline()
+            while executed < budget and self.cycles < stop and not self.halted and \
+                    not (self.irq_pending and not self._status & 0x80):
+                block = lookup(pc)
+                if block is None:
+                    self.PC = pc
+                    while not self.step():
+                        pass
+                    executed += 1
+                    pc = self.flush_pipeline()
+                    continue
+                pc = block.run()
+                executed += block.length
+                if pc == block.start and block.idle is not None and self.cycles < stop < NEVER and self.idle_loop(block):
+                    self.idle_skipped += stop - self.cycles
+                    self.cycles = stop
+            self.PC = pc
+            return executed
+        step = self.step
+        breakpoints = self.breakpoints
+        while executed < budget and self.cycles < stop and not self.halted and \
+                not (self.irq_pending and not self._status & 0x80):
+            if breakpoints and executed and self.next_address() in breakpoints:
+                break
+            if step():
+                executed += 1
+        return executed
+
+    def idle_loop(self, block):
+        # nothing but an event can change what the loop reads, unless it polls
+        # a register that changes by itself like a timer counter
+        memory = self.memory
+        for rn, offset in block.idle:
+            bank, offset = memory.resolve(memory.regions, self.reg[rn] + offset & 0xffffffff, 1)
+            if bank is not None and bank.read_handlers is not None and offset & 0xfffffffe in bank.read_handlers:
+                return False
+        return True
+
+    def exception(self, mode, vector, link):
+        saved = self.status
+        self.flush_pipeline()
+        self.status = saved & 0xffffff40 | 0x80 | mode  # ARM state, IRQs masked
+        self.saved_status[mode] = saved
+        self.LR = link
+        self.PC = vector
+        self.branched = True
+
+    def interrupt(self):
+        # IRQ entry, handlers return with subs pc, lr, #4
+        self.exception(self.MODE_irq, 0x18, self.next_address() + 4)
+
+    def next_address(self):
+        # address of the instruction that executes next
+        if self.decode != 0:
+            return self.PC - 2 * self.word_size
+        elif self.fetch != 0:
+            return self.PC - self.word_size
+        return self.PC
+
+    def flush_pipeline(self):
+        # empties the pipeline and returns the address of the next instruction to execute
+        addr = self.next_address()
+        self.decode = 0
+        self.fetch = 0
+        return addr
+
+    def step_block(self):
+        # runs one translated block and returns how many instructions it executed
+        if not self.use_blocks or self.tracer is not None:
+            self.step()
+            return 1
+        pc = self.flush_pipeline()
+        block = self.translator.lookup(pc)
+        if block is None:
+            self.PC = pc
+            self.step()
+            return 1
+        self.PC = block.run()
+        return block.length
+
+    def decode_at(self, addr):
+        # decoded instructions are cached per page of the bank they were read
+        # from, keyed by offset and instruction set, and dropped on writes
+        thumb = self.word_size == 2
+        bank, offset = self.memory.resolve(self.memory.regions, addr, self.word_size)
+        if bank is None:
+            self.decode_misses += 1
+            return self.decoder(self.memory.read16(addr) if thumb else self.memory.read32(addr))
+        page = bank.code_cache.get(offset >> CODE_PAGE_SHIFT)
+        if page is None:
+            page = bank.code_cache[offset >> CODE_PAGE_SHIFT] = {}
+        key = offset << 1 | thumb
+        decoded = page.get(key)
+        if decoded is None:
+            self.decode_misses += 1
+            decoded = page[key] = self.decoder(self.memory.read16(addr) if thumb else self.memory.read32(addr))
+        else:
+            self.decode_hits += 1
+        return decoded
 
     def decoder(self, cmd):
-        decoded = {"cmd": self.NOP, "bin": cmd}
         if self.state == "THUMB":
-            condition = 14
-            if cmd & 1 << 15:
-                pass
+            handler, extract = self.thumb_table[cmd >> 6]
+            decoded = extract(cmd)
+            decoded.cond = 14
+            decoded.always = True
+        else:
+            handler, extract = self.arm_table[(cmd >> 16 & 0xff0) | (cmd >> 4 & 15)]
+            decoded = extract(cmd)
+            decoded.cond = cmd >> 28
+            decoded.always = decoded.cond == 14
+        decoded.cmd = MethodType(handler, self)
+        decoded.bin = cmd
+        return self.bind_operand(decoded)
+
+    def bind_operand(self, decoded):
+        if decoded.operand:
+            decoded.operand = MethodType(decoded.operand, self)
+        return decoded
+
+    @classmethod
+    def build_decode_tables(cls):
+        # ARM is indexed by bits 27-20 and 7-4, THUMB by bits 15-6
+        cls.arm_table = [cls.classify_arm((i & 0xff0) << 16 | (i & 15) << 4) for i in range(4096)]
+        cls.thumb_table = [cls.classify_thumb(i << 6) for i in range(1024)]
+
+    @classmethod
+    def classify_arm(cls, cmd):
+        # First 3 bits
+        if cmd & 1 << 27:
+            if cmd & 1 << 26:
+                if cmd & 1 << 25:  # 111
+                    if cmd & 1 << 24:
+                        return cls.SWI, cls.extract_swi
+                else:  # 110
+                    pass
             else:
-                if cmd & 1 << 14:
-                    if cmd & 1 << 13:
-                        pass
-                    else:
-                        if cmd & 1 << 12:
-                            pass
-                        else:
-                            if cmd & 1 << 11:
-                                pass
-                            else:
-                                if cmd & 1 << 10:
-                                    pass
-                                else:
-                                    op = (cmd >> 6) & 15
-                                    decoded["cmd"] = self.t_ops[op]
-                                    decoded["rd"] = cmd & 7
-                                    decoded["rm"] = (cmd >> 3) & 7
-                else:
-                    if cmd & 1 << 13:
-                        pass
-                    else:
-                        decoded["rd"] = cmd & 7
-                        if cmd & 1 << 12:
-                            if cmd & 1 << 11:
-                                pass
-                            else:
-                                decoded["rm"] = (cmd >> 3) & 7
-                                decoded["im"] = True
-                                decoded["immediate"] = (cmd >> 6) & 31
-                                decoded["cmd"] = self.T_ASR
-
-                        else:
-                            decoded["rm"] = (cmd >> 3) & 7
-                            decoded["im"] = True
-                            decoded["immediate"] = (cmd >> 6) & 31
-                            if cmd & 1 << 11:
-                                decoded["cmd"] = self.T_LSR
-                            else:
-                                decoded["cmd"] = self.T_LSL  # 469
+                if cmd & 1 << 25:  # 101
+                    return cls.BRANCH, cls.extract_branch
+                else:  # 100
+                    if cmd & 1 << 20:
+                        return cls.LDM, cls.extract_block_transfer
+                    return cls.STM, cls.extract_block_transfer
         else:
-            condition = cmd >> 28
-            # First 3 bits
-            if cmd & 1 << 27:
-                if cmd & 1 << 26:
-                    if cmd & 1 << 25:  # 111
-                        pass
-                    else:  # 110
-                        pass
-                else:
-                    if cmd & 1 << 25:  # 101
-                        # branch
-                        decoded["cmd"] = self.BRANCH
-                        decoded["link"] = cmd & 1 << 24
-                        decoded["addr"] = self.SignExtend(cmd & ((1 << 24) - 1), 8, 24)
-                    else:  # 100
-                        a = cmd & 1 << 22
-                        decoded["priv"] = cmd & 1 << 24
-                        decoded["U"] = cmd & 1 << 23
-                        decoded["I"] = a
-                        decoded["W"] = cmd & 1 << 21
-                        if a:
-                            reg_list = cmd & ((1 << 15) - 1)
-                        else:
-                            reg_list = cmd & ((1 << 16) - 1)
-                        decoded["reg_list"] = reg_list
-                        decoded["R"] = cmd & 1 << 15
-                        decoded["rn"] = (cmd >> 16) & 15
-                        if cmd & 1 << 20:
-                            decoded["cmd"] = self.LDM
-                        else:
-                            decoded["cmd"] = self.STM
+            if cmd & 1 << 26:  # 01
+                if cmd & 1 << 20:
+                    return cls.LDR, cls.extract_single_transfer
+                return cls.STR, cls.extract_single_transfer
             else:
-                if cmd & 1 << 26:  # 01
-                    im = cmd & 1 << 25 == 0
-                    load = cmd & 1 << 20
-                    decoded["im"] = im
-                    decoded["rn"] = cmd >> 16 & 15
-                    decoded["rd"] = cmd >> 12 & 15
-                    decoded["rest"] = cmd & (1 << 12) - 1
-                    decoded["priv"] = cmd & 1 << 24
-                    decoded["U"] = cmd & 1 << 23
-                    decoded["I"] = cmd & 1 << 22
-                    decoded["W"] = cmd & 1 << 21
-                    if load:
-                        decoded["cmd"] = self.LDR
-                    else:
-                        decoded["cmd"] = self.STR
+                op = cmd >> 21 & 15
+                a = cmd & 1 << 7
+                b = cmd & 1 << 4
+                im = cmd & 1 << 25  # immediate mode
+                # ldr str on page 201
+                if a and b and not im:  # mul swp str ldr
+                    t = cmd >> 5 & 3
+                    if t != 0:  # extra ldr/str
+                        if cmd & (1 << 20):
+                            return (cls.LDRH, cls.LDRSB, cls.LDRSH)[t - 1], cls.extract_halfword_transfer
+                        return cls.STRH, cls.extract_halfword_transfer
+                    else:  # misc
+                        if op in cls.multiply_ops:
+                            return getattr(cls, cls.multiply_ops[op]), cls.extract_none
                 else:
-                    op = cmd >> 21 & 15
-                    a = cmd & 1 << 7
-                    b = cmd & 1 << 4
-                    im = cmd & 1 << 25  # immediate mode
-                    # ldr str on page 201
-                    if a and b and not im:  # mul swp str ldr
-                        t = cmd >> 5 & 3
-                        if t != 0:  # extra ldr/str
-                            decoded["rn"] = cmd >> 16 & 15
-                            decoded["rd"] = cmd >> 12 & 15
-                            top4 = cmd >> 4 & 0b11110000
-                            decoded["rm"] = top4 + cmd & 15
-                            decoded["priv"] = cmd & 1 << 24
-                            decoded["U"] = cmd & 1 << 23
-                            decoded["im"] = cmd & 1 << 22
-                            decoded["W"] = cmd & 1 << 21
-                            if cmd & (1 << 20):
-                                if t == 1:
-                                    decoded["cmd"] = self.LDRH
-                                elif t == 2:
-                                    decoded["cmd"] = self.LDRSB
-                                elif t == 3:
-                                    decoded["cmd"] = self.LDRSH
-                            else:
-                                decoded["cmd"] = self.STRH
-                        else:  # misc
-                            if op == 0:
-                                decoded["cmd"] = self.MUL
-                            elif op == 1:
-                                decoded["cmd"] = self.MLA
-                            elif op == 4:
-                                decoded["cmd"] = self.UMULL
-                            elif op == 5:
-                                decoded["cmd"] = self.UMLAL
-                            elif op == 6:
-                                decoded["cmd"] = self.SMULL
-                            elif op == 7:
-                                decoded["cmd"] = self.SMLAL
-                            else:
-                                self.print("Invalid Misc op:", op, cmd)
-                    else:
-                        s = cmd & 1 << 20
-                        if s:
-                            decoded["cmd"] = self.ops0s[op]
-                        else:
-                            decoded["cmd"] = self.ops0[op]
-                        decoded["im"] = im
-                        decoded["rest"] = cmd & (1 << 12) - 1
-                        if decoded["cmd"].__name__ == "MRS":
-                            decoded["R"] = cmd & 1 << 22
-                        elif decoded["cmd"].__name__ == "MSR":
-                            if b:
-                                decoded["cmd"] = self.BX
-                                decoded["rm"] = cmd & 15
-                            else:
-                                decoded["field_mask"] = cmd >> 16 & 15
-                                decoded["R"] = cmd & 1 << 22
-                        else:
-                            decoded["s"] = s
-                            decoded["rn"] = cmd >> 16 & 15
-                            decoded["rd"] = cmd >> 12 & 15
-        decoded["cond"] = condition
-        return decoded
+                    if cmd & 1 << 20:
+                        return getattr(cls, cls.data_ops[op]), cls.extract_data_processing
+                    name = cls.data_ops_no_flags[op]
+                    if name == "MRS":
+                        return cls.MRS, cls.extract_mrs
+                    elif name == "MSR":
+                        if b and not im:  # an immediate MSR can have bit 4 set
+                            return cls.BX, cls.extract_bx
+                        return cls.MSR, cls.extract_msr
+                    return getattr(cls, name), cls.extract_data_processing
+        return cls.NOP, cls.extract_none
+
+    @classmethod
+    def classify_thumb(cls, cmd):
+        if cmd & 1 << 15:
+            if cmd >> 8 == 0xdf:
+                return cls.SWI, cls.extract_thumb_swi
+            if cmd >> 12 == 0b1011 and cmd >> 9 & 3 == 0b10:
+                return (cls.LDM if cmd & 1 << 11 else cls.STM), cls.extract_thumb_push_pop
+            if cmd >> 12 == 0b1100:
+                return (cls.LDM if cmd & 1 << 11 else cls.STM), cls.extract_thumb_block_transfer
+        else:
+            if cmd & 1 << 14:
+                if cmd >> 10 & 15 == 0:  # 010000
+                    return getattr(cls, cls.thumb_alu_ops[cmd >> 6 & 15]), cls.extract_thumb_alu
+            else:
+                if not cmd & 1 << 13:
+                    op = cmd >> 11 & 3
+                    if op != 3:
+                        return (cls.T_LSL, cls.T_LSR, cls.T_ASR)[op], cls.extract_thumb_shift
+        return cls.NOP, cls.extract_none
+
+    cond_table = COND_TABLE
+    data_ops = ("AND", "EOR", "SUB", "RSB", "ADD", "ADC", "SBC", "RSC",
+                "TST", "TEQ", "CMP", "CMN", "ORR", "MOV", "BIC", "MVN")
+    data_ops_no_flags = ("AND", "EOR", "SUB", "RSB", "ADD", "ADC", "SBC", "RSC",
+                         "MRS", "MSR", "MRS", "MSR", "ORR", "MOV", "BIC", "MVN")
+    multiply_ops = {0: "MUL", 1: "MLA", 4: "UMULL", 5: "UMLAL", 6: "SMULL", 7: "SMLAL"}
+    thumb_alu_ops = ("AND", "EOR", "T_LSL", "T_LSR", "T_ASR", "ADC", "SBC", "ROR",
+                     "TST", "T_NEG", "CMP", "CMN", "ORR", "T_MUL", "BIC", "MVN")
+
+    # field extractors used by the decode tables
+    @staticmethod
+    def extract_none(cmd):
+        return Instruction()
+
+    @staticmethod
+    def extract_branch(cmd):
+        addr = cmd & ((1 << 24) - 1)
+        if addr & 1 << 23:
+            addr += 0xff << 24
+        return Instruction(link=cmd & 1 << 24, addr=addr)
+
+    @staticmethod
+    def extract_swi(cmd):
+        return Instruction(immediate=cmd >> 16 & 0xff)  # the GBA BIOS only looks at this byte of the comment
+
+    @staticmethod
+    def extract_thumb_swi(cmd):
+        return Instruction(immediate=cmd & 0xff)
+
+    @staticmethod
+    def extract_block_transfer(cmd):
+        reg_list = cmd & 0xffff
+        return Instruction(
+            priv=cmd & 1 << 24,
+            U=cmd & 1 << 23,
+            I=cmd & 1 << 22,
+            W=cmd & 1 << 21,
+            reg_list=reg_list,
+            registers=register_list(reg_list),
+            R=cmd & 1 << 15,
+            rn=(cmd >> 16) & 15
+        )
+
+    @staticmethod
+    def extract_thumb_push_pop(cmd):
+        # POP is ldmia sp!, PUSH is stmdb sp!; the R bit adds pc to POP and lr to PUSH
+        load = cmd & 1 << 11
+        reg_list = cmd & 0xff | (cmd & 1 << 8) << (7 if load else 6)
+        return Instruction(priv=not load, U=load, W=True, reg_list=reg_list,
+                           registers=register_list(reg_list), rn=13)
+
+    @staticmethod
+    def extract_thumb_block_transfer(cmd):
+        reg_list = cmd & 0xff
+        return Instruction(U=True, W=True, reg_list=reg_list, registers=register_list(reg_list), rn=cmd >> 8 & 7)
+
+    @staticmethod
+    def extract_single_transfer(cmd):
+        return Instruction(
+            im=cmd & 1 << 25 == 0,
+            rn=cmd >> 16 & 15,
+            rd=cmd >> 12 & 15,
+            rest=cmd & (1 << 12) - 1,
+            priv=cmd & 1 << 24,
+            U=cmd & 1 << 23,
+            I=cmd & 1 << 22,
+            W=cmd & 1 << 21
+        )
+
+    @staticmethod
+    def extract_halfword_transfer(cmd):
+        return Instruction(
+            rn=cmd >> 16 & 15,
+            rd=cmd >> 12 & 15,
+            rm=(cmd >> 4 & 0b11110000) + (cmd & 15),
+            priv=cmd & 1 << 24,
+            U=cmd & 1 << 23,
+            im=cmd & 1 << 22,
+            W=cmd & 1 << 21
+        )
+
+    @classmethod
+    def extract_data_processing(cls, cmd):
+        return cls.select_operand(Instruction(
+            im=cmd & 1 << 25,
+            rest=cmd & (1 << 12) - 1,
+            s=cmd & 1 << 20,
+            rn=cmd >> 16 & 15,
+            rd=cmd >> 12 & 15
+        ))
+
+    @staticmethod
+    def extract_mrs(cmd):
+        return Instruction(rd=cmd >> 12 & 15, R=cmd & 1 << 22)
+
+    @classmethod
+    def extract_msr(cls, cmd):
+        return cls.select_operand(Instruction(
+            im=cmd & 1 << 25,
+            rest=cmd & (1 << 12) - 1,
+            field_mask=cmd >> 16 & 15,
+            R=cmd & 1 << 22
+        ))
+
+    @staticmethod
+    def extract_bx(cmd):
+        return Instruction(rm=cmd & 15)
+
+    @classmethod
+    def extract_thumb_alu(cls, cmd):
+        # rd = rd op rm through the ARM handlers, always setting flags
+        return Instruction(rd=cmd & 7, rn=cmd & 7, rm=(cmd >> 3) & 7, s=True, operand=cls.op_reg)
+
+    @classmethod
+    def select_operand(cls, ins):
+        # picks the operand2 evaluator once, so the ALU handlers never look at the encoding
+        rest = ins.rest
+        if ins.im:
+            ins.immediate, ins.carry = ROTATED_IMMEDIATES[rest]
+            ins.operand = cls.op_imm if ins.carry is None else cls.op_imm_carry
+            return ins
+        ins.rm = rest & 15
+        kind = rest >> 5 & 3
+        if rest & 16:
+            ins.rs = rest >> 8 & 15
+            ins.operand = (cls.op_lsl_reg, cls.op_lsr_reg, cls.op_asr_reg, cls.op_ror_reg)[kind]
+            return ins
+        ins.amount = rest >> 7
+        if ins.amount == 0:  # LSR #0 and ASR #0 mean 32, ROR #0 is RRX
+            ins.amount = (0, 32, 32, 0)[kind]
+            ins.operand = (cls.op_reg, cls.op_lsr_imm, cls.op_asr_imm, cls.op_rrx)[kind]
+        else:
+            ins.operand = (cls.op_lsl_imm, cls.op_lsr_imm, cls.op_asr_imm, cls.op_ror_imm)[kind]
+        return ins
+
+    @staticmethod
+    def extract_thumb_shift(cmd):
+        return Instruction(rd=cmd & 7, rm=(cmd >> 3) & 7, im=True, immediate=(cmd >> 6) & 31)
 
     def get_reg_shift(self, rest):
         rm = rest & 15
@@ -566,6 +812,7 @@ class Processor:
         shift_code = (rest >> 5) & 3
         shift_t = self.shift_codes[shift_code]
         if rest & 16:  # shift by reg
+            self.cycles += 1
             shift = self.reg[rest >> 8] & 255  # last byte only
             return self.shift(value, shift_t, shift, self.C)
         else:
@@ -591,7 +838,96 @@ class Processor:
             return t(v, n)
 
     def get_immediate(self, rest):
-        return self.ROR(rest & 255, rest >> 8 << 1)
+        value, carry = ROTATED_IMMEDIATES[rest]
+        if self.write_flags and carry is not None:
+            self.C = carry
+        return value
+
+    # operand2 evaluators, bound to each data processing instruction when it is
+    # decoded; the shifter carry is only produced when the handler sets flags
+    def op_imm(self, param):
+        return param.immediate
+
+    def op_imm_carry(self, param):
+        if self.write_flags:
+            self.C = param.carry
+        return param.immediate
+
+    def op_reg(self, param):
+        return self.reg[param.rm]
+
+    def op_lsl_imm(self, param):
+        value = self.reg[param.rm]
+        if self.write_flags:
+            self.C = value >> 32 - param.amount & 1
+        return value << param.amount & 0xffffffff
+
+    def op_lsr_imm(self, param):
+        value = self.reg[param.rm]
+        if self.write_flags:
+            self.C = value >> param.amount - 1 & 1
+        return value >> param.amount
+
+    def op_asr_imm(self, param):
+        value = SInt32(self.reg[param.rm])
+        if self.write_flags:
+            self.C = value >> param.amount - 1 & 1
+        return value >> param.amount & 0xffffffff
+
+    def op_ror_imm(self, param):
+        value = self.reg[param.rm]
+        if self.write_flags:
+            self.C = value >> param.amount - 1 & 1
+        return (value >> param.amount | value << 32 - param.amount) & 0xffffffff
+
+    def op_rrx(self, param):
+        value = self.reg[param.rm]
+        carry = self.C
+        if self.write_flags:
+            self.C = value & 1
+        return value >> 1 | carry << 31
+
+    def op_lsl_reg(self, param):
+        self.cycles += 1
+        value = self.reg[param.rm]
+        amount = self.reg[param.rs] & 255
+        if amount == 0:
+            return value
+        if self.write_flags:
+            self.C = amount <= 32 and value >> 32 - amount & 1
+        return value << amount & 0xffffffff
+
+    def op_lsr_reg(self, param):
+        self.cycles += 1
+        value = self.reg[param.rm]
+        amount = self.reg[param.rs] & 255
+        if amount == 0:
+            return value
+        if self.write_flags:
+            self.C = amount <= 32 and value >> amount - 1 & 1
+        return value >> amount
+
+    def op_asr_reg(self, param):
+        self.cycles += 1
+        value = self.reg[param.rm]
+        amount = min(self.reg[param.rs] & 255, 32)
+        if amount == 0:
+            return value
+        value = SInt32(value)
+        if self.write_flags:
+            self.C = value >> amount - 1 & 1
+        return value >> amount & 0xffffffff
+
+    def op_ror_reg(self, param):
+        self.cycles += 1
+        value = self.reg[param.rm]
+        amount = self.reg[param.rs] & 255
+        if amount == 0:
+            return value
+        amount &= 31
+        if self.write_flags:
+            self.C = value >> (amount or 32) - 1 & 1
+        return (value >> amount | value << 32 - amount) & 0xffffffff
 
     def SignExtend(self, a, i, N):  # num, how many to shift, length of a in bits
         first = a & 1 << N - 1
@@ -599,9 +935,6 @@ class Processor:
             return a + (((1 << i) - 1) << N)
         return a
 
-    def bitcount(self, n):
-        return bin(n).count("1")
-
     def ITAdvance(self):
         if (self.ITSTATE & 7) == 0:
             self.ITSTATE = 0
@@ -614,40 +947,40 @@ class Processor:
     # THUMB Instructions
     def T_AND(self, param):
         self.write_flags = not self.InITBlock()
-        r = self.reg[param["rd"]] & self.reg[param["rm"]]
+        r = self.reg[param.rd] & self.reg[param.rm]
         self.write_to_register(param, r)
 
     def T_LSL(self, param):
         self.write_flags = not self.InITBlock()
         shift = 0
-        if param["im"]:
-            shift = param["immediate"]
+        if param.im:
+            shift = param.immediate
         else:
-            shift = self.reg[param["rd"]] & 255
-        value = self.shift(self.reg[param["rm"]], self.LSL, shift, self.C)
-        param["s"] = self.write_flags
+            shift = self.reg[param.rd] & 255
+        value = self.shift(self.reg[param.rm], self.LSL, shift, self.C)
+        param.s = self.write_flags
         self.write_to_register(param, value)
 
     def T_LSR(self, param):
         self.write_flags = not self.InITBlock()
         shift = 0
-        if param["im"]:
-            shift = param["immediate"]
+        if param.im:
+            shift = param.immediate
         else:
-            shift = self.reg[param["rd"]] & 255
-        value = self.shift(self.reg[param["rm"]], self.LSR, shift, self.C)
-        param["s"] = self.write_flags
+            shift = self.reg[param.rd] & 255
+        value = self.shift(self.reg[param.rm], self.LSR, shift, self.C)
+        param.s = self.write_flags
         self.write_to_register(param, value)
 
     def T_ASR(self, param):
         self.write_flags = not self.InITBlock()
         shift = 0
-        if param["im"]:
-            shift = param["immediate"]
+        if param.im:
+            shift = param.immediate
         else:
-            shift = self.reg[param["rd"]] & 255
-        value = self.shift(self.reg[param["rm"]], self.ASR, shift, self.C)
-        param["s"] = self.write_flags
+            shift = self.reg[param.rd] & 255
+        value = self.shift(self.reg[param.rm], self.ASR, shift, self.C)
+        param.s = self.write_flags
         self.write_to_register(param, value)
 
     def T_NEG(self, param):
@@ -684,448 +1017,366 @@ class Processor:
         return (a + (b << 32)) >> 1
 
     def add_with_carry(self, x, y, i):
-        us = UInt32(x) + UInt32(y) + i
-        ss = SInt32(x) + SInt32(y) + i
-        result = ss & 0xffffffff
-        carry = UInt32(result) != us
-        overflow = SInt32(result) != ss
-        if self.write_flags:
-            self.C = carry
-            self.V = overflow
+        x &= 0xffffffff
+        y &= 0xffffffff
+        result = (x + y + i) & 0xffffffff
+        if self.write_flags:  # N and Z come from the same record
+            self.flag_op = FLAGS_ADD
+            self.flag_x = x
+            self.flag_y = y
+            self.flag_carry = i
+            self.flag_result = result
         return result
 
-    def write_to_register(self, param, value):
-        if param["rd"] == 15:
-            # should not be allowed in hyp, user or system mode
-            # page 1999
-            self.write_current_status(self.saved_status[self.get_mode(self.status)], 0b1111, True)
+    def write_to_register(self, param, value, set_nz=True):
+        # set_nz is False for arithmetic ops, add_with_carry already recorded N and Z
+        if param.rd == 15:
+            if param.s:  # return from an exception, not allowed in user or system mode (page 1999)
+                self.write_current_status(self.saved_status[self.get_mode(self.status)], 0b1111, True)
             self.PC = value
+            self.branched = True
         else:
-            self.reg[param["rd"]] = value
-            if param["s"]:
-                self.N = value & 1 << 31
-                self.Z = value == 0
+            self.reg[param.rd] = value
+            if param.s and set_nz:
+                self.set_nz(value)
 
     # ARM Instructions
     # logical instructions defined page 195
     def AND(self, param):
-        self.write_flags = False if param["rd"] == 15 else param["s"]
-        value = 0
-        if param["im"]:
-            value = self.get_immediate(param["rest"])
-        else:
-            value = self.get_reg_shift(param["rest"])
-        v = self.reg[param["rn"]]
+        self.write_flags = False if param.rd == 15 else param.s
+        value = param.operand(param)
+        v = self.reg[param.rn]
         r = v & value
         self.write_to_register(param, r)
 
     def EOR(self, param):
-        self.write_flags = False if param["rd"] == 15 else param["s"]
-        value = 0
-        if param["im"]:
-            value = self.get_immediate(param["rest"])
-        else:
-            value = self.get_reg_shift(param["rest"])
-        v = self.reg[param["rn"]]
+        self.write_flags = False if param.rd == 15 else param.s
+        value = param.operand(param)
+        v = self.reg[param.rn]
         r = v ^ value
         self.write_to_register(param, r)
 
     def SUB(self, param):
-        self.write_flags = False if param["rd"] == 15 else param["s"]
-        value = 0
-        if param["im"]:
-            value = self.get_immediate(param["rest"])
-        else:
-            value = self.get_reg_shift(param["rest"])
-        v = self.reg[param["rn"]]
+        self.write_flags = False if param.rd == 15 else param.s
+        value = param.operand(param)
+        v = self.reg[param.rn]
         r = self.add_with_carry(v, Not32(value), 1)
-        self.write_to_register(param, r)
+        self.write_to_register(param, r, False)
 
     def RSB(self, param):
-        self.write_flags = False if param["rd"] == 15 else param["s"]
-        value = 0
-        if param["im"]:
-            value = self.get_immediate(param["rest"])
-        else:
-            value = self.get_reg_shift(param["rest"])
-        v = self.reg[param["rn"]]
+        self.write_flags = False if param.rd == 15 else param.s
+        value = param.operand(param)
+        v = self.reg[param.rn]
         r = self.add_with_carry(Not32(v), value, 1)
-        self.write_to_register(param, r)
+        self.write_to_register(param, r, False)
 
     def ADD(self, param):
-        self.write_flags = False if param["rd"] == 15 else param["s"]
-        value = 0
-        if param["im"]:
-            value = self.get_immediate(param["rest"])
-        else:
-            value = self.get_reg_shift(param["rest"])
-        v = self.reg[param["rn"]]
+        self.write_flags = False if param.rd == 15 else param.s
+        value = param.operand(param)
+        v = self.reg[param.rn]
         r = self.add_with_carry(v, value, 0)
-        self.write_to_register(param, r)
+        self.write_to_register(param, r, False)
 
     def ADC(self, param):
-        self.write_flags = False if param["rd"] == 15 else param["s"]
-        value = 0
-        if param["im"]:
-            value = self.get_immediate(param["rest"])
-        else:
-            value = self.get_reg_shift(param["rest"])
-        v = self.reg[param["rn"]]
+        self.write_flags = False if param.rd == 15 else param.s
+        value = param.operand(param)
+        v = self.reg[param.rn]
         r = self.add_with_carry(v, value, self.C)
-        self.write_to_register(param, r)
+        self.write_to_register(param, r, False)
 
     def SBC(self, param):
-        self.write_flags = False if param["rd"] == 15 else param["s"]
-        value = 0
-        if param["im"]:
-            value = self.get_immediate(param["rest"])
-        else:
-            value = self.get_reg_shift(param["rest"])
-        v = self.reg[param["rn"]]
+        self.write_flags = False if param.rd == 15 else param.s
+        value = param.operand(param)
+        v = self.reg[param.rn]
         r = self.add_with_carry(v, Not32(value), self.C)
-        self.write_to_register(param, r)
+        self.write_to_register(param, r, False)
 
     def RSC(self, param):
-        self.write_flags = False if param["rd"] == 15 else param["s"]
-        value = 0
-        if param["im"]:
-            value = self.get_immediate(param["rest"])
-        else:
-            value = self.get_reg_shift(param["rest"])
-        v = self.reg[param["rn"]]
+        self.write_flags = False if param.rd == 15 else param.s
+        value = param.operand(param)
+        v = self.reg[param.rn]
         r = self.add_with_carry(Not32(v), value, self.C)
-        self.write_to_register(param, r)
+        self.write_to_register(param, r, False)
 
     def TST(self, param):
         self.write_flags = True
-        value = 0
-        if param["im"]:
-            value = self.get_immediate(param["rest"])
-        else:
-            value = self.get_reg_shift(param["rest"])
-        v = self.reg[param["rn"]]
+        value = param.operand(param)
+        v = self.reg[param.rn]
         r = v & value
-        self.N = r & 1 << 31
-        self.Z = r == 0
+        self.set_nz(r)
 
     def TEQ(self, param):
         self.write_flags = True
-        value = 0
-        if param["im"]:
-            value = self.get_immediate(param["rest"])
-        else:
-            value = self.get_reg_shift(param["rest"])
-        v = self.reg[param["rn"]]
+        value = param.operand(param)
+        v = self.reg[param.rn]
         r = v ^ value
-        self.N = r & 1 << 31
-        self.Z = r == 0
+        self.set_nz(r)
 
     def CMP(self, param):
         self.write_flags = True
-        value = 0
-        if param["im"]:
-            value = self.get_immediate(param["rest"])
-        else:
-            value = self.get_reg_shift(param["rest"])
-        v = self.reg[param["rn"]]
-        r = self.add_with_carry(v, Not32(value), 1)
-        self.N = r & 1 << 31
-        self.Z = r == 0
+        value = param.operand(param)
+        v = self.reg[param.rn]
+        self.add_with_carry(v, Not32(value), 1)
 
     def CMN(self, param):
         self.write_flags = True
-        value = 0
-        if param["im"]:
-            value = self.get_immediate(param["rest"])
-        else:
-            value = self.get_reg_shift(param["rest"])
-        v = self.reg[param["rn"]]
-        r = self.add_with_carry(v, value, 0)
-        self.N = r & 1 << 31
-        self.Z = r == 0
+        value = param.operand(param)
+        v = self.reg[param.rn]
+        self.add_with_carry(v, value, 0)
 
     def ORR(self, param):
-        self.write_flags = False if param["rd"] == 15 else param["s"]
-        value = 0
-        if param["im"]:
-            value = self.get_immediate(param["rest"])
-        else:
-            value = self.get_reg_shift(param["rest"])
-        v = self.reg[param["rn"]]
+        self.write_flags = False if param.rd == 15 else param.s
+        value = param.operand(param)
+        v = self.reg[param.rn]
         r = v | value
         self.write_to_register(param, r)
 
     def MOV(self, param):  # see page 491 for rd=PC
-        self.write_flags = False if param["rd"] == 15 else param["s"]
-        value = 0
-        if param["im"]:
-            value = self.get_immediate(param["rest"])
-        else:
-            value = self.get_reg_shift(param["rest"])
+        self.write_flags = False if param.rd == 15 else param.s
+        value = param.operand(param)
         self.write_to_register(param, value)
 
     def BIC(self, param):
-        self.write_flags = False if param["rd"] == 15 else param["s"]
-        value = 0
-        if param["im"]:
-            value = self.get_immediate(param["rest"])
-        else:
-            value = self.get_reg_shift(param["rest"])
-        v = self.reg[param["rn"]]
+        self.write_flags = False if param.rd == 15 else param.s
+        value = param.operand(param)
+        v = self.reg[param.rn]
         r = v & Not32(value)
         self.write_to_register(param, r)
 
     def MVN(self, param):
-        self.write_flags = False if param["rd"] == 15 else param["s"]
-        value = 0
-        if param["im"]:
-            value = self.get_immediate(param["rest"])
-        else:
-            value = self.get_reg_shift(param["rest"])
+        self.write_flags = False if param.rd == 15 else param.s
+        value = param.operand(param)
         self.write_to_register(param, Not32(value))
 
     def MRS(self, param):
-        if param["R"]:
-            self.reg[param["rd"]] = self.saved_status(self.get_mode(self.status))
+        if param.R:
+            self.reg[param.rd] = self.saved_status[self.get_mode(self.status)]
         else:
-            self.reg[param["rd"]] = self.status
+            self.reg[param.rd] = self.status
 
     def MSR(self, param):
-        m = param["field_mask"]
-        value = 0
-        if param["im"]:
-            value = self.get_immediate(param["rest"])
-        else:
-            value = self.get_reg_shift(param["rest"])
-        if param["R"]:
+        m = param.field_mask
+        value = param.operand(param)
+        if param.R:
             self.write_saved_status(value, m)
         else:
             self.write_current_status(value, m, False)
 
     def LDR(self, param):
         offset = 0
-        address = self.reg[param["rn"]]
-        write_back = not param["priv"] or param["W"]
-        if param["im"]:
-            offset = param["rest"]
+        address = self.reg[param.rn]
+        write_back = not param.priv or param.W
+        if param.im:
+            offset = param.rest
         else:
-            offset = self.get_reg_shift(param["rest"])
+            offset = self.get_reg_shift(param.rest)
         off_address = address
-        if param["U"]:
+        if param.U:
             off_address += offset
         else:
             off_address -= offset
 
-        if not param["priv"] and param["W"]:
+        if not param.priv and param.W:
             pass
         else:
-            address = off_address if param["priv"] else address
-        if param["rn"] == 15:
+            address = off_address if param.priv else address
+        if param.rn == 15:
             address = off_address & 0xfffffffc
         data = 0
-        if param["I"]:
-            data = self.memory.lookup(address, 1)
+        if param.I:
+            data = self.memory.read8(address)
+            self.cycles += self.memory.cycles_n16[address >> 24 & 0xff] + 1
         else:
-            data = self.memory.lookup(address, self.word_size)
-        if write_back and param["rn"] != 15:
-            self.reg[param["rn"]] = off_address
-        if param["rd"] == 15:
+            data = self.memory.read32(address)
+            self.cycles += self.memory.cycles_n32[address >> 24 & 0xff] + 1
+        if write_back and param.rn != 15:
+            self.reg[param.rn] = off_address & 0xffffffff
+        if param.rd == 15:
             self.PC = data
+            self.branched = True
         else:
-            self.reg[param["rd"]] = data
+            self.reg[param.rd] = data
 
     def LDRH(self, param):
-        write_back = not param["priv"] or param["W"]
-        if param["im"]:
-            offset = self.reg[param["rm"]]
+        write_back = not param.priv or param.W
+        if param.im:
+            offset = param.rm
         else:
-            offset = self.shift(self.reg[param["rm"]], self.LSL, 0, self.C)
-        if param["rn"] == 15:
+            offset = self.shift(self.reg[param.rm], self.LSL, 0, self.C)
+        if param.rn == 15:
             address = self.PC
         else:
-            address = self.reg[param["rn"]]
+            address = self.reg[param.rn]
         off_address = address
-        if param["U"]:
+        if param.U:
             off_address += offset
         else:
             off_address -= offset
-        address = off_address if param["priv"] else address
-        data = self.memory.lookup(address, 2)
-        if write_back and param["rn"] != 15:
-            self.reg[param["rn"]] = off_address
-        if param["rd"] == 15:
+        address = off_address if param.priv else address
+        data = self.memory.read16(address)
+        self.cycles += self.memory.cycles_n16[address >> 24 & 0xff] + 1
+        if write_back and param.rn != 15:
+            self.reg[param.rn] = off_address & 0xffffffff
+        if param.rd == 15:
             self.PC = data
+            self.branched = True
         else:
-            self.reg[param["rd"]] = data
+            self.reg[param.rd] = data
 
 
     def LDRSB(self, param):
-        write_back = not param["priv"] or param["W"]
-        if param["im"]:
-            offset = self.reg[param["rm"]]
+        write_back = not param.priv or param.W
+        if param.im:
+            offset = param.rm
         else:
-            offset = self.shift(self.reg[param["rm"]], self.LSL, 0, self.C)
-        if param["rn"] == 15:
+            offset = self.shift(self.reg[param.rm], self.LSL, 0, self.C)
+        if param.rn == 15:
             address = self.PC
         else:
-            address = self.reg[param["rn"]]
+            address = self.reg[param.rn]
         off_address = address
-        if param["U"]:
+        if param.U:
             off_address += offset
         else:
             off_address -= offset
-        address = off_address if param["priv"] else address
-        data = SignExtend(self.memory.lookup(address, 1), 8, 32)
-        if write_back and param["rn"] != 15:
-            self.reg[param["rn"]] = off_address
-        if param["rd"] == 15:
+        address = off_address if param.priv else address
+        data = self.SignExtend(self.memory.read8(address), 24, 8)
+        self.cycles += self.memory.cycles_n16[address >> 24 & 0xff] + 1
+        if write_back and param.rn != 15:
+            self.reg[param.rn] = off_address & 0xffffffff
+        if param.rd == 15:
             self.PC = data
+            self.branched = True
         else:
-            self.reg[param["rd"]] = data
+            self.reg[param.rd] = data
 
     def LDRSH(self, param):
-        write_back = not param["priv"] or param["W"]
-        if param["im"]:
-            offset = self.reg[param["rm"]]
+        write_back = not param.priv or param.W
+        if param.im:
+            offset = param.rm
         else:
-            offset = self.shift(self.reg[param["rm"]], self.LSL, 0, self.C)
-        if param["rn"] == 15:
+            offset = self.shift(self.reg[param.rm], self.LSL, 0, self.C)
+        if param.rn == 15:
             address = self.PC
         else:
-            address = self.reg[param["rn"]]
+            address = self.reg[param.rn]
         off_address = address
-        if param["U"]:
+        if param.U:
             off_address += offset
         else:
             off_address -= offset
-        address = off_address if param["priv"] else address
-        data = SignExtend(self.memory.lookup(address, 2), 16, 32)
-        if write_back and param["rn"] != 15:
-            self.reg[param["rn"]] = off_address
-        if param["rd"] == 15:
+        address = off_address if param.priv else address
+        if address & 1:  # misaligned halfword loads sign extend the odd byte
+            data = self.SignExtend(self.memory.read8(address), 24, 8)
+        else:
+            data = self.SignExtend(self.memory.read16(address), 16, 16)
+        self.cycles += self.memory.cycles_n16[address >> 24 & 0xff] + 1
+        if write_back and param.rn != 15:
+            self.reg[param.rn] = off_address & 0xffffffff
+        if param.rd == 15:
             self.PC = data
+            self.branched = True
         else:
-            self.reg[param["rd"]] = data
+            self.reg[param.rd] = data
+
+    def transfer_cycles(self, address, count):
+        # one non-sequential access, then sequential ones for the other registers
+        region = address >> 24 & 0xff
+        return self.memory.cycles_n32[region] + (count - 1) * self.memory.cycles_s32[region]
+
+    def transfer_address(self, param, count):
+        # lowest address of the block, the registers always go upwards from it
+        base = self.reg[param.rn]
+        if param.U:
+            start = base + 4 if param.priv else base
+            end = base + 4 * count
+        else:
+            start = base - 4 * count + (0 if param.priv else 4)
+            end = base - 4 * count
+        if param.W:
+            self.reg[param.rn] = end & 0xffffffff
+        return start & 0xfffffffc
 
     def LDM(self, param):
-        before = param["priv"]
-        add = param["U"]
-        write_back = param["W"]
-        reg_list = param["reg_list"]
-        write_pc = reg_list & (1 << 15)
-        address = self.reg[param["rn"]]
-        if param["I"]:
-            length = 4 * self.bitcount(reg_list)
-            if not add:
-                address -= length
-            if add == before:
-                address += 4
-        else:
-            if not add:
-                address -= 4 * self.bitcount(reg_list) + 4
-            if before:
-                address += 4
-
-        for i in range(15):
-            if reg_list & (1 << i):
-                if param["I"] and not write_pc:
-                    self.reg.write_register_with_mode(self.reg.MODE_usr, i, self.memory.lookup(address, 4))
-                else:
-                    self.reg[i] = self.memory.lookup(address, 4)
-                address += 4
-        if write_pc and param["I"]:
-            if write_back:
-                length = 4 * self.bitcount(reg_list) + 4
-                if add:
-                    self.reg[param["rn"]] = self.reg[param["rn"]] + length
-                else:
-                    self.reg[param["rn"]] = self.reg[param["rn"]] - length
-            self.write_current_status(self.saved_status[self.get_mode(self.status)], 0b1111, True)
+        registers = param.registers
+        if not registers:
+            return
+        address = self.transfer_address(param, len(registers))  # a loaded base wins over the write back
+        self.cycles += self.transfer_cycles(address, len(registers)) + 1
+        values = self.memory.read_words(address, len(registers))
+        reg = self.reg
+        if param.reg_list & 1 << 15:
+            for i, value in zip(registers[:-1], values):
+                reg[i] = value
+            if param.I:  # return from an exception
+                self.write_current_status(self.saved_status[self.get_mode(self.status)], 0b1111, True)
+            self.PC = values[-1]
+            self.branched = True
+        elif param.I:
+            for i, value in zip(registers, values):
+                self.write_user_register(i, value)
         else:
-            if write_back:
-                if add:
-                    self.reg[param["rn"]] = self.reg[param["rn"]] + 4 * self.bitcount(reg_list)
-                else:
-                    self.reg[param["rn"]] = self.reg[param["rn"]] - 4 * self.bitcount(reg_list)
-        if write_pc:
-            self.PC = self.memory.lookup(address, 4)
+            for i, value in zip(registers, values):
+                reg[i] = value
 
     def STR(self, param):
         # if rn = 13, priv, not U,W, rest=4 see PUSH
         # if not priv and W see STRT/STRBT
         offset = 0
-        address = self.reg[param["rn"]]
-        write_back = not param["priv"] or param["W"]
-        if param["im"]:
-            offset = param["rest"]
+        address = self.reg[param.rn]
+        write_back = not param.priv or param.W
+        if param.im:
+            offset = param.rest
         else:
-            offset = self.get_reg_shift(param["rest"])
+            offset = self.get_reg_shift(param.rest)
         off_address = address
-        if param["U"]:
+        if param.U:
             off_address += offset
         else:
             off_address -= offset
 
-        if not param["priv"] and param["W"]:
+        if not param.priv and param.W:
             pass
         else:
-            address = off_address if param["priv"] else address
-        if param["I"]:
-            self.memory.write_byte(address, param["rd"] & 0xff)
+            address = off_address if param.priv else address
+        if param.I:
+            self.memory.write8(address, self.reg[param.rd])
+            self.cycles += self.memory.cycles_n16[address >> 24 & 0xff]
         else:
-            self.memory.write_word(address, param["rd"])
-        if write_back and param["rn"] != 15:
-            self.reg[param["rn"]] = off_address
+            self.memory.write32(address, self.reg[param.rd])
+            self.cycles += self.memory.cycles_n32[address >> 24 & 0xff]
+        if write_back and param.rn != 15:
+            self.reg[param.rn] = off_address & 0xffffffff
 
     def STRH(self, param):
-        write_back = not param["priv"] or param["W"]
-        if param["im"]:
-            offset = param["rm"]
+        write_back = not param.priv or param.W
+        if param.im:
+            offset = param.rm
         else:
-            offset = self.shift(self.reg[param["rm"]], self.LSL, 0, self.C)
-        address = self.reg[param["rn"]]
+            offset = self.shift(self.reg[param.rm], self.LSL, 0, self.C)
+        address = self.reg[param.rn]
         off_address = address
-        if param["U"]:
+        if param.U:
             off_address += offset
         else:
             off_address -= offset
-        address = off_address if param["priv"] else address
-        self.memory.write_bytes(address, self.reg[param["rd"]], 2)
-        if write_back and param["rn"] != 15:
-            self.reg[param["rn"]] = off_address
+        address = off_address if param.priv else address
+        self.memory.write16(address, self.reg[param.rd])
+        self.cycles += self.memory.cycles_n16[address >> 24 & 0xff]
+        if write_back and param.rn != 15:
+            self.reg[param.rn] = off_address & 0xffffffff
 
     def STM(self, param):  # 212
-        before = param["priv"]
-        add = param["U"]
-        write_back = param["W"]
-        reg_list = param["reg_list"]
-        address = self.reg[param["rn"]]
-        if param["I"]:
-            length = 4 * self.bitcount(reg_list)
-            if not add:
-                address -= length
-            if add == before:
-                address += 4
+        registers = param.registers
+        if not registers:
+            return
+        if param.I:
+            values = [self.read_user_register(i) for i in registers]
         else:
-            if not add:
-                address -= 4 * self.bitcount(reg_list) + 4
-            if before:
-                address += 4
-
-        for i in range(15):
-            if reg_list & (1 << i):
-                if param["I"]:
-                    self.memory.write_word(address, self.reg.read_register_with_mode(self.reg.MODE_usr, i))
-                else:
-                    self.memory.write_word(address, self.reg[i])
-                address += 4
-        if reg_list & (1 << 15):
-            self.memory.write_word(address, self.PC)
-        if write_back:
-            if add:
-                self.reg[param["rn"]] = self.reg[param["rn"]] + 4 * self.bitcount(reg_list)
-            else:
-                self.reg[param["rn"]] = self.reg[param["rn"]] - 4 * self.bitcount(reg_list)
+            values = [self.reg[i] for i in registers]
+        address = self.transfer_address(param, len(registers))
+        self.cycles += self.transfer_cycles(address, len(registers))
+        self.memory.write_words(address, values)
 
     def MUL(self, param):
         pass
@@ -1149,15 +1400,26 @@ class Processor:
         pass
 
     def BRANCH(self, param):  # ignores last 2 bits, or 1 in thumb
-        if param["link"]:
+        if param.link:
             self.LR = self.PC + self.word_size  # addr of next inst
-        self.PC += (param["addr"] << 2)
+        self.PC += (param.addr << 2)
+        self.branched = True
+
+    def SWI(self, param):
+        if self.bios is not None:
+            self.bios.call(param.immediate)
+        else:
+            self.exception(self.MODE_svc, 0x08, self.PC - self.word_size)
 
     def BX(self, param):
-        addr = self.reg[param["rm"]]
+        addr = self.reg[param.rm]
         if self.state == "ARM":
             if addr & 1:
                 self.T = 1
             elif not (addr & 2):
                 self.T = 0
-        self.PC = addr
\ No newline at end of file
+        self.PC = addr
+        self.branched = True
+
+
+Processor.build_decode_tables()
@@ -0,0 +1,451 @@
+from memory import DIRTY_PAGE_SHIFT
+
+try:
+    import numpy as np
+except ImportError:  # the display falls back to the slow per pixel path
+    np = None
+
+WIDTH = 240
+HEIGHT = 160
+DISPCNT = 0x000
+BG0CNT = 0x008
+BG0HOFS = 0x010
+BG2PA = 0x020  # PA, PB, PC, PD, then the X and Y reference points; BG3 follows 0x10 later
+BG2X = 0x028
+AFFINE_STRIDE = 0x010
+REGISTERS = 0x056  # display registers, DISPCNT up to BLDY
+WHITE = 0x7fff
+PAGE_OFFSET = 0xa000  # second frame buffer of modes 4 and 5
+MODE5_WIDTH = 160
+MODE5_HEIGHT = 128
+TEXT_LAYERS = ((0, 1, 2, 3), (0, 1), ())  # text backgrounds of modes 0, 1 and 2
+TEXT_SIZES = ((256, 256), (512, 256), (256, 512), (512, 512))
+AFFINE_LAYERS = ((), (2,), (2, 3))
+AFFINE_SIZES = (128, 256, 512, 1024)
+CHAR_BLOCK = 0x4000
+SCREEN_BLOCK = 0x800
+OAM_ENTRIES = 128
+OBJ_SIZES = (((8, 8), (16, 16), (32, 32), (64, 64)),  # width, height by shape then size
+             ((16, 8), (32, 8), (32, 16), (64, 32)),
+             ((8, 16), (8, 32), (16, 32), (32, 64)))
+OBJ_TILES = 0x10000
+OBJ_PALETTE = 256
+OBJ_LINE_CYCLES = 1210  # OBJ rendering cycles per line, fewer when DISPCNT leaves HBlank free
+OBJ_HDRAW_CYCLES = 954
+SCALERS = ("nearest", "repeat", "scale2x")  # ways of scaling a frame onto the window
+
+
+def available_scalers():
+    # repeat works on the NumPy frame
+    return SCALERS if np is not None else tuple(name for name in SCALERS if name != "repeat")
+
+
+def scale2x_passes(width, height, target_width, target_height):
+    # how often a frame can be doubled before it outgrows the window
+    passes = 0
+    while width << passes + 1 <= target_width and height << passes + 1 <= target_height:
+        passes += 1
+    return passes
+
+
+def repeat_scale(rgb, sx, sy):
+    # nearest neighbour scaling of a HEIGHT x WIDTH x 3 frame by whole factors
+    return rgb.repeat(sy, 0).repeat(sx, 1)
+
+
+def rgb_table():
+    # RGB bytes for every halfword, bit 15 is ignored and the low 3 bits repeat the top ones
+    color = np.arange(1 << 16, dtype=np.uint32)
+    table = np.empty((1 << 16, 3), np.uint8)
+    for i in range(3):
+        c = color >> 5 * i & 31
+        table[:, i] = c << 3 | c >> 2
+    return table
+
+
+def reference(low, high):
+    # BGxX/BGxY, 20.8 fixed point sign extended from 28 bits
+    value = (high & 0xfff) << 16 | low
+    return value - (1 << 28) if value & 1 << 27 else value
+
+
+def signed16(value):
+    return value - 0x10000 if value & 0x8000 else value
+
+
+def transform(image, x, y, dx, dy, width, wrap):
+    # Samples image along one line per row, starting at the 8 bit fraction
+    # fixed point x, y and stepping dx, dy per pixel. Outside the image gives
+    # index 0, the transparent one, unless it wraps around.
+    steps = np.arange(width)
+    tx = (x[:, None] + dx[:, None] * steps) >> 8
+    ty = (y[:, None] + dy[:, None] * steps) >> 8
+    height, size = image.shape
+    if wrap:
+        return image[ty % height, tx % size]
+    inside = (tx >= 0) & (tx < size) & (ty >= 0) & (ty < height)
+    return np.where(inside, image[ty.clip(0, height - 1), tx.clip(0, size - 1)], 0)
+
+
+class TileCache:
+    # VRAM as 8x8 tiles of palette indices. The 8bpp tiles are a view of the
+    # bytes; the 4bpp ones are unpacked again only for the pages written
+    # since the last update.
+    def __init__(self, bank):
+        self.bank = bank
+        data = np.frombuffer(bank.data, np.uint8)
+        self.packed = data.reshape(-1, 8, 4)
+        self.tiles8 = data.reshape(-1, 8, 8)
+        self.tiles4 = np.empty((len(data) // 32, 8, 8), np.uint8)
+        self.decoded = 0  # 4bpp tiles unpacked so far
+        self.decode(np.arange(len(self.tiles4)))
+
+    def decode(self, tiles):
+        packed = self.packed[tiles]
+        self.tiles4[tiles, :, 0::2] = packed & 15  # low nibble is the left pixel
+        self.tiles4[tiles, :, 1::2] = packed >> 4
+        self.decoded += len(tiles)
+
+    def update(self):
+        # has to run before the dirty pages of the bank are cleaned
+        pages = np.flatnonzero(np.frombuffer(self.bank.dirty, np.uint8))
+        if len(pages):
+            per_page = (1 << DIRTY_PAGE_SHIFT) // 32
+            self.decode((pages[:, None] * per_page + np.arange(per_page)).ravel())
+
+
+class Sprite:
+    # one OAM entry that can show up, in the form the line drawing needs
+    __slots__ = ("x", "y", "width", "height", "box_width", "box_height", "tile", "bank", "color256",
+                 "priority", "hflip", "vflip", "affine", "pa", "pb", "pc", "pd", "cycles")
+
+    def __init__(self, **fields):
+        for name in fields:
+            setattr(self, name, fields[name])
+
+
+class Sprites:
+    # Objects from OAM. The table is only parsed again after OAM was written,
+    # into a list of the objects crossing each scanline. Drawing a line looks
+    # at those in OAM order until the line runs out of OBJ rendering cycles,
+    # like the hardware, so the work follows what is actually visible.
+    def __init__(self, memory, tiles):
+        self.oam = np.frombuffer(memory.OAM.data, "<u2").reshape(OAM_ENTRIES, 4)
+        self.tiles = tiles
+        self.scanlines = [[] for i in range(HEIGHT)]
+        self.images = {}  # decoded object tiles, dropped when VRAM changes
+        self.indices = np.zeros((HEIGHT, WIDTH), np.uint16)  # OBJ palette index of each pixel, 0 where none
+        self.priority = np.zeros((HEIGHT, WIDTH), np.uint8)
+        self.parses = 0
+        self.drawn = 0  # object lines drawn in the last frame
+
+    def parse(self):
+        self.parses += 1
+        attributes = self.oam.tolist()
+        scanlines = [[] for i in range(HEIGHT)]
+        for attr0, attr1, attr2, attr3 in attributes:
+            affine = attr0 & 0x100
+            if not affine and attr0 & 0x200 or attr0 >> 10 & 3 >= 2 or attr0 >> 14 == 3:
+                continue  # hidden, OBJ window or prohibited
+            width, height = OBJ_SIZES[attr0 >> 14][attr1 >> 14]
+            double = 2 if affine and attr0 & 0x200 else 1
+            sprite = Sprite(x=(attr1 & 0x1ff) - (attr1 & 0x100) * 2, y=attr0 & 0xff,
+                            width=width, height=height, box_width=width * double, box_height=height * double,
+                            tile=attr2 & 0x3ff, bank=attr2 >> 12, color256=attr0 & 0x2000,
+                            priority=attr2 >> 10 & 3, hflip=attr1 & 0x1000, vflip=attr1 & 0x2000, affine=affine)
+            if affine:
+                group = (attr1 >> 9 & 31) * 4
+                sprite.pa, sprite.pb, sprite.pc, sprite.pd = (signed16(attributes[group + i][3]) for i in range(4))
+                sprite.cycles = 10 + 2 * sprite.box_width
+            else:
+                sprite.cycles = width
+            for row in range(sprite.box_height):
+                line = sprite.y + row & 0xff  # objects near the bottom wrap to the top
+                if line < HEIGHT:
+                    scanlines[line].append(sprite)
+        self.scanlines = scanlines
+
+    def draw(self, dispcnt):
+        indices = self.indices
+        priority = self.priority
+        indices[:] = 0
+        budget = OBJ_HDRAW_CYCLES if dispcnt & 0x20 else OBJ_LINE_CYCLES
+        one_d = dispcnt & 0x40
+        bitmap = dispcnt & 7 >= 3  # the bitmaps take the lower half of the OBJ tiles
+        self.drawn = 0
+        for line in range(HEIGHT):
+            visible = []
+            cycles = budget
+            for sprite in self.scanlines[line]:
+                cycles -= sprite.cycles
+                if cycles < 0:
+                    break
+                visible.append(sprite)
+            for sprite in reversed(visible):  # lower OAM entries end up in front
+                if bitmap and sprite.tile < 512:
+                    continue
+                start = max(0, -sprite.x)
+                end = min(sprite.box_width, WIDTH - sprite.x)
+                if start >= end:
+                    continue
+                segment = self.row(sprite, line, one_d)[start:end]
+                mask = segment != 0
+                indices[line, sprite.x + start:sprite.x + end][mask] = segment[mask]
+                priority[line, sprite.x + start:sprite.x + end][mask] = sprite.priority
+                self.drawn += 1
+
+    def row(self, sprite, line, one_d):
+        image = self.image(sprite, one_d)
+        row = line - sprite.y & 0xff
+        if sprite.affine:  # rotates around the center of the box
+            dy = row - (sprite.box_height >> 1)
+            left = -(sprite.box_width >> 1)
+            x = sprite.pa * left + sprite.pb * dy + (sprite.width << 7)
+            y = sprite.pc * left + sprite.pd * dy + (sprite.height << 7)
+            return transform(image, np.array([x]), np.array([y]), np.array([sprite.pa]), np.array([sprite.pc]),
+                             sprite.box_width, False)[0]
+        if sprite.vflip:
+            row = sprite.height - 1 - row
+        return image[row, ::-1] if sprite.hflip else image[row]
+
+    def image(self, sprite, one_d):
+        # palette indices of the whole object, rows of 32 tiles apart in 2D mapping or packed in 1D
+        key = (sprite.tile, sprite.width, sprite.height, sprite.color256, sprite.bank, one_d)
+        image = self.images.get(key)
+        if image is not None:
+            return image
+        step = 2 if sprite.color256 else 1
+        columns = sprite.width >> 3
+        stride = columns * step if one_d else 32
+        numbers = sprite.tile + np.arange(sprite.height >> 3)[:, None] * stride + np.arange(columns) * step & 0x3ff
+        if sprite.color256:
+            pixels = self.tiles.tiles8[(OBJ_TILES >> 6) + (numbers >> 1)]
+        else:
+            pixels = self.tiles.tiles4[(OBJ_TILES >> 5) + numbers]
+            pixels = np.where(pixels != 0, pixels | sprite.bank << 4, 0)
+        image = self.images[key] = pixels.transpose(0, 2, 1, 3).reshape(sprite.height, sprite.width).astype(np.uint16)
+        return image
+
+
+class Renderer:
+    # Builds whole frames as arrays of BGR555 colors straight from the video
+    # memory buffers, which the arrays here view without copying. A frame is
+    # only rebuilt when video memory or the display registers changed since
+    # the last one. Once attached to the video timing, the registers are
+    # latched at the end of every scanline, so effects that rewrite scroll or
+    # affine registers during HBlank land on the right lines.
+    def __init__(self, memory):
+        self.memory = memory
+        self.io = memory.IO_RAM
+        self.banks = (memory.PAL_RAM, memory.VRAM, memory.OAM)
+        self.vram = np.frombuffer(memory.VRAM.data, np.uint8)
+        self.vram16 = np.frombuffer(memory.VRAM.data, "<u2")
+        self.palette = np.frombuffer(memory.PAL_RAM.data, "<u2")
+        self.rgb_table = rgb_table()
+        self.frame = np.zeros((HEIGHT, WIDTH), np.uint16)
+        self.tiles = TileCache(memory.VRAM)
+        self.text_cache = {}  # background -> (BGxCNT, palette indices of its whole map)
+        self.affine_cache = {}
+        self.sprites = Sprites(memory, self.tiles)
+        self.sprites.parse()
+        self.lines = bytearray(HEIGHT * REGISTERS)  # display registers as each line was drawn
+        self.references = np.zeros((HEIGHT, 4), np.int64)  # BG2X, BG2Y, BG3X, BG3Y each line started at
+        self.internal = [0, 0, 0, 0]  # the reference points the hardware steps by PB and PD every line
+        self.attached = False
+        self.state = None
+        self.frames = 0  # frames actually rebuilt
+        self.modes = {0: self.tile_mode, 1: self.tile_mode, 2: self.tile_mode,
+                      3: self.bitmap_mode, 4: self.bitmap_mode, 5: self.bitmap_mode}
+        self.bitmaps = {3: self.mode3, 4: self.mode4, 5: self.mode5}
+
+    def attach(self, video):
+        video.hblank_listeners.append(self.latch)
+        video.vblank_listeners.append(self.reload)
+        for bg in range(2):
+            for offset in range(4):
+                self.io.write_handlers[BG2X + bg * AFFINE_STRIDE + 2 * offset] = self.write_reference
+        self.attached = True
+        self.reload()
+
+    def reload(self):
+        # the reference points restart from the registers at VBlank
+        for i in range(4):
+            self.reload_reference(i)
+
+    def reload_reference(self, i):
+        offset = BG2X + (i >> 1) * AFFINE_STRIDE + (i & 1) * 4
+        self.internal[i] = reference(self.io16(offset), self.io16(offset + 2))
+
+    def write_reference(self, offset, old):
+        self.reload_reference((offset - BG2X) // AFFINE_STRIDE * 2 + (offset >> 2 & 1))
+
+    def latch(self, vcount):
+        if vcount >= HEIGHT:
+            return
+        self.lines[vcount * REGISTERS:(vcount + 1) * REGISTERS] = self.io.data[:REGISTERS]
+        self.references[vcount] = self.internal
+        for i in range(4):  # X moves by PB and Y by PD
+            self.internal[i] += signed16(self.io16(BG2PA + (i >> 1) * AFFINE_STRIDE + 2 + (i & 1) * 4))
+
+    def update_lines(self):
+        # without the video timing every line sees the registers as they are now
+        if self.attached:
+            return
+        self.lines[:] = bytes(self.io.data[:REGISTERS]) * HEIGHT
+        self.reload()
+        for i in range(4):
+            step = signed16(self.io16(BG2PA + (i >> 1) * AFFINE_STRIDE + 2 + (i & 1) * 4))
+            self.references[:, i] = self.internal[i] + step * np.arange(HEIGHT)
+
+    def line_registers(self, offset, dtype="<u2"):
+        # one register for every line
+        return np.frombuffer(self.lines, dtype).reshape(HEIGHT, REGISTERS // 2)[:, offset >> 1].astype(np.int64)
+
+    def render(self):
+        # returns the frame as BGR555 colors, row major
+        self.update_lines()
+        state = bytes(self.io.data[:REGISTERS]) + bytes(self.lines) + self.references.tobytes()
+        if state == self.state and not any(bank.is_dirty() for bank in self.banks):
+            return self.frame
+        self.state = state
+        self.frames += 1
+        if self.memory.VRAM.is_dirty():
+            self.tiles.update()
+            self.text_cache.clear()
+            self.affine_cache.clear()
+            self.sprites.images.clear()
+        if self.memory.OAM.is_dirty():
+            self.sprites.parse()
+        dispcnt = self.io16(DISPCNT)
+        mode = self.modes.get(dispcnt & 7)
+        if dispcnt & 0x80:  # forced blank
+            self.frame[:] = WHITE
+        elif mode is None:
+            self.frame[:] = self.palette[0]
+        else:
+            mode(dispcnt)
+        for bank in self.banks:
+            bank.clean()
+        return self.frame
+
+    def io16(self, offset):
+        return self.io.data[offset] | self.io.data[offset + 1] << 8
+
+    def rgb(self):
+        # the frame as 8 bit RGB, HEIGHT x WIDTH x 3
+        return self.rgb_table[self.render()]
+
+    def page(self, dispcnt):
+        return PAGE_OFFSET if dispcnt & 0x10 else 0
+
+    def bitmap_mode(self, dispcnt):
+        if dispcnt & 0x400:  # only BG2 exists in the bitmap modes
+            self.bitmaps[dispcnt & 7](dispcnt)
+        else:
+            self.frame[:] = self.palette[0]
+        if dispcnt & 0x1000:
+            # objects behind the bitmap are hidden, it has no transparent pixels in modes 3 and 5
+            self.sprites.draw(dispcnt)
+            front = self.sprites.priority <= (self.io16(BG0CNT + 4) & 3 if dispcnt & 0x400 else 3)
+            mask = (self.sprites.indices != 0) & front
+            self.frame[mask] = self.palette[OBJ_PALETTE:][self.sprites.indices[mask]]
+
+    def mode3(self, dispcnt):
+        self.frame[:] = self.vram16[:WIDTH * HEIGHT].reshape(HEIGHT, WIDTH)
+
+    def mode4(self, dispcnt):
+        start = self.page(dispcnt)
+        indices = self.vram[start:start + WIDTH * HEIGHT].reshape(HEIGHT, WIDTH)
+        self.frame[:] = self.palette[indices]  # index 0 is transparent and shows the backdrop, palette[0]
+
+    def mode5(self, dispcnt):
+        start = self.page(dispcnt) >> 1
+        self.frame[:] = self.palette[0]
+        self.frame[:MODE5_HEIGHT, :MODE5_WIDTH] = \
+            self.vram16[start:start + MODE5_WIDTH * MODE5_HEIGHT].reshape(MODE5_HEIGHT, MODE5_WIDTH)
+
+    def tile_mode(self, dispcnt):
+        layers = []
+        for bg in TEXT_LAYERS[dispcnt & 7]:
+            if dispcnt & 0x100 << bg:
+                bgcnt = self.io16(BG0CNT + 2 * bg)
+                indices = self.scroll(self.text_layer(bg, bgcnt), self.line_registers(BG0HOFS + 4 * bg) & 0x1ff,
+                                      self.line_registers(BG0HOFS + 4 * bg + 2) & 0x1ff)
+                layers.append((bgcnt & 3, bg, indices, 0))
+        for bg in AFFINE_LAYERS[dispcnt & 7]:
+            if dispcnt & 0x100 << bg:
+                bgcnt = self.io16(BG0CNT + 2 * bg)
+                layers.append((bgcnt & 3, bg, self.affine(bg, bgcnt), 0))
+        if dispcnt & 0x1000:
+            self.sprites.draw(dispcnt)
+            for priority in range(4):  # objects are in front of backgrounds with the same priority
+                indices = np.where(self.sprites.priority == priority, self.sprites.indices, 0)
+                layers.append((priority, -1, indices, OBJ_PALETTE))
+        self.compose(layers)
+
+    def text_layer(self, bg, bgcnt):
+        # palette indices of the whole map, 0 where transparent, kept until VRAM or BGxCNT change
+        cached = self.text_cache.get(bg)
+        if cached is not None and cached[0] == bgcnt:
+            return cached[1]
+        width, height = TEXT_SIZES[bgcnt >> 14]
+        base = (bgcnt >> 8 & 31) * SCREEN_BLOCK >> 1
+        blocks = [self.vram16[base + i * 0x400:base + (i + 1) * 0x400].reshape(32, 32)
+                  for i in range(width * height >> 16)]
+        if len(blocks) == 4:
+            entries = np.block([[blocks[0], blocks[1]], [blocks[2], blocks[3]]])
+        else:
+            entries = np.hstack(blocks) if width == 512 else np.vstack(blocks)
+        char_base = (bgcnt >> 2 & 3) * CHAR_BLOCK
+        if bgcnt & 0x80:
+            tiles = self.tiles.tiles8
+            pixels = tiles[((char_base >> 6) + (entries & 0x3ff)) % len(tiles)]
+        else:
+            tiles = self.tiles.tiles4
+            pixels = tiles[((char_base >> 5) + (entries & 0x3ff)) % len(tiles)]
+        pixels = np.where((entries & 0x400 != 0)[..., None, None], pixels[..., ::-1], pixels)
+        pixels = np.where((entries & 0x800 != 0)[..., None, None], pixels[..., ::-1, :], pixels)
+        if not bgcnt & 0x80:  # 16 color tiles pick one of the 16 palette banks
+            bank = (entries >> 12 << 4).astype(np.uint8)[..., None, None]
+            pixels = np.where(pixels != 0, pixels | bank, 0).astype(np.uint8)
+        image = pixels.transpose(0, 2, 1, 3).reshape(height, width)
+        self.text_cache[bg] = (bgcnt, image)
+        return image
+
+    def scroll(self, image, hofs, vofs):
+        # the visible window of a map, wrapping around its edges; the offsets are per line
+        height, width = image.shape
+        ys = (np.arange(HEIGHT) + vofs) % height
+        xs = (np.arange(WIDTH) + hofs[:, None]) % width
+        return image[ys[:, None], xs]
+
+    def affine_layer(self, bg, bgcnt):
+        # palette indices of the whole map, affine maps always use 8bpp tiles and one byte per entry
+        cached = self.affine_cache.get(bg)
+        if cached is not None and cached[0] == bgcnt:
+            return cached[1]
+        size = AFFINE_SIZES[bgcnt >> 14]
+        count = size >> 3
+        base = (bgcnt >> 8 & 31) * SCREEN_BLOCK
+        entries = self.vram[base:base + count * count].reshape(count, count)
+        tiles = self.tiles.tiles8
+        pixels = tiles[(((bgcnt >> 2 & 3) * CHAR_BLOCK >> 6) + entries.astype(np.intp)) % len(tiles)]
+        image = pixels.transpose(0, 2, 1, 3).reshape(size, size)
+        self.affine_cache[bg] = (bgcnt, image)
+        return image
+
+    def affine(self, bg, bgcnt):
+        params = BG2PA + (bg - 2) * AFFINE_STRIDE
+        return transform(self.affine_layer(bg, bgcnt),
+                         self.references[:, 2 * (bg - 2)], self.references[:, 2 * (bg - 2) + 1],
+                         self.line_registers(params, "<i2"), self.line_registers(params + 4, "<i2"),
+                         WIDTH, bgcnt & 0x2000)
+
+    def compose(self, layers):
+        # layers are (priority, number, palette indices, palette offset), index 0 is transparent;
+        # lower priorities and then lower numbers end up in front
+        frame = self.frame
+        frame[:] = self.palette[0]
+        for priority, number, indices, offset in sorted(layers, key=lambda layer: layer[:2], reverse=True):
+            mask = indices != 0
+            frame[mask] = self.palette[offset:][indices[mask]]
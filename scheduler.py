@@ -0,0 +1,58 @@
+import heapq
+from itertools import count
+
+NEVER = 1 << 62  # timestamp later than anything that gets scheduled
+
+
+class Event:
+    __slots__ = ("time", "callback", "cancelled")
+
+    def __init__(self, time, callback):
+        self.time = time
+        self.callback = callback  # called with the time the event was due
+        self.cancelled = False
+
+
+class Scheduler:
+    # Events ordered by the cycle they are due at. Cancelled events stay in
+    # the heap until they reach the top, so cancel and reschedule are cheap.
+    # next_time is kept up to date for the run loop, which only leaves its
+    # hot loop once the clock reaches it.
+    def __init__(self):
+        self.queue = []
+        self.order = count()  # keeps events due at the same cycle in scheduling order
+        self.next_time = NEVER
+        self.fired = 0
+
+    def schedule(self, time, callback):
+        event = Event(time, callback)
+        heapq.heappush(self.queue, (time, next(self.order), event))
+        if time < self.next_time:
+            self.next_time = time
+        return event
+
+    def cancel(self, event):
+        if event is not None and not event.cancelled:
+            event.cancelled = True
+            self.drop_cancelled()
+
+    def reschedule(self, event, time):
+        self.cancel(event)
+        return self.schedule(time, event.callback)
+
+    def drop_cancelled(self):
+        queue = self.queue
+        while queue and queue[0][2].cancelled:
+            heapq.heappop(queue)
+        self.next_time = queue[0][0] if queue else NEVER
+
+    def run_due(self, now):
+        # fires everything due by now in time order, including events the callbacks schedule
+        queue = self.queue
+        while queue and queue[0][0] <= now:
+            time, order, event = heapq.heappop(queue)
+            if not event.cancelled:
+                event.cancelled = True  # a fired event can no longer be cancelled
+                self.fired += 1
+                event.callback(time)
+        self.drop_cancelled()
@@ -1,8 +1,23 @@
 import processor
 import helper
+import memory
+import tracer
+import scheduler
+import devices
+import bios
+import renderer
+import os
+import tempfile
 import unittest
 from unittest.mock import MagicMock
 
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")  # no window for the frontend tests
+try:
+    import gba
+except ImportError:  # the frontend needs pygame, the core does not
+    gba = None
+
+
 class Test_Labeled32(unittest.TestCase):
     def test_Labeled32(self):
         label = helper.Labeled32([("A", 0, 1), ("Z", 31, 1), ("something", 30, 0)])
@@ -14,6 +29,18 @@ class Test_Labeled32(unittest.TestCase):
         self.assertEqual(label.Z, 1)
         self.assertEqual(label.A, 0)
 
+class Test_Bytes(unittest.TestCase):
+    def test_get_set_bytes(self):
+        ram = bytearray(8)
+        helper.set_bytes(ram, 1, 4, 0x1234567890)
+        self.assertEqual(ram, bytearray([0, 0x90, 0x78, 0x56, 0x34, 0, 0, 0]))
+        self.assertEqual(helper.get_bytes(ram, 1, 4), 0x34567890)
+        ram = [0] * 4
+        helper.set_bytes(ram, 0, 2, -1)
+        self.assertEqual(ram, [255, 255, 0, 0])
+        self.assertEqual(helper.get_bytes(ram, 0, 2), 0xffff)
+
+
 class Test_CPU(unittest.TestCase):
     def setUp(self):
         self.cpu = processor.Processor(0)
@@ -106,6 +133,360 @@ class Test_CPU(unittest.TestCase):
         rrx.assert_called_with(37, 1)
 
 
+    def test_load_store(self):
+        self.cpu.memory = memory.Memory()
+        self.cpu.reg[0] = 0x03000000
+        self.cpu.reg[1] = 0x11223344
+        param = processor.Instruction(rn=0, rd=1, im=True, rest=4, priv=1, U=1, I=0, W=0)
+        self.cpu.STR(param)
+        self.assertEqual(self.cpu.memory.read32(0x03000004), 0x11223344)
+        param = processor.Instruction(rn=0, rd=2, im=True, rest=5, priv=1, U=1, I=0, W=1)
+        self.cpu.LDR(param)
+        self.assertEqual(self.cpu.reg[2], 0x44112233)
+        self.assertEqual(self.cpu.reg[0], 0x03000005)
+        param = processor.Instruction(rn=0, rd=3, im=True, rm=0, priv=1, U=1, W=0)
+        self.cpu.LDRSB(param)
+        self.assertEqual(self.cpu.reg[3], 0x00000033)
+        self.cpu.reg[0] = 0x03000006
+        self.cpu.LDRSH(param)
+        self.assertEqual(self.cpu.reg[3], 0x00001122)
+        self.cpu.memory.write16(0x03000006, 0x8000)
+        self.cpu.LDRSH(param)
+        self.assertEqual(self.cpu.reg[3], 0xffff8000)
+
+    def test_decoder(self):
+        d = self.cpu.decoder(0xe3a00005)  # mov r0, #5
+        self.assertEqual(d.cmd.__name__, "MOV")
+        self.assertEqual((d.rd, d.rest, d.cond), (0, 5, 14))
+        self.assertTrue(d.im)
+        d = self.cpu.decoder(0x0afffffe)  # beq .
+        self.assertEqual(d.cmd.__name__, "BRANCH")
+        self.assertEqual((d.addr, d.cond), (0xfffffffe, 0))
+        d = self.cpu.decoder(0xe12fff13)  # bx r3
+        self.assertEqual((d.cmd.__name__, d.rm), ("BX", 3))
+        d = self.cpu.decoder(0xe10f2000)  # mrs r2, cpsr
+        self.assertEqual((d.cmd.__name__, d.rd), ("MRS", 2))
+        d = self.cpu.decoder(0xe1d320b4)  # ldrh r2, [r3, #4]
+        self.assertEqual((d.cmd.__name__, d.rn, d.rd, d.rm), ("LDRH", 3, 2, 4))
+        d = self.cpu.decoder(0xe321f01f)  # msr cpsr_c, #0x1f
+        self.assertEqual((d.cmd.__name__, d.field_mask, d.immediate), ("MSR", 1, 0x1f))
+        d.cmd(d)
+        self.assertEqual(self.cpu.status & 0x1f, 0x1f)
+        self.assertEqual(self.cpu.decoder(0xe12fff1e).cmd.__name__, "BX")  # bx lr
+        d = self.cpu.decoder(0xe8bd500f)  # ldmfd sp!, {r0-r3, r12, lr}
+        self.assertEqual((d.cmd.__name__, d.rn, d.reg_list), ("LDM", 13, 0x500f))
+        self.cpu.state = "THUMB"
+        d = self.cpu.decoder(0x4008)  # ands r0, r1
+        self.assertEqual((d.cmd.__name__, d.rd, d.rm, d.cond), ("AND", 0, 1, 14))
+        d = self.cpu.decoder(0x1088)  # asrs r0, r1, #2
+        self.assertEqual((d.cmd.__name__, d.rd, d.rm, d.immediate), ("T_ASR", 0, 1, 2))
+
+    def test_decode_cache(self):
+        self.cpu.memory = memory.Memory()
+        self.cpu.memory.write32(0x03000000, 0xe3a00005)  # mov r0, #5
+        self.cpu.memory.write32(0x03000004, 0xe2800001)  # add r0, r0, #1
+        self.cpu.PC = 0x03000000
+        for i in range(4):
+            self.cpu.step()
+        self.assertEqual(self.cpu.reg[0], 6)
+        self.assertEqual(self.cpu.decode_misses, 4)
+        self.cpu.PC = 0x03000000
+        self.cpu.fetch = self.cpu.decode = 0
+        for i in range(4):
+            self.cpu.step()
+        self.assertEqual(self.cpu.reg[0], 6)
+        self.assertEqual(self.cpu.decode_hits, 4)
+        self.cpu.memory.write32(0x03000004, 0xe2800002)  # add r0, r0, #2
+        self.assertEqual(self.cpu.memory.IWRAM.code_cache, {})
+        self.cpu.PC = 0x03000000
+        self.cpu.fetch = self.cpu.decode = 0
+        for i in range(4):
+            self.cpu.step()
+        self.assertEqual(self.cpu.reg[0], 7)
+        self.assertEqual(self.cpu.decode_misses, 8)
+
+    def data_op(self, **fields):
+        # a data processing instruction with its operand2 evaluator, as the decoder builds it
+        return self.cpu.bind_operand(processor.Processor.select_operand(processor.Instruction(**fields)))
+
+    def test_operand_evaluators(self):
+        self.assertEqual(processor.ROTATED_IMMEDIATES[0x4ff], (0xff000000, 1))
+        self.assertEqual(processor.ROTATED_IMMEDIATES[0x0ff], (0xff, None))
+        reg = self.cpu.reg
+        reg[1] = 0x80000003
+        reg[2] = 33
+        cases = [
+            (0x081, 0x00000006, True),  # lsl #1
+            (0x201, 0x00000030, False),  # lsl #4
+            (0x021, 0x00000000, True),  # lsr #32
+            (0x0c1, 0xc0000001, True),  # asr #1
+            (0x061, 0xc0000001, True),  # rrx with C set
+            (0x261, 0x38000000, False),  # ror #4
+            (0x211, 0x00000000, False),  # lsl r2 (33)
+            (0x271, 0xc0000001, True),  # ror r2 (33 is 1)
+            (0x251, 0xffffffff, True),  # asr r2 (33 is 32)
+        ]
+        for rest, value, carry in cases:
+            self.cpu.status = 1 << 29  # C set for the rrx case
+            self.cpu.MOV(self.data_op(rd=0, rest=rest, s=1))
+            self.assertEqual((reg[0], self.cpu.C), (value, carry), hex(rest))
+
+    def test_thumb_alu(self):
+        self.cpu.T = 1
+        self.cpu.reg[0] = 0b1100
+        self.cpu.reg[1] = 0b1010
+        ins = self.cpu.decoder(0x4008)  # ands r0, r1
+        ins.cmd(ins)
+        self.assertEqual(self.cpu.reg[0], 0b1000)
+        self.assertFalse(self.cpu.Z)
+
+    def test_block_transfer(self):
+        self.cpu.memory = memory.Memory()
+        self.cpu.SP = 0x03000100
+        for i in range(4):
+            self.cpu.reg[i] = i + 1
+        self.cpu.reg[12] = 12
+        self.cpu.LR = 0x08000123
+        ins = self.cpu.decoder(0xe92d500f)  # stmfd sp!, {r0-r3, r12, lr}
+        self.assertEqual(ins.registers, (0, 1, 2, 3, 12, 14))
+        ins.cmd(ins)
+        self.assertEqual(self.cpu.SP, 0x03000100 - 24)
+        self.assertEqual(self.cpu.memory.read32(0x03000100 - 24), 1)
+        self.assertEqual(self.cpu.memory.read32(0x03000100 - 4), 0x08000123)
+        for i in range(4):
+            self.cpu.reg[i] = 0
+        ins = self.cpu.decoder(0xe8bd500f)  # ldmfd sp!, {r0-r3, r12, lr}
+        ins.cmd(ins)
+        self.assertEqual(self.cpu.reg[:4], [1, 2, 3, 4])
+        self.assertEqual(self.cpu.LR, 0x08000123)
+        self.assertEqual(self.cpu.SP, 0x03000100)
+
+    def test_store_after_wrapping_write_back(self):
+        for use_blocks in (False, True):
+            self.load_program(0x02000000, [
+                0xe3e03000,  # mvn r3, #0
+                0xe5b34004,  # ldr r4, [r3, #4]!
+                0xe8814008,  # stm r1, {r3, lr}
+            ])
+            self.cpu.use_blocks = use_blocks
+            self.cpu.reg[1] = 0x03000000
+            self.cpu.run(3)
+            self.assertEqual(self.cpu.reg[3], 3)
+            self.assertEqual(self.cpu.memory.read32(0x03000000), 3)
+
+    def test_thumb_push_pop(self):
+        self.cpu.memory = memory.Memory()
+        self.cpu.T = 1
+        self.cpu.SP = 0x03000100
+        self.cpu.reg[4] = 4
+        self.cpu.LR = 0x08000201
+        ins = self.cpu.decoder(0xb510)  # push {r4, lr}
+        ins.cmd(ins)
+        self.assertEqual(self.cpu.SP, 0x030000f8)
+        self.assertEqual(self.cpu.memory.read32(0x030000fc), 0x08000201)
+        self.cpu.reg[4] = 0
+        ins = self.cpu.decoder(0xbd10)  # pop {r4, pc}
+        self.assertEqual(ins.registers, (4, 15))
+        ins.cmd(ins)
+        self.assertEqual(self.cpu.reg[4], 4)
+        self.assertEqual(self.cpu.PC, 0x08000200)
+        self.assertEqual(self.cpu.SP, 0x03000100)
+
+    def load_program(self, addr, program):
+        self.cpu.memory = memory.Memory()
+        for i, cmd in enumerate(program):
+            self.cpu.memory.write32(addr + 4 * i, cmd)
+        self.cpu.PC = addr
+
+    sum_program = [
+        0xe3a00000,  # mov r0, #0
+        0xe3a0100a,  # mov r1, #10
+        0xe0800001,  # loop: add r0, r0, r1
+        0xe2511001,  # subs r1, r1, #1
+        0x1afffffc,  # bne loop
+        0xeafffffe   # b .
+    ]
+
+    def test_blocks(self):
+        self.load_program(0x03000000, self.sum_program)
+        executed = 0
+        while executed < 100:
+            executed += self.cpu.step_block()
+        self.assertEqual(self.cpu.reg[0], 55)
+        self.assertEqual(self.cpu.reg[1], 0)
+        self.assertEqual(self.cpu.PC, 0x03000014)
+        self.assertEqual(self.cpu.translator.compiled, 3)
+        self.cpu.memory.write32(0x03000004, 0xe3a01004)  # mov r1, #4
+        self.assertEqual(self.cpu.memory.IWRAM.code_cache, {})
+        self.cpu.PC = 0x03000000
+        for i in range(10):
+            self.cpu.step_block()
+        self.assertEqual(self.cpu.reg[0], 10)
+
+    def test_blocks_match_interpreter(self):
+        self.load_program(0x03000000, self.sum_program)
+        self.cpu.use_blocks = False
+        for i in range(100):
+            self.cpu.step_block()
+        self.assertEqual(self.cpu.flush_pipeline(), 0x03000014)
+        self.assertEqual(self.cpu.reg[0], 55)
+
+    def test_run(self):
+        self.load_program(0x03000000, self.sum_program)
+        executed = self.cpu.run(40)
+        self.assertGreaterEqual(executed, 40)
+        self.assertEqual(self.cpu.reg[0], 55)
+        self.cpu.use_blocks = False
+        self.cpu.PC = 0x03000000
+        self.assertEqual(self.cpu.run(5), 5)
+        self.assertEqual(self.cpu.reg[0], 10)
+        self.assertEqual(self.cpu.next_address(), 0x03000008)  # bne was taken
+
+    def test_run_stops(self):
+        self.load_program(0x03000000, self.sum_program)
+        self.cpu.breakpoints.add(0x03000010)
+        self.assertEqual(self.cpu.run(100), 4)
+        self.assertEqual(self.cpu.next_address(), 0x03000010)
+        self.assertEqual(self.cpu.run(100), 3)  # resumes past the breakpoint
+
+    def test_idle_loop_detection(self):
+        self.load_program(0x03000000, [
+            0xe5910000,  # loop: ldr r0, [r1]
+            0xe3500000,  # cmp r0, #0
+            0x0afffffc,  # beq loop
+        ] + self.sum_program)
+        translate = self.cpu.translator.translate
+        self.assertEqual(translate(0x03000000).idle, ((1, 0),))
+        self.assertIsNone(translate(0x03000014).idle)  # r0 and r1 carry over to the next iteration
+        self.assertEqual(translate(0x03000020).idle, ())  # b .
+
+    def test_interrupt(self):
+        self.load_program(0x03000000, self.sum_program)
+        bios = bytearray(0x4000)
+        bios[0x18:0x1c] = (0xe25ef004).to_bytes(4, "little")  # subs pc, lr, #4
+        self.cpu.memory.SYS_ROM.initialize(bios)
+        self.cpu.use_blocks = False
+        self.cpu.run(2)
+        self.cpu.irq_pending = True
+        self.cpu.interrupt()
+        self.assertEqual(self.cpu.get_current_mode(), self.cpu.MODE_irq)
+        self.assertEqual(self.cpu.LR, 0x0300000c)
+        self.assertEqual(self.cpu.next_address(), 0x18)
+        self.cpu.irq_pending = False
+        self.cpu.run(1)
+        self.assertEqual(self.cpu.get_current_mode(), 0)
+        self.assertEqual(self.cpu.next_address(), 0x03000008)
+        self.cpu.irq_pending = True
+        self.cpu.status |= 0x80  # masked
+        self.cpu.run(3)
+        self.assertEqual(self.cpu.reg[0], 10)
+
+    def test_cycles(self):
+        # IWRAM is single cycle: 32 instructions plus a refill for each of the 9 taken branches
+        self.load_program(0x03000000, self.sum_program)
+        self.assertEqual(self.cpu.run(cycles=50), 32)
+        self.assertEqual(self.cpu.cycles, 50)
+        self.assertEqual(self.cpu.reg[0], 55)
+        self.load_program(0x03000000, self.sum_program)
+        self.cpu.use_blocks = False
+        self.cpu.cycles = 0
+        self.assertEqual(self.cpu.run(cycles=50), 32)
+        self.assertEqual(self.cpu.cycles, 50)
+        self.assertEqual(self.cpu.reg[0], 55)
+
+    def test_branch_over_one_instruction(self):
+        # a taken branch refills the pipeline even when it lands where the PC already points
+        for use_blocks in (True, False):
+            self.load_program(0x03000000, [
+                0xea000000,  # b skip
+                0xe3a00002,  # mov r0, #2
+                0xe3a00001,  # skip: mov r0, #1
+                0xeafffffe,  # b .
+            ])
+            self.cpu.use_blocks = use_blocks
+            self.cpu.cycles = 0
+            self.assertEqual(self.cpu.run(cycles=1), 1)
+            self.assertEqual(self.cpu.cycles, 1 + self.cpu.refill_cycles(0x03000008))
+            self.assertEqual(self.cpu.next_address(), 0x03000008)
+
+    def test_load_cycles(self):
+        self.load_program(0x02000000, [0xe5901000])  # ldr r1, [r0]
+        self.cpu.memory.write32(0x03000000, 0x1234)
+        self.cpu.reg[0] = 0x03000000
+        self.cpu.use_blocks = False
+        self.cpu.cycles = 0
+        self.cpu.run(1)
+        self.assertEqual(self.cpu.reg[1], 0x1234)
+        self.assertEqual(self.cpu.cycles, 6 + 1 + 1)  # EWRAM fetch, IWRAM N32, internal cycle
+
+    def test_lazy_flags(self):
+        self.cpu.reg[0] = 0x7fffffff
+        self.cpu.ADD(self.data_op(rd=1, rn=0, im=1, rest=1, s=1))  # adds r1, r0, #1
+        self.assertEqual(self.cpu.flag_op, processor.FLAGS_ADD)
+        self.assertEqual(self.cpu.reg[1], 0x80000000)
+        self.assertEqual((self.cpu.N, self.cpu.Z, self.cpu.C, self.cpu.V), (True, False, False, True))
+        self.assertEqual(self.cpu.flag_op, processor.FLAGS_ADD)
+        self.cpu.MOV(self.data_op(rd=2, im=1, rest=0, s=1))  # movs r2, #0 keeps C and V
+        self.assertEqual(self.cpu.flag_op, processor.FLAGS_LOGIC)
+        self.assertEqual(self.cpu.status >> 28, 0x5)  # Z V
+        self.assertEqual(self.cpu.flag_op, processor.FLAGS_CLEAN)
+        self.cpu.reg[0] = 0xffffffff
+        self.cpu.CMN(self.data_op(rn=0, im=1, rest=1))
+        self.assertEqual(self.cpu.status >> 28, 0x6)  # Z C
+
+    def test_condition_table(self):
+        table = processor.COND_TABLE
+        self.assertTrue(table[0][0b0100])  # EQ
+        self.assertFalse(table[0][0b1011])
+        self.assertTrue(table[8][0b0010])  # HI
+        self.assertTrue(table[9][0b0110])  # LS with Z set
+        self.assertTrue(table[9][0b0000])  # LS with C clear
+        self.assertTrue(table[13][0b1000])  # LE with N != V
+        self.assertFalse(table[12][0b1100])  # GT with Z set
+        self.assertTrue(all(table[14]))
+        self.assertFalse(any(table[15]))
+        self.assertTrue(self.cpu.decoder(0xe3a00005).always)
+        self.assertFalse(self.cpu.decoder(0x03a00005).always)
+
+    def test_banked_registers(self):
+        self.cpu.status = self.cpu.MODE_sys
+        self.cpu.reg[8] = 8
+        self.cpu.reg[13] = 0x03007f00
+        self.cpu.reg[14] = 0x08000100
+        self.cpu.write_current_status(self.cpu.MODE_irq, 0b0001, False)
+        self.assertEqual(self.cpu.reg[13], 0)
+        self.assertEqual(self.cpu.reg[8], 8)
+        self.cpu.reg[13] = 0x03007fa0
+        self.assertEqual(self.cpu.read_user_register(13), 0x03007f00)
+        self.cpu.write_user_register(14, 0x08000200)
+        self.cpu.write_current_status(self.cpu.MODE_fiq, 0b0001, False)
+        self.assertEqual(self.cpu.reg[8], 0)
+        self.cpu.reg[8] = 0x88
+        self.assertEqual(self.cpu.read_user_register(8), 8)
+        self.cpu.write_current_status(self.cpu.MODE_irq, 0b0001, False)
+        self.assertEqual((self.cpu.reg[8], self.cpu.reg[13]), (8, 0x03007fa0))
+        self.cpu.status = self.cpu.MODE_usr
+        self.assertEqual((self.cpu.reg[13], self.cpu.reg[14]), (0x03007f00, 0x08000200))
+        self.cpu.status = self.cpu.MODE_fiq
+        self.assertEqual(self.cpu.reg[8], 0x88)
+
+    def test_trace(self):
+        self.load_program(0x03000000, self.sum_program)
+        self.cpu.enable_trace(4)
+        self.assertEqual(self.cpu.run(6), 6)
+        records = list(self.cpu.tracer.records())
+        self.assertEqual(len(records), 4)
+        self.assertEqual(records[0][:2], (0x03000008, 0xe0800001))
+        self.assertEqual(records[-1][:2], (0x03000008, 0xe0800001))
+        self.assertEqual(records[-1][2], 19)  # r0 after the second add
+        with tempfile.TemporaryDirectory() as folder:
+            name = os.path.join(folder, "trace.bin")
+            self.assertEqual(self.cpu.tracer.dump(name), 4)
+            self.assertEqual(tracer.load(name), records)
+        self.assertTrue(tracer.format_record(records[0]).startswith("0x03000008 e0800001  0000000a"))
+        self.cpu.disable_trace()
+        self.assertNotIn("step", self.cpu.__dict__)
+
     def test_get_immediate(self):
         self.assertEqual(self.cpu.get_immediate(0x0bff), 261120)
         self.assertEqual(self.cpu.get_immediate(0x01d3), 3221225524)
@@ -113,51 +494,616 @@ class Test_CPU(unittest.TestCase):
     def test_CMP_immediate(self):
         # N Z C V
         self.cpu.reg[0] = self.cpu.get_immediate(0x047f)
-        param = {
-            "rn": 0,
-            "im": 1,
-            "rest": 0x04ff
-        }
+        param = self.data_op(rn=0, im=1, rest=0x04ff)
         self.cpu.CMP(param)
         self.assertEqual(self.cpu.status >> 28, 0x9) # N V
 
-        param = {
-            "rn": 0,
-            "im": 1,
-            "rest": 0x06ff
-        }
+        param = self.data_op(rn=0, im=1, rest=0x06ff)
         self.cpu.CMP(param)
         self.assertEqual(self.cpu.status >> 28, 0x2) # C
 
-        param = {
-            "rn": 0,
-            "im": 1,
-            "rest": 0x047f
-        }
+        param = self.data_op(rn=0, im=1, rest=0x047f)
         self.cpu.CMP(param)
         self.assertEqual(self.cpu.status >> 28, 0x6) # Z C
 
 
         self.cpu.reg[0] = self.cpu.get_immediate(0x007f)
 
-        param = {
-            "rn": 0,
-            "im": 1,
-            "rest": 0x00ff
-        }
+        param = self.data_op(rn=0, im=1, rest=0x00ff)
         self.cpu.CMP(param)
         self.assertEqual(self.cpu.status >> 28, 0x8) # N
 
         self.cpu.reg[0] = self.cpu.get_immediate(0x0102)
 
-        param = {
-            "rn": 0,
-            "im": 1,
-            "rest": 0x047f
-        }
+        param = self.data_op(rn=0, im=1, rest=0x047f)
         self.cpu.CMP(param)
         self.assertEqual(self.cpu.status >> 28, 0x3) # C V
 
 
+class Test_Memory(unittest.TestCase):
+    def setUp(self):
+        self.mem = memory.Memory()
+
+    def test_region_lookup(self):
+        self.mem.PAK_ROM.initialize(bytes([1, 2, 3, 4]))
+        self.assertEqual(self.mem.lookup(0x08000000, 4), 0x04030201)
+        self.assertEqual(self.mem.lookup(0x0a000002, 2), 0x0403)  # wait state 1 mirror
+        self.mem.write_word(0x03000010, 0xdeadbeef)
+        self.assertEqual(self.mem.lookup(0x03000010, 4), 0xdeadbeef)
+
+    def test_mirrors(self):
+        self.mem.write_word(0x02000004, 0x12345678)
+        self.assertEqual(self.mem.lookup(0x02040004, 4), 0x12345678)
+        self.mem.write_bytes(0x03007ffc, 0xabcd, 2)
+        self.assertEqual(self.mem.lookup(0x03fffffc, 2), 0xabcd)
+        self.mem.write_bytes(0x06010000, 0x1234, 2)
+        self.assertEqual(self.mem.lookup(0x06018000, 2), 0x1234)  # 0x18000 folds back to 0x10000
+        self.assertEqual(self.mem.lookup(0x06030000, 2), 0x1234)
+
+    def test_typed_views(self):
+        self.mem.write_bytes(0x05000002, 0x7fff, 2)
+        self.assertEqual(self.mem.PAL_RAM.data[2:4], b"\xff\x7f")
+        self.assertEqual(self.mem.PAL_RAM.halfwords[1], 0x7fff)
+        self.mem.write_bytes(0x05000005, 0x123456, 3)  # unaligned, goes through set_bytes
+        self.assertEqual(self.mem.lookup(0x05000004, 4), 0x12345600)
+        rom = bytes([1, 2, 3])
+        self.mem.PAK_ROM.initialize(rom)
+        self.assertIs(self.mem.PAK_ROM.data, rom)
+        self.assertIsNone(self.mem.PAK_ROM.words)
+        self.assertEqual(self.mem.lookup(0x08000001, 2), 0x0302)
+
+    def test_load_rom(self):
+        with tempfile.TemporaryDirectory() as folder:
+            name = os.path.join(folder, "rom.gba")
+            with open(name, "wb") as file:
+                file.write(bytes([0x78, 0x56, 0x34, 0x12]))
+                file.truncate(0x2000000 + 0x1000)  # larger than the cartridge window
+            memory.load_rom(self.mem, name)
+            rom = self.mem.PAK_ROM
+            self.assertEqual(rom.size, 0x2000000)
+            self.assertEqual(rom.touched_bytes(), 0)
+            self.assertEqual(self.mem.lookup(0x08000000, 4), 0x12345678)
+            self.assertEqual(self.mem.lookup(0x09fffffe, 2), 0)
+            self.assertEqual(self.mem.lookup(0x08000004, 4), 0)
+            self.assertEqual(rom.touched_bytes(), 2 << memory.TOUCH_PAGE_SHIFT)
+            rom.initialize(b"")  # release the mapping before the file is removed
+
+    def test_typed_accessors(self):
+        self.mem.write32(0x03000102, 0x11223344)  # aligned down to 0x03000100
+        self.assertEqual(self.mem.read32(0x03000100), 0x11223344)
+        self.assertEqual(self.mem.read32(0x03000101), 0x44112233)
+        self.assertEqual(self.mem.read32(0x03000103), 0x22334411)
+        self.assertEqual(self.mem.read16(0x03000102), 0x1122)
+        self.assertEqual(self.mem.read16(0x03000103), 0x22000011)
+        self.assertEqual(self.mem.read8(0x03000103), 0x11)
+        self.mem.write16(0x03000101, 0xabcd)
+        self.mem.write8(0x03000103, 0xef)
+        self.assertEqual(self.mem.read32(0x03000100), 0xef22abcd)
+
+    def test_dirty_pages(self):
+        vram = self.mem.VRAM
+        self.assertFalse(vram.is_dirty())
+        self.mem.write16(0x06000000 + 480 * 10, 0x7fff)  # first pixel of scanline 10
+        self.assertTrue(vram.is_dirty())
+        self.assertTrue(vram.is_dirty(480 * 10, 480 * 11))
+        self.assertFalse(vram.is_dirty(0, 480 * 9))
+        self.mem.write_bytes(0x06002ffe, 0x12345678, 4)  # crosses a page boundary
+        self.assertEqual(vram.dirty.count(1), 3)
+        vram.clean()
+        self.assertFalse(vram.is_dirty())
+        self.mem.write32(0x03000000, 1)
+        self.assertFalse(vram.is_dirty())
+        self.mem.write8(0x07000010, 1)
+        self.assertTrue(self.mem.OAM.is_dirty())
+        self.assertFalse(self.mem.PAL_RAM.is_dirty())
+
+    def test_waitstates(self):
+        mem = memory.Memory()
+        rom = 0x08
+        self.assertEqual((mem.cycles_n16[rom], mem.cycles_s16[rom], mem.cycles_n32[rom], mem.cycles_s32[rom]), (5, 3, 8, 6))
+        self.assertEqual(mem.cycles_n32[0x02], 6)
+        self.assertEqual(mem.cycles_s32[0x03], 1)
+        mem.write16(0x04000204, 0x4317)
+        self.assertEqual((mem.cycles_n16[rom], mem.cycles_s16[rom], mem.cycles_n32[rom], mem.cycles_s32[rom]), (4, 2, 6, 4))
+        self.assertEqual(mem.cycles_n16[0x0d], 9)  # wait state 2
+        self.assertEqual(mem.cycles_n16[0x0e], 9)
+        self.assertEqual(mem.read16(0x04000204), 0x4317)
+
+    def test_open_bus(self):
+        self.mem.open_bus = 0xe3a00000
+        self.assertEqual(self.mem.lookup(0x01000000, 4), 0xe3a00000)
+        self.assertEqual(self.mem.lookup(0x10000000, 2), 0x0000)
+        self.assertEqual(self.mem.lookup(0x08000000, 4), 0xe3a00000)  # no cartridge loaded
+        self.mem.write_word(0x01000000, 5)
+        self.mem.write_word(0x08000000, 5)
+
+
+class Test_Scheduler(unittest.TestCase):
+    def test_order(self):
+        sched = scheduler.Scheduler()
+        fired = []
+        sched.schedule(30, lambda time: fired.append(("c", time)))
+        first = sched.schedule(10, lambda time: fired.append(("a", time)))
+        sched.schedule(20, lambda time: sched.schedule(time + 5, lambda t: fired.append(("b", t))))
+        self.assertEqual(sched.next_time, 10)
+        moved = sched.reschedule(first, 40)
+        self.assertEqual(sched.next_time, 20)
+        sched.run_due(30)
+        self.assertEqual(fired, [("b", 25), ("c", 30)])
+        self.assertEqual(sched.next_time, 40)
+        sched.cancel(moved)
+        self.assertEqual(sched.next_time, scheduler.NEVER)
+
+
+class Test_Devices(unittest.TestCase):
+    def setUp(self):
+        self.mem = memory.Memory()
+        self.cpu = processor.Processor(self.mem)
+        self.irq = devices.Interrupts(self.cpu)
+        self.video = devices.Video(self.cpu, self.irq)
+        self.timers = devices.Timers(self.cpu, self.irq)
+        self.dma = devices.Dma(self.cpu, self.irq, self.video)
+
+    def advance(self, cycles):
+        self.cpu.cycles += cycles
+        self.cpu.scheduler.run_due(self.cpu.cycles)
+
+    def test_video_timing(self):
+        self.mem.write16(0x04000004, 0x0808 | 7)  # vblank irq, vcount 8, flag bits ignored
+        self.assertEqual(self.mem.read16(0x04000004), 0x0808)
+        self.advance(960)
+        self.assertEqual(self.mem.read16(0x04000004) & 2, 2)
+        self.advance(272 + 7 * 1232)
+        self.assertEqual(self.mem.read16(0x04000006), 8)
+        self.assertEqual(self.mem.read16(0x04000004) & 7, 4)
+        self.advance(152 * 1232)
+        self.assertEqual(self.mem.read16(0x04000006), 160)
+        self.assertEqual(self.mem.read16(0x04000004) & 1, 1)
+        self.assertEqual(self.mem.read16(0x04000202), devices.IRQ_VBLANK)
+        self.assertEqual(self.video.frames, 1)
+        self.assertFalse(self.cpu.irq_pending)
+        self.mem.write16(0x04000200, devices.IRQ_VBLANK)
+        self.mem.write16(0x04000208, 1)
+        self.assertTrue(self.cpu.irq_pending)
+        self.mem.write16(0x04000202, devices.IRQ_VBLANK)  # acknowledge
+        self.assertEqual(self.mem.read16(0x04000202), 0)
+        self.assertFalse(self.cpu.irq_pending)
+
+    def test_timers(self):
+        self.mem.write32(0x04000100, 0x00c1fff0)  # reload 0xfff0, prescaler 64, irq
+        self.mem.write32(0x04000104, 0x00840000)  # timer 1 cascades
+        self.advance(64 * 8)
+        self.assertEqual(self.mem.read16(0x04000100), 0xfff8)
+        self.advance(64 * 8)
+        self.assertEqual(self.mem.read16(0x04000100), 0xfff0)
+        self.assertEqual(self.mem.read16(0x04000104), 1)
+        self.assertEqual(self.mem.read16(0x04000202), devices.IRQ_TIMER0)
+        self.advance(64 * 4)
+        self.mem.write16(0x04000102, 0)  # stop
+        self.advance(64 * 4)
+        self.assertEqual(self.mem.read16(0x04000100), 0xfff4)
+
+    def test_dma(self):
+        for i in range(8):
+            self.mem.write16(0x02000000 + 2 * i, i)
+        self.mem.write32(0x040000d4, 0x02000000)
+        self.mem.write32(0x040000d8, 0x06000000)
+        self.mem.write32(0x040000dc, 0xc0000008)  # enable, irq, 8 halfwords
+        self.advance(2)
+        self.assertEqual(self.mem.read16(0x0600000e), 7)
+        self.assertTrue(self.mem.VRAM.is_dirty())
+        self.assertEqual(self.mem.read16(0x040000de), 0x4000)
+        self.assertEqual(self.mem.read16(0x04000202), devices.IRQ_DMA0 << 3)
+        self.mem.write32(0x040000d4, 0x02000000)
+        self.mem.write32(0x040000d8, 0x06001000)
+        self.mem.write32(0x040000dc, 0x95000002)  # 32 bit, on vblank, fixed source
+        self.advance(1232 * 160)
+        self.assertEqual(self.mem.read32(0x06001000), 0x00010000)
+        self.assertEqual(self.mem.read32(0x06001004), 0x00010000)
+        self.assertEqual(self.mem.read32(0x06001008), 0)
+        self.assertEqual(self.dma.transfers, 2)
+
+    def test_dma_special(self):
+        self.mem.write32(0x040000d4, 0x02000000)
+        self.mem.write32(0x040000d8, 0x06000000)
+        self.mem.write32(0x040000dc, 0xb2000004)  # video capture, repeat
+        self.advance(1232 * 228)
+        self.assertEqual(self.dma.transfers, 160)  # lines 2 to 161
+        self.assertEqual(self.mem.read16(0x040000de) & 0x8000, 0)
+        self.mem.write32(0x02000000, 0x12345678)
+        self.mem.write32(0x040000bc, 0x02000000)
+        self.mem.write32(0x040000c0, devices.FIFO_A)
+        self.mem.write32(0x040000c4, 0xb6400004)  # sound FIFO, 32 bit, repeat
+        self.advance(1232 * 228)
+        self.assertEqual(self.dma.transfers, 160)  # waits for the FIFO
+        self.dma.fifo_request(devices.FIFO_B)
+        self.assertEqual(self.dma.transfers, 160)
+        self.dma.fifo_request(devices.FIFO_A)
+        self.assertEqual(self.dma.transfers, 161)
+        self.assertEqual(self.dma.source[1], 0x02000010)
+        self.assertEqual(self.mem.read32(devices.FIFO_A), 0)  # the last of the four words
+        self.assertTrue(self.mem.read16(0x040000c6) & 0x8000)
+
+    def test_halt_and_idle_skip(self):
+        self.mem.write32(0x03000000, 0xe3a00301)  # mov r0, #0x04000000
+        self.mem.write32(0x03000004, 0xe5c00301)  # strb r0, [r0, #0x301]
+        self.mem.write32(0x03000008, 0xeafffffe)  # b .
+        self.cpu.PC = 0x03000000
+        self.mem.write16(0x04000004, 8)
+        self.mem.write16(0x04000200, devices.IRQ_VBLANK)
+        self.cpu.run(cycles=1232 * 100)
+        self.assertTrue(self.cpu.halted)
+        self.assertEqual(self.irq.halts, 1)
+        self.assertGreater(self.cpu.halt_skipped, 1232 * 90)
+        self.mem.write8(0x04000300, 1)  # POSTFLG does not halt again
+        self.assertEqual(self.irq.halts, 1)
+        self.cpu.run(cycles=1232 * 100)
+        self.assertFalse(self.cpu.halted)  # woken by vblank without IME
+        self.assertEqual(self.cpu.next_address(), 0x03000008)
+        self.assertGreater(self.cpu.idle_skipped, 1232 * 30)
+        block = self.cpu.translator.translate(0x03000008)
+        self.assertTrue(self.cpu.idle_loop(block))
+
+    def test_timer_poll_is_not_idle(self):
+        self.mem.write32(0x03000000, 0xe1d100b0)  # loop: ldrh r0, [r1]
+        self.mem.write32(0x03000004, 0xe3500000)  # cmp r0, #0
+        self.mem.write32(0x03000008, 0x1afffffc)  # bne loop
+        block = self.cpu.translator.translate(0x03000000)
+        self.assertEqual(block.idle, ((1, 0),))
+        self.cpu.reg[1] = 0x04000100
+        self.assertFalse(self.cpu.idle_loop(block))
+        self.cpu.reg[1] = 0x04000006
+        self.assertTrue(self.cpu.idle_loop(block))
+
+    def test_run_fires_events(self):
+        bios = bytearray(0x4000)
+        self.mem.SYS_ROM.initialize(bios)
+        self.mem.write32(0x03000000, 0xeafffffe)  # b .
+        self.cpu.PC = 0x03000000
+        self.mem.write16(0x04000004, 8)
+        self.mem.write16(0x04000200, devices.IRQ_VBLANK)
+        self.mem.write16(0x04000208, 1)
+        self.cpu.run(cycles=1232 * 160 + 10)
+        self.assertEqual(self.cpu.get_current_mode(), self.cpu.MODE_irq)
+        self.assertEqual(self.cpu.LR, 0x03000004)
+
+
+class Test_Bios(unittest.TestCase):
+    def setUp(self):
+        self.mem = memory.Memory()
+        self.cpu = processor.Processor(self.mem)
+        self.bios = bios.HleBios(self.cpu)
+
+    def test_decode_swi(self):
+        self.assertEqual(processor.Processor.thumb_table[0xdf06 >> 6][0], processor.Processor.SWI)
+        self.mem.write32(0x03000000, 0xef080000)  # swi 0x08, sqrt
+        self.cpu.PC = 0x03000000
+        self.cpu.reg[0] = 1000000
+        self.cpu.run(1)
+        self.assertEqual(self.cpu.reg[0], 1000)
+        self.assertEqual(self.bios.count, 1)
+
+    def test_boot_return(self):
+        rom = bytearray(0x200)
+        helper.set_bytes(rom, 0, 4, 0xe1a0f00e)  # mov pc, lr
+        self.mem.PAK_ROM.initialize(rom)
+        self.bios.install()
+        self.bios.boot()
+        self.cpu.LR = 0x08000100
+        self.cpu.run(1)
+        self.assertEqual(self.cpu.PC, 0x08000100)
+        self.assertEqual(self.cpu.status & 0x1f, 0x1f)  # still in system mode
+
+    def test_math(self):
+        reg = self.cpu.reg
+        reg[0], reg[1] = helper.UInt32(-7), 2
+        self.bios.call(0x06)
+        self.assertEqual((helper.SInt32(reg[0]), helper.SInt32(reg[1]), reg[3]), (-3, -1, 3))
+        reg[0], reg[1] = 0x100, 0x100
+        self.bios.call(0x0a)
+        self.assertAlmostEqual(reg[0], 0x2000, delta=2)
+        reg[0], reg[1] = 0, helper.UInt32(-5)
+        self.bios.call(0x0a)
+        self.assertEqual(reg[0], 0xc000)
+        self.bios.call(0x19)  # SoundBias
+        self.assertEqual(self.bios.unsupported, {0x19})
+
+    def test_cpu_set(self):
+        reg = self.cpu.reg
+        for i in range(10):
+            self.mem.write32(0x02000000 + 4 * i, i + 1)
+        reg[0], reg[1], reg[2] = 0x02000000, 0x06000000, 1 << 26 | 3
+        self.bios.call(0x0b)
+        self.assertEqual(self.mem.read32(0x06000008), 3)
+        self.assertEqual(self.mem.read32(0x0600000c), 0)
+        reg[0], reg[1], reg[2] = 0x02000004, 0x03000000, 1 << 24 | 4
+        self.bios.call(0x0b)  # 16 bit fill
+        self.assertEqual(self.mem.read32(0x03000004), 0x00020002)
+        self.assertEqual(self.mem.read32(0x03000008), 0)
+        reg[0], reg[1], reg[2] = 0x02000000, 0x03000100, 1
+        self.bios.call(0x0c)  # rounded up to 8 words
+        self.assertEqual(self.mem.read32(0x0300011c), 8)
+        self.assertEqual(self.mem.read32(0x03000120), 0)
+
+    def decompress(self, number, data):
+        self.mem.write_block(0x02000000, bytes(data))
+        self.cpu.reg[0], self.cpu.reg[1] = 0x02000000, 0x03000000
+        self.bios.call(number)
+
+    def test_decompress(self):
+        self.decompress(0x11, [0x10, 8, 0, 0, 0x10, 0x41, 0x42, 0x43, 0x20, 0x02])
+        self.assertEqual(self.mem.read_block(0x03000000, 9), b"ABCABCAB\0")
+        self.decompress(0x14, [0x30, 6, 0, 0, 0x81, 0x41, 0x01, 0x58, 0x59])
+        self.assertEqual(self.mem.read_block(0x03000000, 6), b"AAAAXY")
+        self.decompress(0x13, [0x28, 4, 0, 0, 1, 0xc0, 0x41, 0x42, 0, 0, 0, 0x60])
+        self.assertEqual(self.mem.read_block(0x03000000, 4), b"ABBA")
+        # headers at the end of EWRAM promise more data than the bank holds
+        for number in (0x11, 0x13, 0x14):
+            self.mem.write_block(0x03000000, bytes(8))
+            self.mem.write32(0x0203fffc, 0xffff00 | number << 4)
+            self.cpu.reg[0], self.cpu.reg[1] = 0x0203fffc, 0x03000000
+            self.bios.call(number)
+            self.assertEqual(self.mem.read_block(0x03000000, 8), bytes(8))
+        self.mem.write_block(0x0203fff8, bytes([0x10, 0x10, 0, 0, 0x00, 0x41, 0x42, 0x43]))
+        self.cpu.reg[0] = 0x0203fff8
+        self.bios.call(0x11)
+        self.assertEqual(self.mem.read_block(0x03000000, 4), b"ABC\0")
+
+    def test_affine_set(self):
+        reg = self.cpu.reg
+        self.mem.write_block(0x02000000, bytes([0, 1, 0, 1, 0, 0x40, 0, 0]))  # scale 1 and 1, quarter turn
+        reg[0], reg[1], reg[2], reg[3] = 0x02000000, 0x03000000, 1, 2
+        self.bios.call(0x0f)
+        pa, pb, pc, pd = [helper.SInt32(self.mem.read16(0x03000000 + 2 * i) << 16) >> 16 for i in range(4)]
+        self.assertEqual((pa, pb, pc, pd), (0, -256, 256, 0))
+        self.assertEqual(bios.SINE_TABLE[:4], (0, 0x192, 0x323, 0x4b5))
+        # an eighth of a turn around pixel 10, 0; the shifts round towards minus infinity
+        self.mem.write_block(0x02000000, bytes([0, 0, 0, 0, 0, 0, 0, 0, 10, 0, 0, 0, 0, 1, 0, 1, 0, 0x20, 0, 0]))
+        reg[0], reg[1], reg[2] = 0x02000000, 0x03000000, 1
+        self.bios.call(0x0e)
+        pa, pb, pc, pd = [helper.SInt32(self.mem.read16(0x03000000 + 2 * i) << 16) >> 16 for i in range(4)]
+        self.assertEqual((pa, pb, pc, pd), (181, -182, 181, 181))
+        self.assertEqual(helper.SInt32(self.mem.read32(0x03000008)), -1810)
+        self.assertEqual(helper.SInt32(self.mem.read32(0x0300000c)), -1810)
+
+    def test_vblank_intr_wait(self):
+        irq = devices.Interrupts(self.cpu)
+        devices.Video(self.cpu, irq)
+        self.bios.install()
+        self.bios.boot()
+        self.assertEqual(self.cpu.get_current_mode(), self.cpu.MODE_sys)
+        self.assertEqual(self.cpu.next_address(), 0x08000000)
+        program = [
+            0xef050000,  # swi 0x05
+            0xeafffffe,  # b .
+        ]
+        handler = [
+            0xe3a00301,  # mov r0, #0x04000000
+            0xe3a01001,  # mov r1, #1
+            0xe14010b8,  # strh r1, [r0, #-8], BIOS_IF
+            0xe2800c02,  # add r0, r0, #0x200
+            0xe1c010b2,  # strh r1, [r0, #2], acknowledge IF
+            0xe12fff1e,  # bx lr
+        ]
+        for i, cmd in enumerate(program):
+            self.mem.write32(0x03000000 + 4 * i, cmd)
+        for i, cmd in enumerate(handler):
+            self.mem.write32(0x03000100 + 4 * i, cmd)
+        self.mem.write32(0x03007ffc, 0x03000100)
+        self.mem.write16(0x04000004, 8)
+        self.mem.write16(0x04000200, devices.IRQ_VBLANK)
+        self.cpu.flush_pipeline()
+        self.cpu.PC = 0x03000000
+        self.cpu.run(cycles=1232 * 170)
+        self.assertEqual(self.cpu.next_address(), 0x03000004)
+        self.assertEqual(self.cpu.get_current_mode(), self.cpu.MODE_sys)
+        self.assertGreater(self.cpu.halt_skipped, 1232 * 150)
+        self.assertEqual(self.mem.read16(0x03007ff8), 0)
+        self.assertEqual(self.mem.read16(0x04000202), 0)
+
+
+
+class Test_Scaling(unittest.TestCase):
+    def test_scale2x_passes(self):
+        self.assertEqual(renderer.scale2x_passes(240, 160, 240, 160), 0)
+        self.assertEqual(renderer.scale2x_passes(240, 160, 480, 320), 1)
+        self.assertEqual(renderer.scale2x_passes(240, 160, 1200, 800), 2)  # 5x ends with a nearest scale
+        self.assertEqual(renderer.scale2x_passes(240, 160, 960, 480), 1)  # the smaller factor decides
+
+    def test_available_scalers(self):
+        self.assertEqual(renderer.available_scalers(),
+                         renderer.SCALERS if renderer.np is not None else ("nearest", "scale2x"))
+
+    @unittest.skipIf(renderer.np is None, "needs numpy")
+    def test_repeat_scale(self):
+        rgb = renderer.np.arange(2 * 3 * 3, dtype=renderer.np.uint8).reshape(2, 3, 3)
+        scaled = renderer.repeat_scale(rgb, 2, 3)
+        self.assertEqual(scaled.shape, (6, 6, 3))
+        self.assertEqual(scaled[5, 5].tolist(), rgb[1, 2].tolist())
+        self.assertEqual(scaled[2, 1].tolist(), rgb[0, 0].tolist())
+
+    @unittest.skipIf(gba is None, "needs pygame")
+    def test_present_without_renderer(self):
+        for scaler in renderer.available_scalers():
+            mem = memory.Memory()
+            graphics = gba.Graphics(240, 160, mem.VRAM, 2, 2, None, scaler)
+            self.assertIsNone(graphics.renderer)
+            graphics.present()
+            self.assertEqual(graphics.display.get_size(), (480, 320))
+
+
+@unittest.skipIf(renderer.np is None, "needs numpy")
+class Test_Renderer(unittest.TestCase):
+    def setUp(self):
+        self.mem = memory.Memory()
+        self.video = renderer.Renderer(self.mem)
+
+    def dispcnt(self, value):
+        self.mem.write16(0x04000000, value)
+
+    def test_rgb_table(self):
+        table = renderer.rgb_table()
+        self.assertEqual(list(table[0x7fff]), [255, 255, 255])
+        self.assertEqual(list(table[0x001f]), [255, 0, 0])
+        self.assertEqual(list(table[0x8000 | 0x03e0]), [0, 255, 0])
+
+    def test_mode3(self):
+        self.dispcnt(0x403)
+        self.mem.write16(0x06000000 + 2 * (240 * 10 + 5), 0x7c00)
+        frame = self.video.render()
+        self.assertEqual(frame[10, 5], 0x7c00)
+        self.assertEqual(list(self.video.rgb()[10, 5]), [0, 0, 255])
+        frames = self.video.frames
+        self.video.render()
+        self.assertEqual(self.video.frames, frames)  # nothing changed
+
+    def test_mode4_pages(self):
+        self.mem.write16(0x05000002, 0x1234)
+        self.mem.write16(0x05000004, 0x0567)
+        self.mem.write8(0x06000000, 1)
+        self.mem.write16(0x0600a000, 2)
+        self.dispcnt(0x404)
+        self.assertEqual(self.video.render()[0, 0], 0x1234)
+        self.dispcnt(0x414)
+        self.assertEqual(self.video.render()[0, 0], 0x0567)
+
+    def test_mode5_and_blank(self):
+        self.mem.write16(0x05000000, 0x0011)  # backdrop
+        self.mem.write16(0x06000000 + 2 * 159, 0x2222)
+        self.dispcnt(0x405)
+        frame = self.video.render()
+        self.assertEqual(frame[0, 159], 0x2222)
+        self.assertEqual(frame[0, 160], 0x0011)
+        self.assertEqual(frame[130, 0], 0x0011)
+        self.dispcnt(0x485)
+        self.assertEqual(self.video.render()[0, 0], 0x7fff)
+
+
+    def test_tile_cache(self):
+        tiles = self.video.tiles
+        self.mem.write32(0x06000020, 0x000000f3)  # tile 1, first row
+        decoded = tiles.decoded
+        tiles.update()
+        self.assertEqual(list(tiles.tiles4[1, 0, :3]), [3, 15, 0])
+        self.assertEqual(tiles.decoded - decoded, 8)  # only the written page
+        self.assertEqual(tiles.tiles8[0, 4, :2].tolist(), [0xf3, 0])  # the same bytes as one 8bpp row
+
+    def test_text_background(self):
+        self.mem.write16(0x05000000 + 2 * (16 + 3), 0x1234)  # bank 1, color 3
+        self.mem.write16(0x05000000 + 2 * 5, 0x0555)
+        self.mem.write32(0x06000020, 0x00000003)  # 4bpp tile 1, left pixel of the first row
+        self.mem.write16(0x06004000, 0x1401)  # screen block 8: tile 1, h flip, bank 1
+        self.mem.write16(0x04000008, 0x0801)  # BG0: screen block 8, priority 1
+        self.dispcnt(0x0100)
+        frame = self.video.render()
+        self.assertEqual(frame[0, 7], 0x1234)
+        self.assertEqual(frame[0, 0], 0)
+        self.mem.write16(0x04000010, 3)  # BG0HOFS
+        self.assertEqual(self.video.render()[0, 4], 0x1234)
+        self.mem.write16(0x04000010, 255)  # wraps around the 256 pixel map
+        self.assertEqual(self.video.render()[0, 8], 0x1234)
+        self.mem.write16(0x06004800, 2)  # screen block 9: 8bpp tile 2
+        self.mem.write8(0x06000080, 5)
+        self.mem.write16(0x0400000a, 0x0980)  # BG1: 8bpp, priority 0 in front of BG0
+        self.dispcnt(0x0300)
+        self.assertEqual(self.video.render()[0, 0], 0x0555)
+
+
+    def affine_setup(self):
+        self.mem.write16(0x05000000 + 2 * 5, 0x0555)
+        for row in range(8):  # 8bpp tile 1, left column
+            self.mem.write8(0x06000040 + 8 * row, 5)
+        self.mem.write8(0x06004000, 1)  # top left map entry
+        self.mem.write16(0x04000020, 0x100)  # PA
+        self.mem.write16(0x04000026, 0x100)  # PD
+        self.dispcnt(0x0401)  # mode 1, BG2
+
+    def test_affine_background(self):
+        self.affine_setup()
+        self.mem.write16(0x0400000c, 0x0800)  # 128 pixels, screen block 8
+        frame = self.video.render()
+        self.assertEqual((frame[0, 0], frame[7, 0], frame[0, 1]), (0x0555, 0x0555, 0))
+        self.assertEqual(frame[0, 128], 0)  # clipped
+        self.mem.write16(0x0400000c, 0x2800)
+        self.assertEqual(self.video.render()[0, 128], 0x0555)  # wrapped
+        self.mem.write32(0x04000028, -0x300 & 0xfffffff)  # BG2X, 3 pixels to the right
+        self.mem.write16(0x04000020, 0x80)  # half size horizontally
+        frame = self.video.render()
+        self.assertEqual((frame[0, 5], frame[0, 6], frame[0, 7], frame[0, 8]), (0, 0x0555, 0x0555, 0))
+
+    def test_scanline_latch(self):
+        self.affine_setup()
+        self.mem.write16(0x0400000c, 0x0800)
+        video = MagicMock(hblank_listeners=[], vblank_listeners=[])
+        self.video.attach(video)
+        for line in range(228):
+            if line == 5:  # an HBlank effect moving the layer from line 5 on
+                self.mem.write32(0x04000028, -0x300 & 0xfffffff)
+            for listener in video.hblank_listeners:
+                listener(line)
+        frame = self.video.render()
+        self.assertEqual((frame[4, 0], frame[5, 0], frame[5, 3]), (0x0555, 0, 0x0555))
+        self.assertEqual(self.video.references[5, 1], 5 << 8)  # Y kept stepping by PD
+        for listener in video.vblank_listeners:
+            listener()
+        self.assertEqual(self.video.internal[:2], [-0x300, 0])
+
+
+    def hide_sprites(self):
+        for i in range(128):
+            self.mem.write16(0x07000000 + 8 * i, 0x200)
+
+    def test_sprites(self):
+        self.hide_sprites()
+        self.mem.write16(0x05000200 + 2 * (16 + 1), 0x0123)  # OBJ palette bank 1, color 1
+        self.mem.write8(0x06010000, 1)  # OBJ tile 0, top left pixel
+        self.mem.write8(0x06010040, 1)  # OBJ tile 2
+        self.mem.write16(0x07000000, 10)  # y 10, 8x8
+        self.mem.write16(0x07000002, 0x1000 | 20)  # x 20, h flip
+        self.mem.write16(0x07000004, 0x1000)  # tile 0, bank 1
+        self.dispcnt(0x1000)
+        frame = self.video.render()
+        self.assertEqual((frame[10, 27], frame[10, 20]), (0x0123, 0))
+        parses = self.video.sprites.parses
+        self.mem.write16(0x04000010, 1)  # a register write does not parse OAM again
+        self.video.render()
+        self.assertEqual(self.video.sprites.parses, parses)
+        self.mem.write16(0x07000002, 0x4000 | 20)  # 16x16, the lower left tile is 32 in 2D and 2 in 1D
+        self.assertEqual(self.video.render()[18, 20], 0)
+        self.dispcnt(0x1040)
+        self.assertEqual(self.video.render()[18, 20], 0x0123)
+        self.assertEqual(self.video.sprites.parses, parses + 1)
+
+    def test_sprite_priority_and_affine(self):
+        self.hide_sprites()
+        self.mem.write16(0x05000202, 0x0123)
+        self.mem.write16(0x05000002, 0x0456)
+        self.mem.write8(0x06010000, 1)
+        self.mem.write8(0x06000020, 1)  # BG tile 1
+        self.mem.write16(0x06004000, 1)
+        self.mem.write16(0x04000008, 0x0800)  # BG0 priority 0
+        self.mem.write16(0x07000000, 0x100)  # affine, group 0
+        self.mem.write16(0x07000004, 0x0400)  # priority 1
+        self.mem.write16(0x07000006, 0x100)  # PA
+        self.mem.write16(0x0700001e, 0x100)  # PD
+        self.dispcnt(0x1100)
+        frame = self.video.render()
+        self.assertEqual(frame[0, 0], 0x0456)  # BG0 wins
+        self.mem.write16(0x04000008, 0x0802)
+        self.assertEqual(self.video.render()[0, 0], 0x0123)
+
+    def test_sprite_cycle_limit(self):
+        self.hide_sprites()
+        for i in range(20):
+            self.mem.write16(0x07000000 + 8 * i, 0)
+            self.mem.write16(0x07000002 + 8 * i, 0xc000 | i)  # 64x64
+        self.dispcnt(0x1000)
+        self.video.render()
+        self.assertEqual(self.video.sprites.drawn, 18 * 64)  # 1210 cycles fit 18 of them
+        self.dispcnt(0x1020)
+        self.video.render()
+        self.assertEqual(self.video.sprites.drawn, 14 * 64)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,65 @@
+import sys
+import struct
+from helper import *
+
+# one record: instruction address, opcode, r0-r15 after it ran and the CPSR
+RECORD = struct.Struct("<19I")
+HEADER = struct.Struct("<8sII")  # magic, record size, record count
+MAGIC = b"GBATRACE"
+
+
+class Tracer:
+    # Fixed size ring buffer of executed instructions. Nothing is formatted
+    # while recording; dump() writes the raw records and render() turns a
+    # dump into text offline.
+    def __init__(self, capacity=65536):
+        self.capacity = capacity
+        self.buffer = bytearray(RECORD.size * capacity)
+        self.count = 0  # records written since the last clear, including overwritten ones
+
+    def record(self, pc, opcode, reg, status):
+        RECORD.pack_into(self.buffer, (self.count % self.capacity) * RECORD.size,
+                         pc & 0xffffffff, opcode, *[r & 0xffffffff for r in reg], status)
+        self.count += 1
+
+    def clear(self):
+        self.count = 0
+
+    def records(self):
+        # oldest first
+        n = min(self.count, self.capacity)
+        first = self.count - n
+        for i in range(first, self.count):
+            yield RECORD.unpack_from(self.buffer, (i % self.capacity) * RECORD.size)
+
+    def dump(self, name):
+        n = min(self.count, self.capacity)
+        with open(name, "wb") as file:
+            file.write(HEADER.pack(MAGIC, RECORD.size, n))
+            for record in self.records():
+                file.write(RECORD.pack(*record))
+        return n
+
+
+def load(name):
+    with open(name, "rb") as file:
+        magic, size, n = HEADER.unpack(file.read(HEADER.size))
+        if magic != MAGIC or size != RECORD.size:
+            raise Exception("Not a trace file: %s" % name)
+        data = file.read(size * n)
+    return [RECORD.unpack_from(data, i * size) for i in range(n)]
+
+
+def format_record(record):
+    pc, opcode = record[0], record[1]
+    registers = " ".join("%08x" % r for r in record[2:18])
+    return "%s %08x  %s  cpsr %08x" % (format_hex(pc, 4), opcode, registers, record[18])
+
+
+def render(name, out=sys.stdout):
+    for record in load(name):
+        out.write(format_record(record) + "\n")
+
+
+if __name__ == "__main__":
+    render(sys.argv[1])
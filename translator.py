@@ -0,0 +1,222 @@
+from memory import CODE_PAGE_SHIFT
+
+MAX_BLOCK_LENGTH = 64
+IDLE_LOOP_LENGTH = 8
+FLAGS = 16  # stands for NZCV in the register sets of the idle loop check
+
+LOAD_OPS = ("LDR", "LDRH", "LDRSB", "LDRSH")
+DATA_OPS = ("AND", "EOR", "SUB", "RSB", "ADD", "ADC", "SBC", "RSC",
+            "TST", "TEQ", "CMP", "CMN", "ORR", "MOV", "BIC", "MVN")
+COMPARE_OPS = ("TST", "TEQ", "CMP", "CMN")
+
+# data processing ops that are emitted inline when they neither set flags
+# nor touch the PC, formatted with the rn value and the second operand
+INLINE_OPS = {
+    "AND": "{rn} & {op}",
+    "EOR": "{rn} ^ {op}",
+    "SUB": "({rn} - {op}) & 0xffffffff",
+    "RSB": "({op} - {rn}) & 0xffffffff",
+    "ADD": "({rn} + {op}) & 0xffffffff",
+    "ORR": "{rn} | {op}",
+    "MOV": "{op}",
+    "BIC": "{rn} & ({op} ^ 0xffffffff)",
+    "MVN": "{op} ^ 0xffffffff",
+}
+
+
+class Block:
+    __slots__ = ("start", "thumb", "length", "run", "source", "idle")
+
+    def __init__(self, start, thumb, length, run, source, idle=None):
+        self.start = start
+        self.thumb = thumb
+        self.length = length
+        self.run = run  # executes the block and returns the next address to execute
+        self.source = source
+        self.idle = idle  # (base register, offset) of each load when the block is an idle loop
+
+
+class BlockTranslator:
+    # Compiles straight-line runs of decoded instructions into Python functions.
+    # A block never crosses a code page, so the memory write path drops it
+    # together with the decoded instructions of that page. A store into the
+    # block that is running only takes effect the next time it is looked up.
+    def __init__(self, processor):
+        self.processor = processor
+        self.compiled = 0
+        self.hits = 0
+
+    def lookup(self, addr):
+        cpu = self.processor
+        thumb = cpu.word_size == 2
+        bank, offset = cpu.memory.resolve(cpu.memory.regions, addr, cpu.word_size)
+        if bank is None:
+            return None
+        page = bank.code_cache.get(offset >> CODE_PAGE_SHIFT)
+        if page is None:
+            page = bank.code_cache[offset >> CODE_PAGE_SHIFT] = {}
+        key = ("block", offset << 1 | thumb)
+        block = page.get(key)
+        if block is None:
+            block = page[key] = self.translate(addr)
+        else:
+            self.hits += 1
+        return block
+
+    def ends_block(self, ins):
+        name = ins.cmd.__name__
+        if name in ("BRANCH", "BX", "MSR", "SWI"):
+            return True
+        if name == "LDM":
+            return ins.reg_list & 1 << 15
+        return ins.rd == 15 and name not in ("STR", "STRH", "STM", "MRS", "NOP")
+
+    def inline_operand(self, ins):
+        # second operand as source text, or None when it needs the shifter
+        if self.processor.word_size == 2:  # THUMB ALU ops reuse the ARM handlers with other fields
+            return None
+        if ins.cmd.__name__ not in INLINE_OPS or ins.s or ins.rd == 15 or ins.rn == 15:
+            return None
+        if ins.im:
+            return hex(ins.immediate)
+        if ins.operand.__name__ == "op_reg" and ins.rm != 15:
+            return "r%d" % ins.rm
+        return None
+
+    def idle_loads(self, start, instructions):
+        # A block branching back to its own start that only loads and computes,
+        # carrying no register or flag from one iteration to the next, spins
+        # until something else changes memory. Returns its loads, or None.
+        if self.processor.word_size != 4 or len(instructions) > IDLE_LOOP_LENGTH:
+            return None
+        branch = instructions[-1]
+        last = start + 4 * (len(instructions) - 1)
+        if branch.cmd.__name__ != "BRANCH" or branch.link or (last + 8 + (branch.addr << 2)) & 0xffffffff != start:
+            return None
+        defined = set()  # written on every iteration so far
+        exposed = set()  # read before this iteration wrote them
+        written = set()
+        loads = []
+        for ins in instructions[:-1]:
+            name = ins.cmd.__name__
+            reads = set() if ins.always else {FLAGS}
+            if name in LOAD_OPS:
+                if ins.rn == 15 or not ins.priv or ins.W or not ins.im:
+                    return None
+                offset = ins.rest if name == "LDR" else ins.rm
+                loads.append((ins.rn, offset if ins.U else -offset))
+                reads.add(ins.rn)
+                writes = {ins.rd}
+            elif name in DATA_OPS:
+                if name not in ("MOV", "MVN"):
+                    reads.add(ins.rn)
+                if not ins.im:
+                    reads.add(ins.rest & 15)
+                    if ins.rest & 16:
+                        reads.add(ins.rest >> 8 & 15)
+                    elif ins.rest >> 4 & 0xff == 6:  # RRX
+                        reads.add(FLAGS)
+                if name in ("ADC", "SBC", "RSC"):
+                    reads.add(FLAGS)
+                writes = set() if name in COMPARE_OPS else {ins.rd}
+                if ins.s:
+                    writes.add(FLAGS)
+            else:
+                return None
+            if 15 in writes:
+                return None
+            exposed |= reads - defined
+            written |= writes
+            if ins.always:
+                defined |= writes
+        if not branch.always:
+            exposed |= {FLAGS} - defined
+        if exposed & written:
+            return None
+        return tuple(loads)
+
+    def translate(self, start):
+        cpu = self.processor
+        size = cpu.word_size
+        thumb = size == 2
+        instructions = []
+        addr = start
+        while True:
+            ins = cpu.decode_at(addr)
+            instructions.append(ins)
+            addr += size
+            if self.ends_block(ins) or len(instructions) == MAX_BLOCK_LENGTH:
+                break
+            if addr >> CODE_PAGE_SHIFT != start >> CODE_PAGE_SHIFT:
+                break
+
+        # every instruction costs a sequential fetch, conditional or not
+        lines = ["    cpu.cycles += S[%d] * %d" % (start >> 24 & 0xff, len(instructions))]
+        loaded = set()  # registers currently held in locals
+        dirty = set()  # locals written since the last flush
+
+        def flush():
+            for r in sorted(dirty):
+                lines.append("    reg[%d] = r%d" % (r, r))
+            dirty.clear()
+
+        for n, ins in enumerate(instructions):
+            pc = start + n * size
+            name = ins.cmd.__name__
+            lines.append("    # %s %s" % (hex(pc), name))
+            indent = "    "
+            op = self.inline_operand(ins)
+            if op is not None:
+                # a conditional write keeps the old value, so rd has to be loaded too
+                used = set() if name in ("MOV", "MVN") else {ins.rn}
+                if not ins.im:
+                    used.add(ins.rm)
+                if not ins.always:
+                    used.add(ins.rd)
+                for r in sorted(used - loaded):
+                    lines.append("    r%d = reg[%d]" % (r, r))
+                loaded |= used | {ins.rd}
+                if not ins.always:
+                    lines.append("    if COND_TABLE[%d][nzcv()]:" % ins.cond)
+                    indent += "    "
+                expr = INLINE_OPS[name].format(rn="r%d" % ins.rn, op=op)
+                lines.append("%sr%d = %s" % (indent, ins.rd, expr))
+                dirty.add(ins.rd)
+                continue
+            flush()
+            loaded.clear()
+            lines.append("    reg[15] = %s" % hex(pc + 2 * size))
+            lines.append("    cpu.write_flags = False")
+            if n == len(instructions) - 1 and self.ends_block(ins):
+                lines.append("    cpu.branched = False")
+            if not ins.always:
+                lines.append("    if COND_TABLE[%d][nzcv()]:" % ins.cond)
+                indent += "    "
+            lines.append("%si%d.cmd(i%d)" % (indent, n, n))
+        flush()
+        last = start + (len(instructions) - 1) * size
+        if self.ends_block(instructions[-1]):
+            lines.append("    if cpu.branched:")
+            lines.append("        pc = reg[15]")
+            lines.append("        cpu.cycles += cpu.refill_cycles(pc)")
+            lines.append("        return pc")
+        lines.append("    return %s" % hex(last + size))
+
+        names = ", ".join("i%d" % n for n in range(len(instructions)))
+        source = "\n".join([
+            "def make(cpu, instructions):",
+            "    %s, = instructions" % names,
+            "    reg = cpu.reg",
+            "    COND_TABLE = cpu.cond_table",
+            "    nzcv = cpu.nzcv",
+            "    S = cpu.memory.%s" % ("cycles_s16" if thumb else "cycles_s32"),
+            "    def run():",
+        ] + ["    " + line for line in lines] + [
+            "    return run",
+            ""
+        ])
+        namespace = {}
+        exec(compile(source, "<block %s>" % hex(start), "exec"), namespace)
+        self.compiled += 1
+        return Block(start, thumb, len(instructions), namespace["make"](cpu, instructions), source,
+                     self.idle_loads(start, instructions))